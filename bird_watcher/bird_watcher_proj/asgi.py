@@ -21,7 +21,7 @@ from fastapi.middleware.wsgi import WSGIMiddleware
 from starlette.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
 
-from birdwatcher.views import api_router
+from birdwatcher.views import api_router, ThumbnailFiles
 from pathlib import Path
 
 @asynccontextmanager
@@ -41,7 +41,7 @@ def get_application() -> FastAPI:
     Path(settings.MEDIA_ROOT).joinpath(settings.VIDEOS_DIRECTORY).mkdir(parents=True, exist_ok=True)
     Path(settings.MEDIA_ROOT).joinpath(settings.THUMBNAIL_DIRECTORY).mkdir(parents=True, exist_ok=True)
     app.mount("/static", StaticFiles(directory="static"), name="static")
-    app.mount("/thumbnails", StaticFiles(directory="assets/thumbnails"), name="thumbnail")
+    app.mount("/thumbnails", ThumbnailFiles(directory="assets/thumbnails"), name="thumbnail")
     app.include_router(api_router, prefix="")
     app.mount("/", WSGIMiddleware(get_wsgi_application()))
 
@@ -11,7 +11,7 @@ https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
 from pathlib import Path
-from decouple import Config, RepositoryEnv
+from decouple import Config, RepositoryEnv, Csv
 from zoneinfo import ZoneInfo
 
 __all__ = ['env']
@@ -31,6 +31,7 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 MEDIA_ROOT = "assets"
 VIDEOS_DIRECTORY = "videos"
 THUMBNAIL_DIRECTORY = "thumbnails"
+SEGMENTS_DIRECTORY = "segments"
 
 PROJECT_NAME = 'birdwatcher'
 
@@ -98,10 +99,27 @@ WSGI_APPLICATION = 'bird_watcher_proj.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
+# seconds a query waits for the lock held by another process writing to the database before "database is locked"
+DB_TIMEOUT_SECONDS = env("DB_TIMEOUT_SECONDS", default=20, cast=float)
+# seconds a connection of the webapp is kept between requests, 0 to open one per request
+DB_CONN_MAX_AGE = env("DB_CONN_MAX_AGE", default=600, cast=int)
+# the recorder's writes waiting in its database writer thread are saved together, at most this many at once
+DB_WRITE_BATCH = env("DB_WRITE_BATCH", default=100, cast=int)
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'CONN_MAX_AGE': DB_CONN_MAX_AGE,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'timeout': DB_TIMEOUT_SECONDS,
+            # the lock is taken when a transaction begins, so a transaction that reads then writes waits for the
+            # timeout instead of failing at once when another process wrote in between
+            'transaction_mode': 'IMMEDIATE',
+            # readers don't block the writer nor each other in WAL mode, and commits don't wait for the disk
+            'init_command': 'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL; PRAGMA journal_size_limit=67108864',
+        },
     }
 }
 
@@ -169,8 +187,57 @@ VID_OUTPUT_PXL_FORMAT = env("VID_OUTPUT_PXL_FORMAT", default="yuvj444p", cast=st
 VID_CAMERA_DEVICE = env("VID_CAMERA_DEVICE", cast=str)
 VID_RESOLUTION = env("VID_RESOLUTION",default="640x400",cast=str)
 VID_INPUT_FORMAT = 'yuyv422' #only format supported by v4l2 loopback
+# pixel layout kept through the capture pipeline: 'bgr' (decoded by OpenCV), or the camera's native 'yuyv' or 'nv12'
+VID_CAPTURE_FORMAT = env("VID_CAPTURE_FORMAT", default='bgr', cast=str)
+# encoding is done by a pool of processes, 0 encodes in the recorder process
+VID_ENCODER_PROCESSES = env("VID_ENCODER_PROCESSES", default=2, cast=int)
+# number of frames an encoder process can be behind before the frames are held by the recorder
+VID_ENCODER_BUFFER_FRAMES = env("VID_ENCODER_BUFFER_FRAMES", default=8, cast=int)
+VID_ENCODER_PRESET = env("VID_ENCODER_PRESET", default="medium", cast=str)
+VID_ENCODER_TUNE = env("VID_ENCODER_TUNE", default="", cast=str)
+# threads used by each libx264 encoder, 0 lets it decide
+VID_ENCODER_THREADS = env("VID_ENCODER_THREADS", default=0, cast=int)
+# memory a clip's frames may use while waiting for the encoder, also capped to a quarter of the available RAM
+VID_WRITER_QUEUE_MAX_MB = env("VID_WRITER_QUEUE_MAX_MB", default=256, cast=float)
+# when the encoder can't keep up: 'drop' frames once the queue is full, or 'decimate' to lower the frame rate before it is
+VID_WRITER_OVERLOAD = env("VID_WRITER_OVERLOAD", default='decimate', cast=str)
+# 'frames' buffers the raw frames before a movement and encodes them when the clip starts, 'packets' encodes
+# continuously and starts clips with the already encoded packets (less memory, no encoding burst)
+VID_PREROLL_MODE = env("VID_PREROLL_MODE", default='frames', cast=str)
+# keyframe interval of the continuous encoding in 'packets' mode, the pre-roll can be up to this much longer
+VID_PREROLL_GOP_SECONDS = env("VID_PREROLL_GOP_SECONDS", default=1, cast=float)
+# longest keyframe interval of clips encoded from frames, the hover preview only uses keyframes
+VID_KEYFRAME_SECONDS = env("VID_KEYFRAME_SECONDS", default=2, cast=float)
+# 'clips' writes a video file per movement, 'segments' records continuously in segments and keeps the movements as
+# time ranges in them
+VID_RECORDING_MODE = env("VID_RECORDING_MODE", default='clips', cast=str)
+# length of the segments, rounded up to a multiple of VID_PREROLL_GOP_SECONDS
+VID_SEGMENT_SECONDS = env("VID_SEGMENT_SECONDS", default=6, cast=float)
+# segments without movement are deleted after this long
+VID_SEGMENT_RETENTION_MINUTES = env("VID_SEGMENT_RETENTION_MINUTES", default=10, cast=float)
+# the oldest videos are deleted while the videos and segments use more than this, 0 for no limit
+RETENTION_MAX_GB = env("RETENTION_MAX_GB", default=0, cast=float)
+# videos older than this are deleted, 0 keeps them
+RETENTION_MAX_DAYS = env("RETENTION_MAX_DAYS", default=0, cast=float)
+# the oldest videos are deleted while less than this is free on the disk of the videos
+RETENTION_MIN_FREE_MB = env("RETENTION_MIN_FREE_MB", default=500, cast=float)
+# minutes between two checks of the retention limits, they are also checked before each clip
+RETENTION_INTERVAL_MINUTES = env("RETENTION_INTERVAL_MINUTES", default=10, cast=float)
 VID_FORCED_FRAMERATE = env("VID_FORCED_FRAMERATE", default=-1, cast=float)
 DEVICE_DUPLICATION = env("DEVICE_DUPLICATION", default='none', cast=str)
+# number of frames kept in the shared memory ring when DEVICE_DUPLICATION is 'shm'
+FRAME_BUS_SLOTS = env("FRAME_BUS_SLOTS", default=6, cast=int)
+# where the motion detector serves its metrics (Prometheus text format): 'host:port', the path of a unix socket,
+# or empty to disable them
+METRICS_ADDRESS = env("METRICS_ADDRESS", default='127.0.0.1:9464', cast=str)
+# seconds an image of the camera is kept in memory and served by /stream/single before a new one is taken
+SNAPSHOT_INTERVAL = env("SNAPSHOT_INTERVAL", default=2, cast=float)
+# widths of the smaller copies of the thumbnails, for the cards of the video list and high density screens
+THUMBNAIL_WIDTHS = env("THUMBNAIL_WIDTHS", default="320,640", cast=Csv(int))
+# frames in the sprite shown when hovering a video in the list, taken from the keyframes of the video
+PREVIEW_FRAMES = env("PREVIEW_FRAMES", default=12, cast=int)
+# width of a frame of the hover preview
+PREVIEW_WIDTH = env("PREVIEW_WIDTH", default=160, cast=int)
 
 MOTION_CHECKS_PER_SECOND = env("MOTION_CHECKS_PER_SECOND", default=2, cast=float)
 MOTION_DETECTION_THRESHOLD = env("MOTION_DETECTION_THRESHOLD", default=0.07, cast=float)
@@ -184,6 +251,9 @@ CONSTANCE_CONFIG = {
     "MOTION_SENSITIVITY_THRESHOLD": (40, "How sensitive a pixel luminosity change should be to be considered a motion change (usually a value above 20 is recommended to avoid random noise to be considered motion)", int),
     "MOTION_DETECTION_THRESHOLD" : (MOTION_DETECTION_THRESHOLD, "", float),
     "MOTION_CHECKS_PER_SECOND" : (MOTION_CHECKS_PER_SECOND, "", float),
+    "MOTION_MIN_CHECKS_PER_SECOND" : (1.0, "Motion checks per second on a quiet scene: the checks slow down to this rate while the scene stays far below the detection threshold. Movements shorter than 1/rate seconds can be missed", float),
+    "MOTION_ENGINE" : ("average", "Background model used to detect movement: 'average' (running average of the checked frames), 'diff' (the original running average, rounded down at each check), 'mog2' or 'knn' (OpenCV background subtraction, adapts to lighting changes but ignores the sensitivity above)", str),
+    "MOTION_MAX_CHECKS_PER_SECOND" : (0.0, "Motion checks per second when a movement is close to the detection threshold or being recorded. 0 checks every frame", float),
     "RECORD_SECONDS_BEFORE_MOVEMENT" : (RECORD_SECONDS_BEFORE_MOVEMENT, "", float),
     "RECORD_SECONDS_AFTER_MOVEMENT" : (RECORD_SECONDS_AFTER_MOVEMENT, "", float),
     
@@ -191,4 +261,5 @@ CONSTANCE_CONFIG = {
     "MOTION_DETECT_AREA_TL_Y" : (0.0, "Y coordinate of the top left corner of the area to monitor for movement", float),
     "MOTION_DETECT_AREA_BR_X" : (100.0, "X coordinate of the bottom right corner of the area to monitor for movement", float),
     "MOTION_DETECT_AREA_BR_Y" : (100.0, "Y coordinate of the bottom right corner of the area to monitor for movement", float),
+    "MOTION_ZONES" : ("", "JSON list of polygon zones to monitor for movement, drawn on this page. Each has 'points' ([x,y] percentages), optional 'threshold', 'sensitivity' and 'exclude' (mask). Replaces the area above when it has a zone to monitor", str),
 }
@@ -0,0 +1,154 @@
+from constance import config
+from django.conf import settings
+from django.core.management import BaseCommand, call_command
+from django.db import connections, transaction, OperationalError
+from birdwatcher.management.commands import watch_motion
+from birdwatcher.management.commands.watch_motion import CapAndRecord, ReplayCamInterface, DatabaseWriter
+from birdwatcher.models import Video, VideoTag, Tag
+from birdwatcher.utils import setup_logging
+from birdwatcher.views import videos_page, filter_videos, tag_counts
+from multiprocessing import Process, Event, Queue
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import numpy as np
+import random
+
+def _read(rng:random.Random):
+    #what the video list and a video page ask for
+    page, _ = videos_page(filter_videos(Video.objects.all()), None, 24)
+    tag_counts()
+    if len(page) > 0:
+        Video.objects.filter(pk=rng.choice(page).pk).first()
+
+def _write(rng:random.Random):
+    #starring and tagging from the webapp
+    pk = Video.objects.order_by('-id').values_list('pk', flat=True).first()
+    if pk is None:
+        return
+    if rng.random() < 0.5:
+        Video.objects.filter(pk=pk).update(starred=rng.random() < 0.5)
+    else:
+        with transaction.atomic():
+            tag, _ = Tag.objects.get_or_create(name=rng.choice(('Robin', 'Sparrow', 'Tit')))
+            VideoTag.objects.get_or_create(video_id=pk, tag=tag)
+
+def _client(name:str, seed:int, stop, results:Queue):
+    """Runs the queries of a webapp worker in a loop until `stop` is set, like a uvicorn worker in a process of its own"""
+    operation = _write if name == 'writer' else _read
+    rng = random.Random(seed)
+    samples, locked, errors = [], 0, 0
+    while not stop.is_set():
+        start = perf_counter()
+        try:
+            operation(rng)
+            samples.append(perf_counter() - start)
+        except OperationalError as e:
+            if 'locked' in str(e):
+                locked += 1
+            else:
+                errors += 1
+        except Exception:
+            errors += 1
+        #the request is over, like at the end of a Django request
+        for connection in connections.all(initialized_only=True):
+            connection.close_if_unusable_or_obsolete()
+    results.put((name, samples, locked, errors))
+
+class Command(BaseCommand):
+    help = ("Stress test of the database: webapp readers and writers in processes of their own query the database "
+            "while the recorder replays a synthetic scene and saves its videos and segments. Reports the latency of "
+            "the queries and the 'database is locked' errors. Videos and database are written to a temporary directory")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--readers', type=int, default=3, help="Processes reading like the webapp workers")
+        parser.add_argument('--writers', type=int, default=1, help="Processes starring and tagging videos")
+        parser.add_argument('--frames', type=int, default=1800, help="Frames of the synthetic scene")
+        parser.add_argument('--resolution', type=str, default='640x360', help="WIDTHxHEIGHT of the synthetic scene")
+        parser.add_argument('--fps', type=float, default=30, help="Replay frame rate")
+        parser.add_argument('--max-speed', action='store_true', help="Replay as fast as frames are consumed instead of in real time")
+        parser.add_argument('--recording-mode', type=str, default=None, help="VID_RECORDING_MODE")
+        parser.add_argument('--segment-seconds', type=float, default=1, help="VID_SEGMENT_SECONDS, shorter for more writes")
+        parser.add_argument('--legacy', action='store_true',
+                            help="Use the database settings before WAL: rollback journal, a connection per request and "
+                                 "transactions deferred")
+
+    def _override_settings(self, options, directory):
+        if not options['recording_mode'] is None:
+            settings.VID_RECORDING_MODE = options['recording_mode']
+        settings.VID_SEGMENT_SECONDS = options['segment_seconds']
+        settings.MEDIA_ROOT = directory
+        settings.STATICFILES_DIRS = [directory]
+        #a database of its own, its config starts from the defaults
+        connections.close_all()
+        database = settings.DATABASES['default']
+        database['NAME'] = f"{directory}/db.sqlite3"
+        if options['legacy']:
+            database['CONN_MAX_AGE'] = 0
+            database['OPTIONS'] = {}
+        call_command('migrate', verbosity=0)
+        journal_mode = connections['default'].cursor().execute("PRAGMA journal_mode").fetchone()[0]
+        #the clients are forked without a connection
+        connections.close_all()
+        return journal_mode
+
+    def _instrument(self):
+        """Times the transactions of the recorder's database writer"""
+        self._batches, self._writes, self._failed = [], 0, 0
+        write = DatabaseWriter._write
+        def timed(jobs):
+            start = perf_counter()
+            write(jobs)
+            self._batches.append(perf_counter() - start)
+            self._writes += len(jobs)
+            self._failed += sum(1 for future, *_ in jobs if not future.exception() is None)
+        DatabaseWriter._write = staticmethod(timed)
+
+    def _line(self, name:str, count:int, samples:list[float], locked:int, errors:int):
+        p50, p99, top = 1000*np.percentile(samples, (50, 99, 100)) if len(samples) > 0 else (0, 0, 0)
+        self.stdout.write(f"{name:<12}{count:>8}{p50:>10.2f}{p99:>10.2f}{top:>10.1f}{locked:>8}{errors:>8}")
+
+    def handle(self, *args, **options):
+        setup_logging()
+        with TemporaryDirectory(prefix="birdwatcher_benchmark_") as directory:
+            journal_mode = self._override_settings(options, directory)
+            stop, results = Event(), Queue()
+            clients = [Process(target=_client, args=('reader', i, stop, results), daemon=True)
+                       for i in range(max(0, options['readers']))]
+            clients += [Process(target=_client, args=('writer', 1000+i, stop, results), daemon=True)
+                        for i in range(max(0, options['writers']))]
+            for client in clients:
+                client.start()
+            width, height = options['resolution'].split('x', 1)
+            cam = ReplayCamInterface(None, (int(height), int(width)), options['fps'], options['frames'],
+                                     realtime=not options['max_speed'])
+            self._instrument()
+            recorder = CapAndRecord(movement_check=1.0/config.MOTION_CHECKS_PER_SECOND,
+                                    before_movement=config.RECORD_SECONDS_BEFORE_MOVEMENT,
+                                    after_movement=config.RECORD_SECONDS_AFTER_MOVEMENT,
+                                    motion_threshold=config.MOTION_DETECTION_THRESHOLD,
+                                    cam=cam)
+            start = perf_counter()
+            recorder.start()
+            recorder._capThread.join()
+            seconds = perf_counter() - start
+            stop.set()
+            stats = {}
+            for _ in clients:
+                name, samples, locked, errors = results.get()
+                total = stats.setdefault(name, [[], 0, 0])
+                total[0] += samples
+                total[1] += locked
+                total[2] += errors
+            for client in clients:
+                client.join()
+            videos = watch_motion.Video.objects.count()
+            segments = watch_motion.Segment.objects.count()
+
+        self.stdout.write(f"{'Previous settings' if options['legacy'] else 'Current settings'}, journal mode "
+                          f"{journal_mode}: {cam.frames_read} frames replayed in {seconds:.1f}s, "
+                          f"{videos} videos and {segments} segments recorded")
+        self.stdout.write(f"{'client':<12}{'queries':>8}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}{'locked':>8}{'errors':>8}")
+        for name, (samples, locked, errors) in stats.items():
+            self._line(name, len(samples), samples, locked, errors)
+        self._line('recorder', self._writes, self._batches, 0, self._failed)
+        self.stdout.write(f"The recorder saved {self._writes} writes in {len(self._batches)} transactions")
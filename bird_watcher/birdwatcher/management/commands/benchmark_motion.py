@@ -0,0 +1,90 @@
+from constance import config
+from django.core.management import BaseCommand, CommandError
+from birdwatcher.management.commands.watch_motion import MotionDetector, MotionZone, SyntheticScene, MOTION_ENGINES
+from birdwatcher.utils import CaptureFormat
+from time import perf_counter
+import numpy as np
+import av
+
+class Command(BaseCommand):
+    help = "Measures the time per check and the accuracy of each motion engine on synthetic or recorded footage"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--video', type=str, default=None, help="Video file to use instead of synthetic footage")
+        parser.add_argument('--motion-frames', type=str, default=None,
+                            help="Frame ranges with movement in the video, e.g. '120-300,500-620'. Synthetic footage has its own")
+        parser.add_argument('--frames', type=int, default=900, help="Number of frames to use")
+        parser.add_argument('--check-every', type=int, default=15, help="Frames between two checks")
+        parser.add_argument('--resolution', type=str, default=None, help="WIDTHxHEIGHT of synthetic footage, defaults to VID_RESOLUTION")
+        parser.add_argument('--config-zones', action='store_true', help="Use the configured zones instead of the whole frame")
+
+    @staticmethod
+    def _parse_ranges(ranges:str) -> list[tuple[int,int]]:
+        #the ranges given include their last frame, the visits of SyntheticScene don't
+        result = []
+        for r in ranges.split(','):
+            start, _, end = r.strip().partition('-')
+            result.append((int(start), int(end or start) + 1))
+        return result
+
+    @staticmethod
+    def _read_video(file_path, n):
+        frames = []
+        with av.open(file_path) as container:
+            for frame in container.decode(video=0):
+                frames.append(frame.to_ndarray(format='bgr24'))
+                if len(frames) >= n:
+                    break
+        return frames
+
+    def handle(self, *args, **options):
+        n = max(2, options['frames'])
+        if options['video']:
+            frames = self._read_video(options['video'], n)
+            if len(frames) == 0:
+                raise CommandError(f"No frame read from {options['video']}")
+            visits = self._parse_ranges(options['motion_frames']) if options['motion_frames'] else None
+        else:
+            width, height = str(options['resolution'] or config.VID_RESOLUTION).split('x', 1)
+            scene = SyntheticScene(int(width), int(height), n)
+            frames, visits = [scene.frame(i) for i in range(n)], scene.visits
+        truth = None
+        if not visits is None:
+            truth = np.zeros(len(frames), dtype=bool)
+            for start, end in visits:
+                truth[start:end] = True
+
+        if options['config_zones']:
+            zones = MotionZone.from_config()
+        else:
+            zones = [MotionZone([(0,0), (100,0), (100,100), (0,100)], config.MOTION_DETECTION_THRESHOLD,
+                                config.MOTION_SENSITIVITY_THRESHOLD)]
+        capture_format = CaptureFormat('bgr')
+        height, width = frames[0].shape[:2]
+
+        self.stdout.write(f"{len(frames)} frames at {width}x{height}, checking every {options['check_every']} frames")
+        self.stdout.write(f"{'engine':<10}{'ms/check':>10}{'detections':>12}" +
+                          ("" if truth is None else f"{'precision':>11}{'recall':>8}{'accuracy':>10}"))
+        for name in MOTION_ENGINES:
+            detector = MotionDetector(zones, (height, width), mov_check_every=options['check_every'],
+                                      capture_format=capture_format, engine=name)
+            seconds = 0.0
+            checked, detected = [], []
+            for i, frame in enumerate(frames):
+                checks = detector.checks
+                start = perf_counter()
+                movement = detector.has_movement(frame)
+                if detector.checks > checks:
+                    seconds += perf_counter() - start
+                    checked.append(i)
+                    detected.append(movement)
+            checked, detected = np.array(checked), np.array(detected, dtype=bool)
+            line = f"{name:<10}{1000*seconds/max(1, len(checked)):>10.3f}{int(detected.sum()):>12}"
+            if not truth is None:
+                expected = truth[checked]
+                true_positives = int((detected & expected).sum())
+                precision = true_positives/max(1, int(detected.sum()))
+                recall = true_positives/max(1, int(expected.sum()))
+                accuracy = float((detected == expected).mean())
+                line += f"{precision:>11.2f}{recall:>8.2f}{accuracy:>10.2f}"
+            self.stdout.write(line)
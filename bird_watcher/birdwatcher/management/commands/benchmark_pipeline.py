@@ -0,0 +1,142 @@
+from constance import config
+from django.conf import settings
+from django.core.management import BaseCommand, call_command
+from django.db import connections
+from birdwatcher.management.commands import watch_motion
+from birdwatcher.management.commands.watch_motion import CapAndRecord, ReplayCamInterface
+from birdwatcher.utils import setup_logging
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import numpy as np
+import resource, logging
+
+logger = logging.getLogger(settings.PROJECT_NAME)
+
+class Command(BaseCommand):
+    help = ("Replays a video or a synthetic scene through the recorder (motion detection and recording) and reports "
+            "the frame rate, the latency of each stage, the peak memory and the dropped frames. "
+            "Videos and database are written to a temporary directory")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--video', type=str, default=None, help="Video file to replay instead of a synthetic scene")
+        parser.add_argument('--preload', action='store_true', help="Decode the video before the replay so decoding isn't measured")
+        parser.add_argument('--frames', type=int, default=900, help="Frames of the synthetic scene, or maximum frames read from the video")
+        parser.add_argument('--resolution', type=str, default=None, help="WIDTHxHEIGHT of the synthetic scene, defaults to VID_RESOLUTION")
+        parser.add_argument('--fps', type=float, default=None, help="Replay frame rate, defaults to 30 or the video's")
+        parser.add_argument('--max-speed', action='store_true', help="Replay as fast as frames are consumed instead of in real time")
+        #motion settings
+        parser.add_argument('--engine', type=str, default=None, help="MOTION_ENGINE")
+        parser.add_argument('--checks-per-second', type=float, default=None, help="MOTION_CHECKS_PER_SECOND")
+        parser.add_argument('--min-checks-per-second', type=float, default=None, help="MOTION_MIN_CHECKS_PER_SECOND")
+        parser.add_argument('--max-checks-per-second', type=float, default=None, help="MOTION_MAX_CHECKS_PER_SECOND")
+        parser.add_argument('--threshold', type=float, default=None, help="MOTION_DETECTION_THRESHOLD")
+        parser.add_argument('--sensitivity', type=int, default=None, help="MOTION_SENSITIVITY_THRESHOLD")
+        #recording and encoder settings
+        parser.add_argument('--recording-mode', type=str, default=None, help="VID_RECORDING_MODE")
+        parser.add_argument('--preroll-mode', type=str, default=None, help="VID_PREROLL_MODE")
+        parser.add_argument('--encoder-processes', type=int, default=None, help="VID_ENCODER_PROCESSES")
+        parser.add_argument('--preset', type=str, default=None, help="VID_ENCODER_PRESET")
+        parser.add_argument('--tune', type=str, default=None, help="VID_ENCODER_TUNE")
+        parser.add_argument('--encoder-threads', type=int, default=None, help="VID_ENCODER_THREADS")
+
+    def _timed(self, stage:str, function, only_checks=False):
+        samples = self._samples.setdefault(stage, [])
+        def timed(instance, *args, **kwargs):
+            checks = instance.checks if only_checks else 0
+            start = perf_counter()
+            try:
+                return function(instance, *args, **kwargs)
+            finally:
+                if not only_checks or instance.checks > checks:
+                    samples.append(perf_counter() - start)
+        return timed
+
+    def _instrument(self):
+        """Times the stages of the pipeline by wrapping their methods, for this process only"""
+        self._samples:dict[str,list[float]] = {}
+        self._writers = []
+        self._last_frame = None
+        frame_samples = self._samples.setdefault('frame', [])
+        get_next_frame = ReplayCamInterface.get_next_frame
+        def next_frame(cam, *args, **kwargs):
+            #time from getting a frame to asking for the next one, all the recorder's work on it
+            if not self._last_frame is None:
+                frame_samples.append(perf_counter() - self._last_frame)
+            frame = get_next_frame(cam, *args, **kwargs)
+            self._last_frame = perf_counter()
+            return frame
+        ReplayCamInterface.get_next_frame = next_frame
+        watch_motion.MotionDetector.has_movement = self._timed('motion check', watch_motion.MotionDetector.has_movement, only_checks=True)
+        write_frame = self._timed('writer queue', watch_motion.VideoWriter.write_frame)
+        def track_writer(writer, *args, **kwargs):
+            if not writer in self._writers:
+                self._writers.append(writer)
+            return write_frame(writer, *args, **kwargs)
+        watch_motion.VideoWriter.write_frame = track_writer
+        watch_motion._ContinuousEncoder.write = self._timed('continuous encoder', watch_motion._ContinuousEncoder.write)
+        watch_motion.EncoderJob.write = self._timed('encoder handoff', watch_motion.EncoderJob.write)
+        watch_motion.ClipEncoder.encode = self._timed('encode', watch_motion.ClipEncoder.encode)
+
+    @staticmethod
+    def _override_settings(options, directory):
+        for option, name in (('recording_mode', 'VID_RECORDING_MODE'), ('preroll_mode', 'VID_PREROLL_MODE'),
+                             ('encoder_processes', 'VID_ENCODER_PROCESSES'), ('preset', 'VID_ENCODER_PRESET'),
+                             ('tune', 'VID_ENCODER_TUNE'), ('encoder_threads', 'VID_ENCODER_THREADS')):
+            if not options[option] is None:
+                setattr(settings, name, options[option])
+        settings.MEDIA_ROOT = directory
+        settings.STATICFILES_DIRS = [directory]
+        #a database of its own, its config starts from the defaults
+        connections.close_all()
+        settings.DATABASES['default']['NAME'] = f"{directory}/db.sqlite3"
+        call_command('migrate', verbosity=0)
+        for option, name in (('engine', 'MOTION_ENGINE'), ('checks_per_second', 'MOTION_CHECKS_PER_SECOND'),
+                             ('min_checks_per_second', 'MOTION_MIN_CHECKS_PER_SECOND'),
+                             ('max_checks_per_second', 'MOTION_MAX_CHECKS_PER_SECOND'),
+                             ('threshold', 'MOTION_DETECTION_THRESHOLD'), ('sensitivity', 'MOTION_SENSITIVITY_THRESHOLD')):
+            if not options[option] is None:
+                setattr(config, name, options[option])
+
+    def handle(self, *args, **options):
+        setup_logging()
+        with TemporaryDirectory(prefix="birdwatcher_benchmark_") as directory:
+            self._override_settings(options, directory)
+            width, height = str(options['resolution'] or config.VID_RESOLUTION).split('x', 1)
+            cam = ReplayCamInterface(options['video'], (int(height), int(width)), options['fps'],
+                                     options['frames'], realtime=not options['max_speed'], preload=options['preload'])
+            self._instrument()
+            recorder = CapAndRecord(movement_check=1.0/config.MOTION_CHECKS_PER_SECOND,
+                                    fast_movement_check=1.0/config.MOTION_MAX_CHECKS_PER_SECOND if config.MOTION_MAX_CHECKS_PER_SECOND > 0 else 0,
+                                    slow_movement_check=1.0/config.MOTION_MIN_CHECKS_PER_SECOND if config.MOTION_MIN_CHECKS_PER_SECOND > 0 else None,
+                                    before_movement=config.RECORD_SECONDS_BEFORE_MOVEMENT,
+                                    after_movement=config.RECORD_SECONDS_AFTER_MOVEMENT,
+                                    motion_threshold=config.MOTION_DETECTION_THRESHOLD,
+                                    cam=cam)
+            start = perf_counter()
+            recorder.start()
+            recorder._capThread.join()
+            total_seconds = perf_counter() - start
+            capture_seconds = sum(self._samples['frame'])
+            pool = recorder._encoder_pool.stats()
+            continuous = recorder._segments or recorder._preroll
+            videos = watch_motion.Video.objects.count()
+            segments = watch_motion.Segment.objects.count()
+
+        self.stdout.write(f"Replayed {cam.frames_read} frames at {cam.resolution[1]}x{cam.resolution[0]}, "
+                          + ("as fast as possible" if options['max_speed'] else f"in real time at {cam.frame_rate:.2f} fps"))
+        self.stdout.write(f"Recorder: {cam.frames_read/max(capture_seconds, 1e-9):.1f} fps of processing time, "
+                          f"{cam.frames_read/total_seconds:.1f} fps including the end of the encoding ({total_seconds:.1f}s)")
+        self.stdout.write(f"Recorded {videos} videos and {segments} segments, "
+                          f"{pool['frames']} frames encoded by the pool at {pool['encode_fps']:.1f} fps")
+        self.stdout.write(f"Dropped frames: {cam.dropped} by the camera, "
+                          f"{sum(w._frame_queue.dropped for w in self._writers)} by the writers"
+                          + ("" if continuous is None else f", {continuous.dropped} by the continuous encoder"))
+        self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+        children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss/1024
+        self.stdout.write(f"Peak RSS: {self_rss:.0f}MiB for the recorder, {children_rss:.0f}MiB for the largest encoder process")
+        self.stdout.write(f"{'stage':<20}{'count':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+        for stage, samples in self._samples.items():
+            if len(samples) == 0:
+                continue
+            p50, p90, p99, top = 1000*np.percentile(samples, (50, 90, 99, 100))
+            self.stdout.write(f"{stage:<20}{len(samples):>8}{p50:>10.2f}{p90:>10.2f}{p99:>10.2f}{top:>10.2f}")
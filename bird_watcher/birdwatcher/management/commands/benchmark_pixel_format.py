@@ -0,0 +1,93 @@
+from constance import config
+from django.core.management import BaseCommand
+from birdwatcher.utils import CaptureFormat
+from time import process_time
+import numpy as np
+import cv2, av
+
+class Command(BaseCommand):
+    help = ("Measures the CPU time spent per frame on pixel conversions for each capture format. The camera is "
+            "taken to deliver YUYV for bgr: the capture column is OpenCV's decode to BGR, or the copy of the raw "
+            "buffer for yuyv and nv12. MJPEG cameras decode at a higher cost, not measured here")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--frames', type=int, default=100, help="Number of frames to process per format")
+        parser.add_argument('--resolution', type=str, default=None, help="WIDTHxHEIGHT, defaults to VID_RESOLUTION")
+
+    @staticmethod
+    def _synthetic_frames(width, height):
+        #smooth gradients with noise, closer to a camera image than pure noise
+        x = np.linspace(0, 255, width, dtype=np.float32)
+        y = np.linspace(0, 255, height, dtype=np.float32)[:,None]
+        noise = np.random.default_rng(0).integers(0, 32, (height, width, 3), dtype=np.uint8)
+        bgr = np.dstack([(x+y)/2, np.broadcast_to(x, (height, width)), np.broadcast_to(y, (height, width))])
+        bgr = cv2.add(bgr.astype(np.uint8), noise)
+        yuyv = cv2.cvtColor(bgr, cv2.COLOR_BGR2YUV_YUY2)
+        i420 = cv2.cvtColor(bgr, cv2.COLOR_BGR2YUV_I420).reshape(-1)
+        y_size, c_size = width*height, width*height//4
+        nv12 = np.empty(y_size + 2*c_size, dtype=np.uint8)
+        nv12[:y_size] = i420[:y_size]
+        nv12[y_size::2] = i420[y_size:y_size+c_size]
+        nv12[y_size+1::2] = i420[y_size+c_size:]
+        return {'bgr':bgr, 'yuyv':yuyv, 'nv12':nv12.reshape(height*3//2, width)}
+
+    @staticmethod
+    def _time(stages, fn, name):
+        start = process_time()
+        result = fn()
+        stages[name] = stages.get(name, 0) + process_time() - start
+        return result
+
+    @staticmethod
+    def _capture(capture_format:CaptureFormat, raw, out):
+        #what camera.read(out) does: OpenCV decodes the camera's YUYV to BGR, native formats are only copied
+        if capture_format.native:
+            np.copyto(out, raw)
+        else:
+            cv2.cvtColor(raw, cv2.COLOR_YUV2BGR_YUY2, dst=out)
+        return out
+
+    def _run_legacy(self, frames, n, stages):
+        #the pipeline before capture formats: BGR->RGB on capture, RGB->GRAY for motion, rgb24 to the encoder
+        bgr_format, out = CaptureFormat('bgr'), np.empty_like(frames['bgr'])
+        for _ in range(n):
+            rgb = self._time(stages, lambda: cv2.cvtColor(self._capture(bgr_format, frames['yuyv'], out),
+                                                          cv2.COLOR_BGR2RGB), 'capture')
+            self._time(stages, lambda: cv2.resize(cv2.cvtColor(rgb, cv2.COLOR_RGB2GRAY), (0,0), fx=0.1, fy=0.1), 'motion')
+            self._time(stages, lambda: av.VideoFrame.from_ndarray(rgb, format='rgb24').reformat(format='yuv420p'), 'encoder input')
+            self._time(stages, lambda: cv2.imencode('.jpg', cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR), [cv2.IMWRITE_JPEG_QUALITY, 70]), 'livestream')
+
+    def _run_format(self, capture_format:CaptureFormat, frames, n, stages):
+        raw = frames[capture_format.name] if capture_format.native else frames['yuyv']
+        frame = np.empty_like(frames[capture_format.name])
+        for _ in range(n):
+            self._time(stages, lambda: self._capture(capture_format, raw, frame), 'capture')
+            self._time(stages, lambda: cv2.resize(capture_format.luma(frame), (0,0), fx=0.1, fy=0.1), 'motion')
+            self._time(stages, lambda: av.VideoFrame.from_ndarray(frame, format=capture_format.av_format
+                                                                  ).reformat(format=capture_format.encoder_pix_fmt), 'encoder input')
+            self._time(stages, lambda: cv2.imencode('.jpg', capture_format.to_bgr(frame), [cv2.IMWRITE_JPEG_QUALITY, 70]), 'livestream')
+
+    def handle(self, *args, **options):
+        width, height = str(options['resolution'] or config.VID_RESOLUTION).split('x', 1)
+        width, height = int(width), int(height)
+        n = max(1, options['frames'])
+        frames = self._synthetic_frames(width, height)
+
+        results = {}
+        results['bgr (legacy rgb)'] = {}
+        self._run_legacy(frames, n, results['bgr (legacy rgb)'])
+        for name in CaptureFormat.FORMATS:
+            results[name] = {}
+            self._run_format(CaptureFormat(name), frames, n, results[name])
+
+        self.stdout.write(f"CPU ms per frame at {width}x{height} over {n} frames")
+        stage_names = list(results['bgr (legacy rgb)'].keys())
+        self.stdout.write(f"{'format':<18}" + "".join(f"{s:>15}" for s in stage_names) + f"{'recorder total':>16}")
+        legacy_total = None
+        for name, stages in results.items():
+            ms = {s:1000*stages[s]/n for s in stage_names}
+            #the livestream only runs while someone watches, it is not part of the recorder's cost
+            total = ms['capture'] + ms['motion'] + ms['encoder input']
+            legacy_total = legacy_total or total
+            self.stdout.write(f"{name:<18}" + "".join(f"{ms[s]:>15.2f}" for s in stage_names)
+                              + f"{total:>16.2f}" + f"  ({legacy_total-total:.2f} saved)")
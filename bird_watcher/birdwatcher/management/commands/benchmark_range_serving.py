@@ -0,0 +1,114 @@
+from django.core.management import BaseCommand
+from birdwatcher.views import range_requests_response
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+from tempfile import NamedTemporaryFile
+from time import perf_counter, process_time
+import numpy as np
+import asyncio, os
+
+class Command(BaseCommand):
+    help = ("Measures the throughput and CPU time of serving a video file to several clients, full files and "
+            "the ranges a player asks for when scrubbing, with the current response and the previous generator")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--file', type=str, default=None, help="File to serve instead of a random one")
+        parser.add_argument('--size', type=int, default=200, help="Size of the random file in MiB")
+        parser.add_argument('--clients', type=int, default=4, help="Number of concurrent clients")
+        parser.add_argument('--requests', type=int, default=50, help="Range requests per client")
+        parser.add_argument('--range-size', type=int, default=1024, help="Size of a range in KiB")
+
+    @staticmethod
+    def _legacy_response(request:Request, file_path:str, content_type:str):
+        #the response before sendfile: a generator of 128KB reads, a single range
+        file_size = os.stat(file_path).st_size
+        headers = {"content-type": content_type, "accept-ranges": "bytes", "content-length": str(file_size)}
+        start, end = 0, file_size - 1
+        status_code = 200
+        range_header = request.headers.get("range")
+        if range_header is not None:
+            h = range_header.replace("bytes=", "").split("-")
+            start = int(h[0]) if h[0] != "" else 0
+            end = int(h[1]) if h[1] != "" else file_size - 1
+            headers["content-length"] = str(end - start + 1)
+            headers["content-range"] = f"bytes {start}-{end}/{file_size}"
+            status_code = 206
+        def send_bytes_range_requests(file_obj, start, end, chunk_size=128*1024):
+            with file_obj as f:
+                f.seek(start)
+                while (pos := f.tell()) <= end:
+                    yield f.read(min(chunk_size, end + 1 - pos))
+        return StreamingResponse(send_bytes_range_requests(open(file_path, mode="rb"), start, end),
+                                 headers=headers, status_code=status_code)
+
+    @staticmethod
+    async def _request(respond, file_path:str, range_header:str|None) -> int:
+        """Runs a response like the server would and returns the number of bytes of its body"""
+        headers = [] if range_header is None else [(b'range', range_header.encode())]
+        scope = {'type':'http', 'method':'GET', 'path':'/stream/0', 'query_string':b'', 'headers':headers,
+                 'asgi':{'version':'3.0', 'spec_version':'2.3'}}
+        received = 0
+        disconnected = asyncio.Event()
+        async def receive():
+            await disconnected.wait()
+            return {'type':'http.disconnect'}
+        async def send(message):
+            nonlocal received
+            if message['type'] == 'http.response.body':
+                received += len(message.get('body', b''))
+        await respond(Request(scope), file_path, 'video/mp4')(scope, receive, send)
+        return received
+
+    async def _run(self, respond, file_path:str, requests:list[list[str|None]]):
+        async def client(ranges):
+            total = 0
+            for range_header in ranges:
+                total += await self._request(respond, file_path, range_header)
+            return total
+        start, cpu = perf_counter(), process_time()
+        received = await asyncio.gather(*(client(ranges) for ranges in requests))
+        return sum(received), perf_counter() - start, process_time() - cpu
+
+    def handle(self, *args, **options):
+        temporary = None
+        file_path = options['file']
+        if file_path is None:
+            temporary = NamedTemporaryFile(prefix="birdwatcher_benchmark_", suffix=".mp4")
+            chunk = np.random.default_rng(0).integers(0, 256, 1024*1024, dtype=np.uint8).tobytes()
+            for _ in range(options['size']):
+                temporary.write(chunk)
+            temporary.flush()
+            file_path = temporary.name
+        try:
+            file_size = os.stat(file_path).st_size
+            clients, n = max(1, options['clients']), max(1, options['requests'])
+            range_size = min(file_size, options['range_size']*1024)
+            rng = np.random.default_rng(1)
+            def scrub():
+                starts = rng.integers(0, file_size - range_size + 1, n)
+                return [f"bytes={s}-{s+range_size-1}" for s in starts]
+            def multiple():
+                #a few ranges per request, like a player fetching the index and the data it seeks to
+                ranges = []
+                for _ in range(n):
+                    starts = np.sort(rng.choice(file_size//range_size, 3, replace=False)) * range_size
+                    ranges.append("bytes=" + ",".join(f"{s}-{s+range_size//4-1}" for s in starts))
+                return ranges
+            scenarios = {'full file':[[None] for _ in range(clients)],
+                         'scrubbing':[scrub() for _ in range(clients)],
+                         'multi-range':[multiple() for _ in range(clients)]}
+
+            self.stdout.write(f"{file_size/2**20:.0f}MiB file, {clients} clients, {n} requests of {range_size//1024}KiB "
+                              "ranges per client when scrubbing")
+            self.stdout.write(f"{'scenario':<14}{'response':<12}{'MiB/s':>10}{'CPU s':>10}{'CPU s/GiB':>12}")
+            for scenario, requests in scenarios.items():
+                for name, respond in (('generator', self._legacy_response), ('current', range_requests_response)):
+                    if name == 'generator' and scenario == 'multi-range':
+                        self.stdout.write(f"{scenario:<14}{name:<12}{'unsupported':>10}")
+                        continue
+                    received, seconds, cpu = asyncio.run(self._run(respond, file_path, requests))
+                    self.stdout.write(f"{scenario:<14}{name:<12}{received/2**20/seconds:>10.0f}{cpu:>10.2f}"
+                                      f"{cpu/max(received/2**30, 1e-9):>12.2f}")
+        finally:
+            if not temporary is None:
+                temporary.close()
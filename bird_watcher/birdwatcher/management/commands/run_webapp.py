@@ -1,7 +1,8 @@
 from django.conf import settings
 from constance import config
 from django.core.management import BaseCommand
-from birdwatcher.utils import setup_logging, start_or_restart_birdwatcher
+from birdwatcher.utils import setup_logging, start_or_restart_birdwatcher, run_livestream_producer
+from multiprocessing import Process
 import uvicorn
 
 class Command(BaseCommand):
@@ -12,8 +13,18 @@ class Command(BaseCommand):
         setup_logging()
         if config.START_MOTION_DETECTOR_ON_SERVER_START:
             start_or_restart_birdwatcher()
-        uvicorn.run('bird_watcher_proj.asgi:app',
-                    host=settings.WEBAPP_HOST,
-                    port=settings.WEBAPP_PORT,
-                    workers=3,
-                    log_level=settings.LOGGING_LEVEL.lower())
\ No newline at end of file
+        producer = None
+        if settings.DEVICE_DUPLICATION.lower() in ('socket', 'shm', 'v4l2loopback'):
+            #a single process reads and encodes the livestream, the workers relay its frames
+            producer = Process(target=run_livestream_producer, name="livestream-producer", daemon=True)
+            producer.start()
+        try:
+            uvicorn.run('bird_watcher_proj.asgi:app',
+                        host=settings.WEBAPP_HOST,
+                        port=settings.WEBAPP_PORT,
+                        workers=3,
+                        log_level=settings.LOGGING_LEVEL.lower())
+        finally:
+            if not producer is None:
+                producer.terminate()
+                producer.join(5)
\ No newline at end of file
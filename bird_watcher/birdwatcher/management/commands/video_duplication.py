@@ -1,7 +1,7 @@
 from constance import config
 from django.conf import settings
 from django.core.management import BaseCommand
-from birdwatcher.utils import setup_logging, FramePublisher
+from birdwatcher.utils import setup_logging, FramePublisher, SharedFramePublisher
 from subprocess import Popen, DEVNULL
 from signal import SIGINT, SIGKILL, SIGTERM, signal
 import asyncio
@@ -15,8 +15,8 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         setup_logging()
         method = settings.DEVICE_DUPLICATION
-        if method.lower() == 'socket':
-            pub = FramePublisher()
+        if method.lower() in ('socket', 'shm'):
+            pub = FramePublisher() if method.lower() == 'socket' else SharedFramePublisher()
             try:
                 signal(SIGTERM, lambda *args, **kwargs : (pub.release()))
                 signal(SIGINT, lambda *args, **kwargs : (pub.release()))
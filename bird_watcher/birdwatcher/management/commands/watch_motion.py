@@ -1,22 +1,57 @@
-import cv2, io
+import cv2
 import numpy as np
-from threading import Thread
-from multiprocessing import Queue
+from threading import Thread, Condition as ThreadCondition, Event as ThreadEvent, Lock as ThreadLock, current_thread
+from multiprocessing import Process, Pipe, Semaphore
+from multiprocessing.connection import Connection
 from pathlib import Path
 import av, logging, math, zoneinfo
-from datetime import datetime
+from datetime import datetime, timedelta
 from collections import deque
+from concurrent.futures import Future
+from fractions import Fraction
+from queue import Empty, Full, Queue as ThreadQueue
 from django.conf import settings
 from constance import config
 from django.core.management import BaseCommand
-from birdwatcher.models import Video
-from birdwatcher.utils import setup_logging, FrameConsumer, get_datetime_local
+from birdwatcher.models import Video, Segment, VideoTag
+from django.db import transaction, connections, close_old_connections
+from django.db.models import Q, Exists, OuterRef, Sum
+from birdwatcher.utils import setup_logging, FrameConsumer, SharedFrameConsumer, SharedFrameRing, CaptureFormat, get_datetime_local, open_video_capture, available_memory, metrics, serve_metrics, decode_keyframes, remove_files
+import os
 from os import path, chmod
-from time import perf_counter
-import signal
+from time import perf_counter, monotonic, time, sleep
+import signal, shutil, atexit
+from abc import ABC, abstractmethod
+from json import loads, dumps
 
 logger = logging.getLogger(settings.PROJECT_NAME)
 
+#metrics of the pipeline, served by serve_metrics()
+FRAMES_CAPTURED = metrics.counter('birdwatcher_frames_captured_total', "Frames read from the camera")
+CAPTURE_SECONDS = metrics.histogram('birdwatcher_capture_seconds', "Time waiting for the camera to return a frame")
+FRAME_SECONDS = metrics.histogram('birdwatcher_frame_processing_seconds',
+                                  "Time the capture thread spends on a frame once it is read")
+MOTION_CHECKS = metrics.counter('birdwatcher_motion_checks_total', "Motion checks done")
+MOTION_DETECTED = metrics.counter('birdwatcher_motion_detected_total', "Motion checks that found movement")
+MOTION_CHECK_SECONDS = metrics.histogram('birdwatcher_motion_check_seconds', "Time spent on a motion check")
+RECORDING = metrics.gauge('birdwatcher_recording', "1 while a movement is recorded")
+WRITER_QUEUE_FRAMES = metrics.gauge('birdwatcher_writer_queue_frames', "Frames waiting for the encoder in the video writers")
+WRITER_QUEUE_BYTES = metrics.gauge('birdwatcher_writer_queue_bytes', "Memory used by the frames waiting for the encoder")
+FRAMES_ENCODED = metrics.counter('birdwatcher_frames_encoded_total', "Frames handed to an encoder")
+ENCODE_SECONDS = metrics.counter('birdwatcher_encode_seconds_total', "Time the encoder pool spent encoding clips")
+CLIPS = metrics.counter('birdwatcher_clips_total', "Videos recorded")
+BYTES_WRITTEN = metrics.counter('birdwatcher_bytes_written_total', "Size of the video files and segments written")
+THUMBNAIL_SECONDS = metrics.histogram('birdwatcher_thumbnail_seconds', "Time spent writing the thumbnails of a video")
+PREVIEW_SECONDS = metrics.histogram('birdwatcher_preview_seconds', "Time spent writing the hover preview of a video")
+STORAGE_BYTES = metrics.gauge('birdwatcher_storage_bytes', "Size of the video files and segments counted by the retention")
+VIDEOS_EVICTED = metrics.counter('birdwatcher_videos_evicted_total', "Videos deleted by the retention")
+DB_WRITES = metrics.counter('birdwatcher_db_writes_total', "Writes saved by the database writer")
+DB_WRITE_SECONDS = metrics.histogram('birdwatcher_db_write_seconds',
+                                     "Time to save a transaction of the database writer, waiting for the lock included")
+DROPPED_CAMERA, DROPPED_WRITER, DROPPED_ENCODER = (
+    metrics.counter('birdwatcher_frames_dropped_total', "Frames dropped before being encoded", stage=stage)
+    for stage in ('camera', 'writer', 'encoder'))
+
 class StaticThreadInterrupt:
     _INTERRUPT = False
     _subscribers:list[Thread] = []
@@ -61,159 +96,1577 @@ class Interruptable:
         if global_interrupt:
             StaticThreadInterrupt.interrupt_all()
 
+def encoder_options() -> dict[str,str]:
+    #libx264 private options from the settings
+    options = {"crf":"18", "preset":settings.VID_ENCODER_PRESET}
+    if len(settings.VID_ENCODER_TUNE) > 0:
+        options["tune"] = settings.VID_ENCODER_TUNE
+    return options
+
+class ClipEncoder:
+    def __init__(self, file_path:str, codec:str, fps:float, resolution:tuple[int,int], av_format:str,
+                 pix_fmt:str, options:dict[str,str], threads:int=0) -> None:
+        """Encodes frames to a video file. Used in an encoder process or directly in the writer thread"""
+        self._container = av.open(file_path, mode="w", options={'movflags':'+faststart'})
+        self._stream = self._container.add_stream(codec, rate=fps, options=options)
+        self._stream.height,self._stream.width = resolution
+        self._stream.pix_fmt = pix_fmt
+        self._stream.codec_context.thread_count = threads
+        self._av_format = av_format
+        #pts count capture frames, frames dropped before the encoder leave a gap instead of speeding up the clip
+        self._time_base = 1/Fraction(fps).limit_denominator(1001)
+        self.frames = 0
+        self.encode_seconds = 0.0
+    
+    def encode(self, frame:np.ndarray, pts:int|None=None):
+        start = perf_counter()
+        video_frame = av.VideoFrame.from_ndarray(frame, format=self._av_format)
+        if not pts is None:
+            video_frame.pts = pts
+            video_frame.time_base = self._time_base
+        for packet in self._stream.encode(video_frame):
+            self._container.mux(packet)
+        self.frames += 1
+        self.encode_seconds += perf_counter() - start
+    
+    def close(self):
+        start = perf_counter()
+        #flush stream
+        for packet in self._stream.encode():
+            self._container.mux(packet)
+        self._container.close()
+        self.encode_seconds += perf_counter() - start
+
+def _encoder_process(conn:Connection, free_slots):
+    """Runs in an encoder process. Receives ('start', job), ('frame', seq, pts)... ('end',) for each clip,
+    reads the frames from the worker's SharedFrameRing and frees their slot once encoded"""
+    #shutdown is driven by the recorder process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    ring:SharedFrameRing|None = None
+    encoder:ClipEncoder|None = None
+    error = None
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            break
+        try:
+            if message[0] == 'start':
+                job = message[1]
+                if ring is None or ring.describe() != job['ring']:
+                    if not ring is None:
+                        ring.close()
+                    ring = SharedFrameRing(job['ring']['name'], job['ring']['shape'],
+                                           job['ring']['dtype'], job['ring']['slots'])
+                error = None
+                encoder = ClipEncoder(**job['encoder'])
+            elif message[0] == 'frame':
+                try:
+                    frame = ring.get(message[1])
+                    if not encoder is None and not frame is None:
+                        encoder.encode(frame, message[2])
+                finally:
+                    free_slots.release()
+            elif message[0] == 'end':
+                if encoder is None:
+                    conn.send(('error', error or 'Encoder was not started'))
+                else:
+                    encoder.close()
+                    conn.send(('finished', encoder.frames, encoder.encode_seconds))
+                encoder = None
+            elif message[0] == 'stop':
+                break
+        except Exception as e:
+            logger.exception("Error in encoder process")
+            error = str(e)
+            encoder = None
+    if not ring is None:
+        ring.close()
+
+class _EncoderWorker:
+    def __init__(self, index:int|str, buffer_frames:int, target=_encoder_process) -> None:
+        self.index = index
+        self.buffer_frames = buffer_frames
+        self.free_slots = Semaphore(buffer_frames)
+        self.conn, child_conn = Pipe()
+        self.process = Process(target=target, args=(child_conn, self.free_slots),
+                               name=f"encoder-{index}", daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.ring:SharedFrameRing|None = None
+        self.seq = 0
+        self.busy = False
+    
+    def ring_for(self, frame:np.ndarray) -> SharedFrameRing:
+        #slots are all free between clips, the ring can be replaced if the frames changed
+        if self.ring is None or self.ring.shape != frame.shape or self.ring.dtype != frame.dtype:
+            if not self.ring is None:
+                self.ring.close()
+            self.ring = SharedFrameRing(f"{settings.PROJECT_NAME}_encoder_{os.getpid()}_{self.index}",
+                                        frame.shape, frame.dtype.str, self.buffer_frames, create=True)
+        return self.ring
+    
+    def close(self):
+        try:
+            self.conn.send(('stop',))
+        except OSError:
+            pass
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+        if not self.ring is None:
+            self.ring.close()
+            self.ring = None
+
+class EncoderJob:
+    def __init__(self, pool:'EncoderPool', worker:'_EncoderWorker|None', encoder_args:dict) -> None:
+        """A clip being encoded, by an encoder process or in the calling thread if `worker` is None.
+        `write()` only blocks when the encoder is more than VID_ENCODER_BUFFER_FRAMES frames behind"""
+        self._pool = pool
+        self._worker = worker
+        self._encoder_args = encoder_args
+        self._inline:ClipEncoder|None = None
+        self._started = False
+    
+    def write(self, frame:np.ndarray, pts:int|None=None):
+        """`pts` is the index of the frame in the clip at the capture frame rate"""
+        FRAMES_ENCODED.inc()
+        if self._worker is None:
+            if self._inline is None:
+                self._inline = ClipEncoder(**self._encoder_args)
+            self._inline.encode(frame, pts)
+            return
+        worker = self._worker
+        ring = worker.ring_for(frame)
+        if not self._started:
+            worker.conn.send(('start', {'ring':ring.describe(), 'encoder':self._encoder_args}))
+            self._started = True
+        while not worker.free_slots.acquire(timeout=1):
+            if not worker.process.is_alive():
+                raise RuntimeError(f"Encoder process {worker.index} died")
+        slot = ring.begin_write(worker.seq)
+        np.copyto(slot, frame)
+        ring.commit(worker.seq)
+        worker.conn.send(('frame', worker.seq, pts))
+        worker.seq += 1
+    
+    def finish(self) -> tuple[int,float]:
+        """Waits for the end of the encoding, returns the number of frames encoded and the time spent encoding"""
+        try:
+            if self._worker is None:
+                if self._inline is None:
+                    return 0, 0.0
+                self._inline.close()
+                result = self._inline.frames, self._inline.encode_seconds
+            elif not self._started:
+                return 0, 0.0
+            else:
+                self._worker.conn.send(('end',))
+                message = self._worker.conn.recv()
+                if message[0] == 'error':
+                    raise RuntimeError(f"Encoder process {self._worker.index} failed: {message[1]}")
+                result = message[1], message[2]
+        finally:
+            self._pool._release(self._worker)
+        self._pool._record(*result)
+        return result
+
+class EncoderPool:
+    def __init__(self, processes:int=0, buffer_frames:int=30) -> None:
+        """Pool of encoder processes so encoding does not compete with capture and motion detection
+        for the GIL. Frames are handed over through a shared memory ring per process, each process
+        encodes one clip at a time. With 0 processes clips are encoded in the writer thread."""
+        self._workers = [_EncoderWorker(i, max(2, buffer_frames)) for i in range(max(0, processes))]
+        self._worker_freed = ThreadCondition()
+        self._clips = 0
+        self._frames = 0
+        self._encode_seconds = 0.0
+        logger.debug(f"Started encoder pool with {len(self._workers)} processes")
+    
+    def start_clip(self, file_path:str, fps:float, resolution:tuple[int,int], capture_format:CaptureFormat,
+                   codec:str="libx264") -> EncoderJob:
+        """Blocks until an encoder process is free"""
+        options = encoder_options()
+        #a keyframe at least every VID_KEYFRAME_SECONDS, for seeking and the hover previews
+        options['x264-params'] = f"keyint={max(1, round(fps*settings.VID_KEYFRAME_SECONDS))}"
+        encoder_args = {'file_path':file_path, 'codec':codec, 'fps':fps, 'resolution':tuple(resolution),
+                        'av_format':capture_format.av_format, 'pix_fmt':capture_format.encoder_pix_fmt,
+                        'options':options, 'threads':settings.VID_ENCODER_THREADS}
+        if len(self._workers) == 0:
+            return EncoderJob(self, None, encoder_args)
+        with self._worker_freed:
+            while True:
+                worker = next((w for w in self._workers if not w.busy), None)
+                if not worker is None:
+                    break
+                logger.debug("All encoder processes busy, waiting for one")
+                self._worker_freed.wait()
+            worker.busy = True
+        return EncoderJob(self, worker, encoder_args)
+    
+    def _release(self, worker:_EncoderWorker|None):
+        if worker is None:
+            return
+        with self._worker_freed:
+            worker.busy = False
+            self._worker_freed.notify()
+    
+    def _record(self, frames:int, encode_seconds:float):
+        ENCODE_SECONDS.inc(encode_seconds)
+        with self._worker_freed:
+            self._clips += 1
+            self._frames += frames
+            self._encode_seconds += encode_seconds
+    
+    def stats(self) -> dict:
+        with self._worker_freed:
+            return {'processes':len(self._workers), 'busy':sum(w.busy for w in self._workers),
+                    'clips':self._clips, 'frames':self._frames,
+                    'encode_fps':self._frames/self._encode_seconds if self._encode_seconds > 0 else 0.0}
+    
+    def close(self):
+        for worker in self._workers:
+            worker.close()
+        self._workers.clear()
+
+class _OpenClip:
+    def __init__(self, container:av.container.OutputContainer, stream, offset:int) -> None:
+        self.container = container
+        self.stream = stream
+        #pts of the first frame of the clip, timestamps in the clip start at 0
+        self.offset = offset
+        self.end_pts:int|None = None
+        self.frames = 0
+        self.encode_seconds = 0.0
+
+def _open_packet_encoder(args:dict) -> av.CodecContext:
+    #an encoder without container, its packets are muxed in clips or segments
+    encoder = av.CodecContext.create(args['codec'], 'w')
+    encoder.height, encoder.width = args['resolution']
+    encoder.pix_fmt = args['pix_fmt']
+    encoder.time_base = 1/Fraction(args['fps']).limit_denominator(1001)
+    encoder.framerate = 1/encoder.time_base
+    encoder.thread_count = args['threads']
+    encoder.options = args['options']
+    return encoder
+
+def _preroll_process(conn:Connection, free_slots):
+    """Runs in the pre-roll encoder process. Encodes every captured frame ('frame', seq, pts, time) and keeps
+    the packets of the last seconds in GOPs starting with a keyframe. ('clip', id, path) opens a clip
+    starting with the buffered GOPs, copied without re-encoding, then the live packets. ('end', id)
+    closes it once the frames up to now are muxed"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    ring:SharedFrameRing|None = None
+    encoder:av.CodecContext|None = None
+    av_format = None
+    preroll_frames = 0
+    #each GOP is a list of (data, pts, dts, keyframe) starting with a keyframe
+    gops:deque[list[tuple[bytes,int,int,bool]]] = deque()
+    clip:_OpenClip|None = None
+    clip_id = None
+    last_pts = -1
+    
+    def mux(data:bytes, pts:int, dts:int, keyframe:bool):
+        packet = av.Packet(data)
+        packet.pts, packet.dts = pts - clip.offset, dts - clip.offset
+        packet.time_base = encoder.time_base
+        packet.is_keyframe = keyframe
+        packet.stream = clip.stream
+        clip.container.mux(packet)
+        clip.frames += 1
+    
+    def close_clip():
+        nonlocal clip, clip_id
+        clip.container.close()
+        conn.send(('finished', clip_id, clip.frames, clip.encode_seconds))
+        clip, clip_id = None, None
+    
+    def on_packet(packet:av.Packet):
+        data = (bytes(packet), packet.pts, packet.dts, packet.is_keyframe)
+        if packet.is_keyframe or len(gops) == 0:
+            gops.append([])
+        gops[-1].append(data)
+        #keep the newest GOP starting at least preroll_frames before the last frame
+        while len(gops) > 1 and gops[1][0][1] <= last_pts - preroll_frames:
+            gops.popleft()
+        if not clip is None:
+            #every frame up to the end has a dts <= its pts, packets after that are not needed
+            if not clip.end_pts is None and packet.dts > clip.end_pts:
+                close_clip()
+            else:
+                mux(*data)
+    
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            break
+        try:
+            if message[0] == 'start':
+                job = message[1]
+                ring = SharedFrameRing(job['ring']['name'], job['ring']['shape'], job['ring']['dtype'], job['ring']['slots'])
+                encoder = _open_packet_encoder(job['encoder'])
+                av_format = job['encoder']['av_format']
+                preroll_frames = job['preroll_frames']
+            elif message[0] == 'frame':
+                try:
+                    frame = ring.get(message[1])
+                    if not frame is None:
+                        start = perf_counter()
+                        video_frame = av.VideoFrame.from_ndarray(frame, format=av_format)
+                        last_pts = video_frame.pts = message[2]
+                        video_frame.time_base = encoder.time_base
+                        packets = encoder.encode(video_frame)
+                        if not clip is None:
+                            clip.encode_seconds += perf_counter() - start
+                        for packet in packets:
+                            on_packet(packet)
+                finally:
+                    free_slots.release()
+            elif message[0] == 'clip':
+                if not clip is None:
+                    close_clip()
+                clip_id = message[1]
+                container = av.open(message[2], mode="w", options={'movflags':'+faststart'})
+                #no global header, the mp4 muxer takes the parameter sets from the first keyframe
+                stream = container.add_mux_stream(encoder.name, rate=encoder.framerate,
+                                                  width=encoder.width, height=encoder.height)
+                stream.time_base = encoder.time_base
+                clip = _OpenClip(container, stream, gops[0][0][1] if len(gops) > 0 else max(0, last_pts))
+                for gop in gops:
+                    for data in gop:
+                        mux(*data)
+            elif message[0] == 'end':
+                if not clip is None and clip_id == message[1]:
+                    clip.end_pts = last_pts
+                else:
+                    conn.send(('error', message[1], 'Clip was not started'))
+            elif message[0] == 'stop':
+                break
+        except Exception as e:
+            logger.exception("Error in pre-roll encoder process")
+            if not clip_id is None:
+                conn.send(('error', clip_id, str(e)))
+            clip, clip_id = None, None
+    try:
+        #flush the encoder's delayed frames into the open clip
+        if not encoder is None:
+            for packet in encoder.encode(None):
+                on_packet(packet)
+        if not clip is None:
+            close_clip()
+    except Exception as e:
+        logger.exception("Error flushing the pre-roll encoder")
+        if not clip_id is None:
+            conn.send(('error', clip_id, str(e)))
+    if not ring is None:
+        ring.close()
+
+class PrerollClip:
+    def __init__(self, preroll:'PrerollEncoder', clip_id:int) -> None:
+        """A clip cut from the pre-roll encoder's packets. The frames were already encoded, `write()` does nothing"""
+        self._preroll = preroll
+        self._clip_id = clip_id
+        self._ended = False
+    
+    def write(self, frame:np.ndarray, pts:int|None=None):
+        pass
+    
+    def end(self):
+        """Ends the clip at the last frame captured. Called from the capture thread"""
+        if not self._ended:
+            self._ended = True
+            self._preroll._send(('end', self._clip_id))
+    
+    def finish(self) -> tuple[int,float]:
+        """Waits for the clip to be written, returns the number of frames and the time spent encoding them"""
+        self.end()
+        message = self._preroll._wait_reply(self._clip_id)
+        if message[0] == 'error':
+            raise RuntimeError(f"Pre-roll encoder failed: {message[2]}")
+        return message[2], message[3]
+
+class _ContinuousEncoder:
+    NAME = ''
+    
+    def __init__(self, buffer_frames:int, target) -> None:
+        """Encodes every captured frame in a separate process (`target`).
+        Frames are dropped rather than blocking the capture if the encoder falls behind"""
+        self._worker = _EncoderWorker(self.NAME, max(2, buffer_frames), target=target)
+        self._started = False
+        self._pts = 0
+        self.dropped = 0
+    
+    def _send(self, message):
+        self._worker.conn.send(message)
+    
+    def _start_job(self, fps:float) -> dict:
+        """Settings of the encoder process sent with the first frame"""
+        return {}
+    
+    def write(self, frame:np.ndarray, fps:float, capture_format:CaptureFormat, codec:str="libx264") -> bool:
+        """Called for every captured frame, returns False if it was dropped"""
+        pts = self._pts
+        self._pts += 1
+        worker = self._worker
+        ring = worker.ring_for(frame)
+        if not self._started:
+            gop = max(1, round(fps*settings.VID_PREROLL_GOP_SECONDS))
+            options = encoder_options()
+            #fixed GOPs so the stream can be cut on a keyframe
+            options['x264-params'] = f"keyint={gop}:min-keyint={gop}:scenecut=0"
+            job = self._start_job(fps)
+            job.update({'ring':ring.describe(),
+                        'encoder':{'codec':codec, 'fps':fps, 'resolution':capture_format.resolution(frame),
+                                   'av_format':capture_format.av_format,
+                                   'pix_fmt':capture_format.encoder_pix_fmt,
+                                   'options':options, 'threads':settings.VID_ENCODER_THREADS}})
+            self._send(('start', job))
+            self._started = True
+        if not worker.free_slots.acquire(False):
+            #the pts gap keeps the timing of the other frames
+            self.dropped += 1
+            DROPPED_ENCODER.inc()
+            if self.dropped % 100 == 1:
+                logger.warning(f"{self.NAME.title()} encoder is falling behind, {self.dropped} frames dropped")
+            return False
+        slot = ring.begin_write(worker.seq)
+        np.copyto(slot, frame)
+        ring.commit(worker.seq)
+        self._send(('frame', worker.seq, pts, time()))
+        worker.seq += 1
+        FRAMES_ENCODED.inc()
+        return True
+    
+    def stop(self):
+        """Flushes the encoder, the replies can still be read until close()"""
+        try:
+            self._send(('stop',))
+        except OSError:
+            pass
+    
+    def close(self):
+        self.stop()
+        self._worker.close()
+
+class PrerollEncoder(_ContinuousEncoder):
+    NAME = 'preroll'
+    
+    def __init__(self, before_movement:float, buffer_frames:int=8) -> None:
+        """Keeps the last `before_movement` seconds as compressed packets, aligned on keyframes every
+        VID_PREROLL_GOP_SECONDS. A clip starts with a copy of these packets, the pre-roll isn't encoded
+        at the start of the clip and only a few MB of packets are kept instead of seconds of raw frames"""
+        super().__init__(buffer_frames, _preroll_process)
+        self._before_movement = before_movement
+        self._clip_id = 0
+        self._replies = {}
+        self._reply_lock = ThreadCondition()
+    
+    def _start_job(self, fps:float) -> dict:
+        return {'preroll_frames':int(math.ceil(fps*self._before_movement))}
+    
+    def _wait_reply(self, clip_id:int):
+        #replies come in the order clips end, each writer thread waits for its own
+        with self._reply_lock:
+            while not clip_id in self._replies:
+                if not self._worker.conn.poll(1):
+                    if not self._worker.process.is_alive() and not self._worker.conn.poll():
+                        raise RuntimeError("Pre-roll encoder process died")
+                    continue
+                message = self._worker.conn.recv()
+                self._replies[message[1]] = message
+            return self._replies.pop(clip_id)
+    
+    def start_clip(self, file_path:str) -> PrerollClip:
+        """Called from the capture thread: the clip starts with the frames captured until now"""
+        self._clip_id += 1
+        self._send(('clip', self._clip_id, file_path))
+        return PrerollClip(self, self._clip_id)
+
+class _OpenSegment:
+    def __init__(self, container:av.container.OutputContainer, stream, file_path:str, first_pts:int, start:float) -> None:
+        self.container = container
+        self.stream = stream
+        self.file_path = file_path
+        self.first_pts = first_pts
+        self.start = start
+        self.end = start
+        self.frames = 0
+
+def _segment_process(conn:Connection, free_slots):
+    """Runs in the segment encoder process. Encodes every captured frame ('frame', seq, pts, time) into
+    MPEG-TS segments cut on keyframes and sends ('segment', path, start, end, frames) for each segment
+    written, with the capture times of its first frame and after its last"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    ring:SharedFrameRing|None = None
+    encoder:av.CodecContext|None = None
+    av_format = None
+    directory = ''
+    segment_frames = 0
+    #capture time of the frames in the encoder
+    capture_times:dict[int,float] = {}
+    segment:_OpenSegment|None = None
+    
+    def close_segment():
+        nonlocal segment
+        segment.container.close()
+        conn.send(('segment', segment.file_path, segment.start, segment.end, segment.frames))
+        segment = None
+    
+    def on_packet(packet:av.Packet):
+        nonlocal segment
+        captured = capture_times.pop(packet.pts, None)
+        if packet.is_keyframe and (segment is None or packet.pts - segment.first_pts >= segment_frames):
+            if not segment is None:
+                close_segment()
+            captured = captured or time()
+            file_path = path.join(directory, datetime.fromtimestamp(captured).strftime("%Y-%m-%d_%H-%M-%S") + f"_{packet.pts}.ts")
+            container = av.open(file_path, mode="w", format='mpegts')
+            stream = container.add_mux_stream(encoder.name, rate=encoder.framerate,
+                                              width=encoder.width, height=encoder.height)
+            stream.time_base = encoder.time_base
+            segment = _OpenSegment(container, stream, file_path, packet.pts, captured)
+        if segment is None:
+            return
+        packet.pts, packet.dts = packet.pts - segment.first_pts, packet.dts - segment.first_pts
+        packet.stream = segment.stream
+        segment.container.mux(packet)
+        segment.frames += 1
+        if not captured is None:
+            segment.end = max(segment.end, captured + float(encoder.time_base))
+    
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            break
+        try:
+            if message[0] == 'start':
+                job = message[1]
+                ring = SharedFrameRing(job['ring']['name'], job['ring']['shape'], job['ring']['dtype'], job['ring']['slots'])
+                encoder = _open_packet_encoder(job['encoder'])
+                av_format = job['encoder']['av_format']
+                directory = job['directory']
+                segment_frames = job['segment_frames']
+            elif message[0] == 'frame':
+                try:
+                    frame = ring.get(message[1])
+                    if not frame is None:
+                        video_frame = av.VideoFrame.from_ndarray(frame, format=av_format)
+                        video_frame.pts = message[2]
+                        video_frame.time_base = encoder.time_base
+                        capture_times[message[2]] = message[3]
+                        for packet in encoder.encode(video_frame):
+                            on_packet(packet)
+                finally:
+                    free_slots.release()
+            elif message[0] == 'stop':
+                break
+        except Exception:
+            logger.exception("Error in segment encoder process")
+    try:
+        if not encoder is None:
+            for packet in encoder.encode(None):
+                on_packet(packet)
+        if not segment is None:
+            close_segment()
+    except Exception:
+        logger.exception("Error flushing the segment encoder")
+    if not ring is None:
+        ring.close()
+
+class DatabaseWriter:
+    _singelton = None
+    
+    def __init__(self, batch:int|None=None) -> None:
+        """Saves the writes of the recorder's threads in a thread of its own so they never wait for each other's lock.
+        The writes waiting are saved in a single transaction, at most `batch` of them (DB_WRITE_BATCH), each in a
+        savepoint so one failing doesn't undo the others. The callbacks a write gives to transaction.on_commit()
+        run in this thread once it is committed. The writes still waiting are saved before the process exits"""
+        self._batch = max(1, batch or settings.DB_WRITE_BATCH)
+        self._jobs:ThreadQueue[tuple|None] = ThreadQueue()
+        self._thread = Thread(target=self._run, name="db-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+    
+    def submit(self, function, *args, **kwargs) -> Future:
+        """Never blocks. The future has the result of `function(*args, **kwargs)` once it is committed"""
+        future = Future()
+        if self._thread.is_alive():
+            self._jobs.put((future, function, args, kwargs))
+        else:
+            #closed, saved by the caller
+            self._write([(future, function, args, kwargs)])
+        return future
+    
+    def run(self, function, *args, **kwargs):
+        """Waits until `function(*args, **kwargs)` is committed and returns its result. Called from a write it runs
+        at once, in the same transaction"""
+        if current_thread() is self._thread:
+            return function(*args, **kwargs)
+        return self.submit(function, *args, **kwargs).result()
+    
+    @staticmethod
+    def _write(jobs:list[tuple]):
+        results = []
+        start = perf_counter()
+        try:
+            with transaction.atomic():
+                for future, function, args, kwargs in jobs:
+                    try:
+                        with transaction.atomic():
+                            results.append((future, function(*args, **kwargs), None))
+                    except Exception as e:
+                        logger.exception(f"Error in the database write {getattr(function, '__qualname__', function)}")
+                        results.append((future, None, e))
+        except Exception as e:
+            logger.exception(f"Error saving {len(jobs)} database writes")
+            results = [(future, None, e) for future, *_ in jobs]
+        DB_WRITE_SECONDS.observe(perf_counter() - start)
+        DB_WRITES.inc(len(jobs))
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+    
+    def _run(self):
+        stop = False
+        while not stop:
+            jobs = [self._jobs.get()]
+            while len(jobs) < self._batch:
+                try:
+                    jobs.append(self._jobs.get_nowait())
+                except Empty:
+                    break
+            stop = None in jobs
+            jobs = [job for job in jobs if not job is None]
+            if len(jobs) > 0:
+                #reconnects once the connection is older than DB_CONN_MAX_AGE or unusable
+                close_old_connections()
+                self._write(jobs)
+        connections.close_all()
+    
+    def close(self):
+        """Waits for the writes submitted"""
+        if self._thread.is_alive():
+            self._jobs.put(None)
+            self._thread.join()
+        if DatabaseWriter._singelton is self:
+            DatabaseWriter._singelton = None
+    
+    @staticmethod
+    def getSingleton():
+        if DatabaseWriter._singelton is None:
+            DatabaseWriter._singelton = DatabaseWriter()
+        return DatabaseWriter._singelton
+
+def event_segments_size(event:Video) -> int:
+    """Bytes of the segments a movement recorded in segments is in"""
+    segments = Segment.objects.filter(start__lt=event.event_end, end__gt=event.event_start)
+    return segments.aggregate(total=Sum('file_size'))['total'] or 0
+
+def delete_old_segments() -> int:
+    """Deletes the segments older than VID_SEGMENT_RETENTION_MINUTES without movement, returns their bytes"""
+    limit = get_datetime_local() - timedelta(minutes=settings.VID_SEGMENT_RETENTION_MINUTES)
+    #segments overlapping a movement are kept until its video is deleted
+    with_motion = Video.objects.filter(event_start__lt=OuterRef('end')).filter(
+        Q(event_end__isnull=True) | Q(event_end__gt=OuterRef('start')))
+    old = list(Segment.objects.filter(end__lt=limit).exclude(Exists(with_motion)))
+    if len(old) == 0:
+        return 0
+    Segment.objects.filter(pk__in=[s.pk for s in old]).delete()
+    #once no video can be written from them anymore
+    paths = [segment.segment_file for segment in old]
+    transaction.on_commit(lambda: remove_files(paths), robust=True)
+    logger.debug(f"Deleted {len(old)} segments without movement")
+    return sum(segment.file_size or 0 for segment in old)
+
+class SegmentRecorder(_ContinuousEncoder):
+    NAME = 'segment'
+    
+    def __init__(self, before_movement:float, buffer_frames:int=8, thumbnails:'ThumbnailWriter|None'=None,
+                 previews:'PreviewWriter|None'=None, retention:'RetentionManager|None'=None) -> None:
+        """Records continuously in segments of VID_SEGMENT_SECONDS. Movements are saved as Videos with
+        the time range of the event, their file is only written from the segments when first played.
+        Segments without movement are deleted after VID_SEGMENT_RETENTION_MINUTES.
+        The database is only written by the DatabaseWriter, never by the capture thread"""
+        super().__init__(buffer_frames, _segment_process)
+        self._before_movement = before_movement
+        self._thumbnails = thumbnails
+        self._previews = previews
+        self._retention = retention
+        #events ended whose last segment isn't written yet, only used by the writes, see _events_written
+        self._ended_events:list[Video] = []
+        self._directory = Path(settings.MEDIA_ROOT).joinpath(settings.SEGMENTS_DIRECTORY)
+        self._directory.mkdir(0o755, True, True)
+        Path(settings.MEDIA_ROOT).joinpath(settings.VIDEOS_DIRECTORY).mkdir(0o755, True, True)
+        Path(settings.MEDIA_ROOT).joinpath(settings.THUMBNAIL_DIRECTORY).mkdir(0o755, True, True)
+        self._fps = 0
+        self._reader = Thread(target=self._read_segments, name="segment-reader", daemon=True)
+    
+    def _start_job(self, fps:float) -> dict:
+        self._fps = fps
+        gop = max(1, round(fps*settings.VID_PREROLL_GOP_SECONDS))
+        self._reader.start()
+        return {'directory':str(self._directory),
+                'segment_frames':max(1, int(math.ceil(fps*settings.VID_SEGMENT_SECONDS/gop)))*gop}
+    
+    def _read_segments(self):
+        conn = self._worker.conn
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                break
+            if message[0] == 'segment':
+                DatabaseWriter.getSingleton().submit(self._save_segment, *message[1:])
+    
+    def _save_segment(self, file_path:str, start:float, end:float, frames:int):
+        try:
+            file_size = os.path.getsize(file_path)
+        except OSError:
+            file_size = 0
+        BYTES_WRITTEN.inc(file_size)
+        Segment.objects.create(segment_file=file_path, start=get_datetime_local(start),
+                               end=get_datetime_local(end), num_frames=frames, framerate=self._fps,
+                               file_size=file_size)
+        self._events_written(get_datetime_local(end))
+        freed = delete_old_segments()
+        if not self._retention is None:
+            self._retention.add(file_size - freed)
+    
+    def _save_event_start(self, event:Video, start:datetime):
+        event.event_start = start - timedelta(seconds=self._before_movement)
+        event.save()
+        logger.info(f"Movement started, event {event.pk}")
+    
+    def _save_event_end(self, event:Video, end:datetime, thumbnail_frame:np.ndarray|None,
+                        capture_format:CaptureFormat|None):
+        event.event_end = end
+        event.num_frames = round((end - event.event_start).total_seconds() * self._fps)
+        event.save(update_fields=['event_end', 'num_frames'])
+        logger.info(f"Movement ended, event {event.pk} lasted {(end - event.event_start).total_seconds():.1f}s")
+        if not self._thumbnails is None and not thumbnail_frame is None:
+            transaction.on_commit(lambda: self._thumbnails.submit(event, thumbnail_frame, capture_format), robust=True)
+        self._ended_events.append(event)
+    
+    def _events_written(self, written_until:datetime|None):
+        """The events ended in the segments written until `written_until` (all if None) get the size of their
+        segments, the retention may delete them from then on, and their preview is written"""
+        written = [e for e in self._ended_events if written_until is None or e.event_end <= written_until]
+        self._ended_events = [e for e in self._ended_events if not e in written]
+        for event in written:
+            Video.objects.filter(pk=event.pk).update(file_size=event_segments_size(event))
+            if not self._previews is None:
+                #the preview reads the segments once they are committed
+                transaction.on_commit(lambda event=event: self._previews.submit(event), robust=True)
+    
+    def start_event(self, when:datetime) -> Video:
+        """Called from the capture thread when a movement starts, the pre-roll is already in the segments"""
+        event = Video(video_file=str(path.join(settings.MEDIA_ROOT, settings.VIDEOS_DIRECTORY,
+                                               when.strftime("%Y-%m-%d_%H-%M-%S.mp4"))),
+                      num_frames=0, framerate=self._fps or 1, title=when.strftime("%A %-d %b %Y, %H:%M:%S"))
+        DatabaseWriter.getSingleton().submit(self._save_event_start, event, when)
+        CLIPS.inc()
+        return event
+    
+    def end_event(self, event:Video, when:datetime, thumbnail_frame:np.ndarray|None=None,
+                  capture_format:CaptureFormat|None=None):
+        """The thumbnail of the event is written from `thumbnail_frame` once it is saved"""
+        DatabaseWriter.getSingleton().submit(self._save_event_end, event, when, thumbnail_frame, capture_format)
+    
+    def close(self):
+        #the last segment is sent once the encoder is flushed
+        self.stop()
+        self._worker.process.join(10)
+        if self._reader.is_alive():
+            self._reader.join(1)
+        #after the writes of the last segments
+        DatabaseWriter.getSingleton().run(self._events_written, None)
+        super().close()
+
+class FrameBudgetQueue:
+    POLICIES = ('drop', 'decimate')
+    
+    def __init__(self, budget_bytes:int, overload:str='decimate') -> None:
+        """Frames waiting to be handed to the encoder, as (index, frame), limited to `budget_bytes`.
+        `put()` never blocks the capture: once the budget is used new frames are dropped. With the
+        'decimate' policy only every 2nd frame is kept once the queue is half full (every 4th at 3/4)
+        which lowers the encoded frame rate until the encoder catches up. The indexes of the dropped
+        frames are skipped so the timestamps of the frames kept stay correct"""
+        if not overload in FrameBudgetQueue.POLICIES:
+            raise ValueError(f"Unknown overload policy '{overload}', expected one of {FrameBudgetQueue.POLICIES}")
+        self.budget_bytes = max(1, int(budget_bytes))
+        self._overload = overload
+        self._queue:deque[tuple[int,np.ndarray]] = deque()
+        self._bytes = 0
+        self._not_empty = ThreadCondition()
+        self._overloaded = False
+        self.dropped = 0
+        self.peak_depth = 0
+        self.peak_bytes = 0
+    
+    def _keep_every(self) -> int:
+        if self._overload != 'decimate':
+            return 1
+        fill = self._bytes / self.budget_bytes
+        return 4 if fill >= 0.75 else 2 if fill >= 0.5 else 1
+    
+    def put(self, index:int, frame:np.ndarray) -> bool:
+        """Returns False if the frame was dropped"""
+        with self._not_empty:
+            keep_every = self._keep_every()
+            #a frame bigger than the whole budget still goes through an empty queue
+            full = len(self._queue) > 0 and self._bytes + frame.nbytes > self.budget_bytes
+            if full or index % keep_every != 0:
+                self.dropped += 1
+                DROPPED_WRITER.inc()
+                if not self._overloaded:
+                    self._overloaded = True
+                    logger.warning(f"Encoder is falling behind: {len(self._queue)} frames "
+                                   f"({self._bytes/2**20:.1f}MiB) queued, "
+                                   + ("dropping frames" if full else f"keeping 1 frame in {keep_every}"))
+                return False
+            if self._overloaded and keep_every == 1:
+                self._overloaded = False
+                logger.info(f"Encoder caught up, {self.dropped} frames dropped so far")
+            self._queue.append((index, frame))
+            self._bytes += frame.nbytes
+            WRITER_QUEUE_FRAMES.inc()
+            WRITER_QUEUE_BYTES.inc(frame.nbytes)
+            self.peak_depth = max(self.peak_depth, len(self._queue))
+            self.peak_bytes = max(self.peak_bytes, self._bytes)
+            self._not_empty.notify()
+            return True
+    
+    def get(self, timeout:float|None=None) -> tuple[int,np.ndarray]:
+        """Raises queue.Empty after `timeout` seconds without frames"""
+        with self._not_empty:
+            if not self._not_empty.wait_for(lambda: len(self._queue) > 0, timeout):
+                raise Empty()
+            index, frame = self._queue.popleft()
+            self._bytes -= frame.nbytes
+            WRITER_QUEUE_FRAMES.dec()
+            WRITER_QUEUE_BYTES.dec(frame.nbytes)
+            return index, frame
+    
+    def peek(self, timeout:float|None=None) -> np.ndarray:
+        """The next frame without removing it. Raises queue.Empty after `timeout` seconds without frames"""
+        with self._not_empty:
+            if not self._not_empty.wait_for(lambda: len(self._queue) > 0, timeout):
+                raise Empty()
+            return self._queue[0][1]
+    
+    def empty(self) -> bool:
+        with self._not_empty:
+            return len(self._queue) == 0
+    
+    @property
+    def depth(self) -> int:
+        return len(self._queue)
+    
+    @property
+    def queued_bytes(self) -> int:
+        return self._bytes
+    
+    @staticmethod
+    def default_budget(frame_bytes:int=0) -> int:
+        """VID_WRITER_QUEUE_MAX_MB capped to a quarter of the available memory, at least 2 frames"""
+        budget = min(settings.VID_WRITER_QUEUE_MAX_MB*2**20, available_memory()/4)
+        return int(max(budget, 2*frame_bytes))
+
+#the formats of the thumbnails and their encoding parameters, AVIF only if OpenCV can write it
+THUMBNAIL_FORMATS = [('webp', [cv2.IMWRITE_WEBP_QUALITY, 85])]
+if hasattr(cv2, 'IMWRITE_AVIF_QUALITY') and cv2.haveImageWriter('.avif'):
+    THUMBNAIL_FORMATS.append(('avif', [cv2.IMWRITE_AVIF_QUALITY, 60]))
+
+class _BackgroundWriter(ABC):
+    NAME = ''
+    SECONDS = None
+    
+    def __init__(self, max_jobs:int=8) -> None:
+        """Writes files of the videos in a thread of its own, started by start() once the encoder processes are.
+        Jobs are dropped if `max_jobs` are waiting"""
+        Path(settings.MEDIA_ROOT).joinpath(settings.THUMBNAIL_DIRECTORY).mkdir(0o755, True, True)
+        self._jobs = ThreadQueue(max_jobs)
+        self._thread = Thread(target=self._run, name=self.NAME+"s", daemon=True)
+    
+    def start(self):
+        self._thread.start()
+    
+    def _submit(self, video:Video, *args) -> bool:
+        try:
+            self._jobs.put_nowait((video,) + args)
+            return True
+        except Full:
+            logger.warning(f"Too many {self.NAME}s waiting, video {video.pk} won't have one")
+            return False
+    
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            start = perf_counter()
+            try:
+                self.write(*job)
+            except Exception:
+                logger.exception(f"Error writing the {self.NAME} of video {job[0].pk}")
+            self.SECONDS.observe(perf_counter() - start)
+    
+    @abstractmethod
+    def write(self, video:Video, *args):
+        """Writes the files of `video`, in the thread of the writer"""
+    
+    def close(self):
+        """Waits for the jobs submitted"""
+        if self._thread.is_alive():
+            self._jobs.put(None)
+            self._thread.join()
+
+def _write_atomic(file_path:str, data:bytes):
+    with open(file_path+'.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(file_path+'.tmp', file_path)
+
+class ThumbnailWriter(_BackgroundWriter):
+    """Writes the thumbnails of videos in each of THUMBNAIL_FORMATS: the full frame and copies THUMBNAIL_WIDTHS wide.
+    The recorder only hands a frame over"""
+    NAME = 'thumbnail'
+    SECONDS = THUMBNAIL_SECONDS
+    
+    def submit(self, video:Video, frame:np.ndarray, capture_format:CaptureFormat) -> bool:
+        """Never blocks, the frame must not be changed afterwards. Returns False if the thumbnail is dropped"""
+        return self._submit(video, frame, capture_format)
+    
+    def write(self, video:Video, frame:np.ndarray, capture_format:CaptureFormat):
+        image = capture_format.to_bgr(frame)
+        height, width = image.shape[:2]
+        widths = sorted(set(w for w in settings.THUMBNAIL_WIDTHS if 0 < w < width))
+        resized = [(w, cv2.resize(image, (w, max(1, round(height*w/width))), interpolation=cv2.INTER_AREA)) for w in widths]
+        name = path.join(settings.THUMBNAIL_DIRECTORY, str(video.pk).rjust(7,'0'))
+        for extension, params in THUMBNAIL_FORMATS:
+            for suffix, img in [('', image)] + [(f'-{w}', r) for w, r in resized]:
+                _, data = cv2.imencode('.'+extension, img, params)
+                _write_atomic(path.join(settings.MEDIA_ROOT, f"{name}{suffix}.{extension}"), data.tobytes())
+        #only these fields, the video may be changed meanwhile
+        DatabaseWriter.getSingleton().submit(Video.objects.filter(pk=video.pk).update, thumbnail_file=name+'.webp',
+                                             thumbnail_widths=','.join(map(str, widths)),
+                                             thumbnail_avif=len(THUMBNAIL_FORMATS) > 1)
+        logger.debug(f"Wrote the thumbnails of video {video.pk}")
+
+class PreviewWriter(_BackgroundWriter):
+    """Writes the hover preview of videos once their file or their segments are written: a sprite of up to
+    PREVIEW_FRAMES keyframes evenly spaced through the video, side by side, and an index of their times and of
+    all the keyframes. Only the keyframes are decoded"""
+    NAME = 'preview'
+    SECONDS = PREVIEW_SECONDS
+    
+    def submit(self, video:Video) -> bool:
+        """Never blocks. Returns False if the preview is dropped"""
+        return self._submit(video)
+    
+    @staticmethod
+    def _keyframes(video:Video, width:int):
+        """(seconds from the start of the video file, image) of the keyframes of the video, and the video duration"""
+        if os.path.exists(video.video_file):
+            with av.open(video.video_file) as container:
+                duration = container.duration/av.time_base if container.duration else 0.0
+            return decode_keyframes(video.video_file, width), duration
+        if video.event_start is None or video.event_end is None:
+            raise FileNotFoundError(f"No file for video {video.pk}")
+        duration = (video.event_end - video.event_start).total_seconds()
+        segments = list(Segment.objects.filter(start__lt=video.event_end, end__gt=video.event_start).order_by('start'))
+        def keyframes():
+            #relative to the start of the event, the times of the file are set once it is known
+            for segment in segments:
+                offset = (segment.start - video.event_start).total_seconds()
+                for seconds, image in decode_keyframes(segment.segment_file, width):
+                    if offset + seconds > duration:
+                        return
+                    yield offset + seconds, image
+        return keyframes(), duration
+    
+    def write(self, video:Video) -> bool:
+        try:
+            video = Video.objects.get(pk=video.pk)
+        except Video.DoesNotExist:
+            return False
+        count = max(1, settings.PREVIEW_FRAMES)
+        keyframes, duration = self._keyframes(video, max(2, settings.PREVIEW_WIDTH//2*2))
+        #the first keyframe of each of `count` parts of the video, only those images are kept
+        step = max(duration, 1e-3)/count
+        tiles:dict[int,tuple[float,np.ndarray]] = {}
+        times = []
+        for seconds, image in keyframes:
+            times.append(seconds)
+            part = min(count-1, int(seconds//step))
+            if seconds <= 0 or not part in tiles:
+                #until the start of the event, the last keyframe before it
+                tiles[max(0, part)] = (seconds, image)
+        if len(times) == 0:
+            logger.warning(f"No keyframe found for the preview of video {video.pk}")
+            return False
+        #a video made from segments starts on the last keyframe before the event, like concat_segments
+        start = max((t for t in times if t <= 0), default=times[0])
+        tiles = [tiles[part] for part in sorted(tiles)]
+        times = [t for t in times if t >= start]
+        sprite = np.hstack([image for _, image in tiles])
+        _, data = cv2.imencode('.webp', sprite, [cv2.IMWRITE_WEBP_QUALITY, 70])
+        height, width = tiles[0][1].shape[:2]
+        index = {'duration':round(duration - start, 3), 'width':width, 'height':height,
+                 'tiles':[round(t - start, 3) for t, _ in tiles], 'keyframes':[round(t - start, 3) for t in times]}
+        name = path.join(settings.MEDIA_ROOT, video.preview_name)
+        _write_atomic(name+'.webp', data.tobytes())
+        _write_atomic(name+'.json', dumps(index, separators=(',', ':')).encode())
+        DatabaseWriter.getSingleton().submit(Video.objects.filter(pk=video.pk).update, preview_tiles=len(tiles))
+        logger.debug(f"Wrote the preview of video {video.pk}: {len(tiles)} of {len(times)} keyframes")
+        return True
+
+class RetentionManager:
+    BATCH = 200
+    
+    def __init__(self) -> None:
+        """Deletes the oldest videos while the videos and segments use more than RETENTION_MAX_GB or while less than
+        RETENTION_MIN_FREE_MB are free, and the videos older than RETENTION_MAX_DAYS. Tagged and starred videos and
+        the videos being recorded are never deleted.
+        The bytes used are a running total of the sizes saved with the videos and segments, counted again from the
+        database at each pass. Passes run in a thread every RETENTION_INTERVAL_MINUTES, or as soon as
+        check_space() finds the limits exceeded"""
+        self._max_bytes = int(settings.RETENTION_MAX_GB*2**30)
+        self._min_free = int(settings.RETENTION_MIN_FREE_MB*2**20)
+        self._total = 0
+        self._lock = ThreadLock()
+        self._wake = ThreadEvent()
+        self._stopped = False
+        self._thread = Thread(target=self._run, name="retention", daemon=True)
+    
+    def start(self):
+        """Counts the bytes used and starts the passes, once the encoder processes are started"""
+        self._fill_missing_sizes()
+        self._count()
+        self._thread.start()
+    
+    @property
+    def total_bytes(self) -> int:
+        return self._total
+    
+    def add(self, size:int):
+        """Counts `size` more bytes (less if negative) written by the recorder"""
+        with self._lock:
+            self._total += size
+            STORAGE_BYTES.set(self._total)
+    
+    def check_space(self):
+        """Called before a clip or a movement starts, never blocks. Starts a pass if the limits are exceeded"""
+        free = shutil.disk_usage(settings.MEDIA_ROOT).free
+        if free < self._min_free:
+            logger.warning(f"Only {free/2**20:.0f}MiB free for the videos, deleting the oldest ones")
+            self._wake.set()
+        elif self._max_bytes > 0 and self._total > self._max_bytes:
+            self._wake.set()
+    
+    def _fill_missing_sizes(self):
+        #videos and segments saved before their size was, or whose recording was interrupted. Nothing is recorded yet
+        db = DatabaseWriter.getSingleton()
+        for segments in iter(lambda: list(Segment.objects.filter(file_size__isnull=True)[:self.BATCH]), []):
+            for segment in segments:
+                segment.file_size = os.path.getsize(segment.segment_file) if os.path.exists(segment.segment_file) else 0
+            db.run(Segment.objects.bulk_update, segments, ['file_size'])
+        for videos in iter(lambda: list(Video.objects.filter(file_size__isnull=True)[:self.BATCH]), []):
+            for video in videos:
+                if os.path.exists(video.video_file):
+                    video.file_size = os.path.getsize(video.video_file)
+                elif not video.event_start is None and not video.event_end is None:
+                    video.file_size = event_segments_size(video)
+                else:
+                    video.file_size = 0
+            db.run(Video.objects.bulk_update, videos, ['file_size'])
+    
+    def _count(self):
+        #the files of the videos in segments are only written when they are played, their segments are counted
+        videos = Video.objects.filter(event_start__isnull=True).aggregate(total=Sum('file_size'))['total'] or 0
+        segments = Segment.objects.aggregate(total=Sum('file_size'))['total'] or 0
+        with self._lock:
+            self._total = videos + segments
+            STORAGE_BYTES.set(self._total)
+    
+    def _bytes_over(self) -> int:
+        over = self._total - self._max_bytes if self._max_bytes > 0 else 0
+        return max(over, self._min_free - shutil.disk_usage(settings.MEDIA_ROOT).free)
+    
+    @staticmethod
+    def _evictable():
+        tagged = VideoTag.objects.filter(video=OuterRef('pk'))
+        return (Video.objects.filter(starred=False, file_size__isnull=False).exclude(Exists(tagged))
+                .order_by('date_created', 'id'))
+    
+    def _delete(self, videos:list[Video]) -> int:
+        db = DatabaseWriter.getSingleton()
+        db.run(Video.objects.filter(pk__in=[v.pk for v in videos]).delete)
+        remove_files(f for v in videos for f in v.files)
+        #the segments of the deleted movements
+        db.run(delete_old_segments)
+        self._count()
+        VIDEOS_EVICTED.inc(len(videos))
+        logger.info(f"Deleted {len(videos)} videos from {videos[0].title} to {videos[-1].title}")
+        return len(videos)
+    
+    def evict(self) -> int:
+        """Deletes the videos over the limits, returns how many"""
+        deleted = 0
+        self._count()
+        if settings.RETENTION_MAX_DAYS > 0:
+            limit = get_datetime_local() - timedelta(days=settings.RETENTION_MAX_DAYS)
+            while not self._stopped:
+                videos = list(self._evictable().filter(date_created__lt=limit)[:self.BATCH])
+                if len(videos) == 0:
+                    break
+                deleted += self._delete(videos)
+        while not self._stopped and (needed := self._bytes_over()) > 0:
+            #the oldest videos until enough bytes are freed
+            videos, size = [], 0
+            for video in self._evictable()[:self.BATCH]:
+                videos.append(video)
+                size += video.file_size
+                if size >= needed:
+                    break
+            if len(videos) == 0:
+                logger.error(f"{needed/2**20:.0f}MiB over the storage limits but all the videos are tagged or starred")
+                break
+            deleted += self._delete(videos)
+        return deleted
+    
+    def _run(self):
+        while not self._stopped:
+            try:
+                self.evict()
+            except Exception:
+                logger.exception("Error deleting old videos")
+            self._wake.wait(settings.RETENTION_INTERVAL_MINUTES*60)
+            self._wake.clear()
+    
+    def close(self):
+        self._stopped = True
+        self._wake.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
 class VideoWriter(Interruptable):
-    def __init__(self, filename, creation_time=None, initial=None, codec="libx264", fps=30, height=1080, width=1920) -> None:
+    QUEUE_LOG_INTERVAL = 5
+    def __init__(self, filename, creation_time=None, initial=None, codec="libx264", fps=30, height=1080, width=1920,
+                 capture_format:CaptureFormat|None=None, encoder_pool:EncoderPool|None=None,
+                 preroll:PrerollEncoder|None=None, thumbnails:ThumbnailWriter|None=None,
+                 previews:PreviewWriter|None=None, retention:RetentionManager|None=None) -> None:
         #ensure assets dir exists
         Path(settings.MEDIA_ROOT).joinpath(settings.VIDEOS_DIRECTORY).mkdir(0o755, True, True)
         Path(settings.MEDIA_ROOT).joinpath(settings.THUMBNAIL_DIRECTORY).mkdir(0o755, True, True)
         
         logger.debug("Starting video writer")
-        self._frame_queue = Queue()
         self._initial = initial if isinstance(initial, (tuple, list)) else []
+        frame_bytes = self._initial[0].nbytes if len(self._initial) > 0 else 0
+        self._frame_queue = FrameBudgetQueue(FrameBudgetQueue.default_budget(frame_bytes), settings.VID_WRITER_OVERLOAD)
+        #index of the next frame in the clip, dropped frames included
+        self._next_index = len(self._initial)
         self._codec = codec
+        self._format = capture_format or CaptureFormat()
+        self._encoder_pool = encoder_pool or EncoderPool(0)
         self._fps = fps
         self._resolution = (height, width)
+        self._thumbnails = thumbnails
+        self._previews = previews
+        self._retention = retention
+        #frame the thumbnail is made from once the clip is written, see set_thumbnail()
+        self._thumbnail_frame = self._initial[-1] if len(self._initial) > 0 else None
+        #the pre-roll clip must start at the frame the writer was created on, not when the writer thread runs
+        self._job = None
+        if not preroll is None:
+            self._job = preroll.start_clip(str(path.join(settings.MEDIA_ROOT, settings.VIDEOS_DIRECTORY, filename)))
         self._write_thread = Thread(target=self._start_write, kwargs={"filename":filename, "creation_time":creation_time})
         super().__init__(self._write_thread)
         logger.debug("Starting Video Writer Thread")
         self._write_thread.start()
         
-    def _start_write(self, filename, creation_time=creation_time):
-        #Create thumbnail
-        if len(self._initial) > 0:
-            #if there are images in the ring buffer use the most recent as thumbnail
-            thumbnail_frame = self._initial[-1]
-        else:
-            #Otherwise take the first next frame
-            thumbnail_frame = self._frame_queue.get(True)
-            self._frame_queue.put_nowait(thumbnail_frame)
-        _, thumbnail = cv2.imencode(".webp", cv2.cvtColor(thumbnail_frame, cv2.COLOR_BGR2RGB),
-                    [cv2.IMWRITE_WEBP_QUALITY, 95])
-        thumbnail = np.array(thumbnail).tobytes()
-        thumbnail = io.BytesIO(thumbnail)
-        logger.debug("Generating thumbnail")
+    def _start_write(self, filename, creation_time=None):
         logger.info(f"Starting video write with codec:{self._codec} and {self._fps} fps")
 
         file_path = str(path.join(settings.MEDIA_ROOT, settings.VIDEOS_DIRECTORY, filename))
-        stream_options = {'movflags':'+faststart', "crf":"18"}
-        container = av.open(file_path, mode="w")
-        stream = container.add_stream(self._codec, rate=self._fps, options=stream_options)
-        stream.height,stream.width = self._resolution
-        # stream.pix_fmt = settings.VID_OUTPUT_PXL_FORMAT
+        #the frames are encoded by a process of the pool or the pre-roll encoder, this thread only hands them over
+        job = self._job or self._encoder_pool.start_clip(file_path, self._fps, self._resolution, self._format, codec=self._codec)
         logger.debug(f"Creating video file \"{file_path}\"")
         
-        vid = Video.objects.create(video_file=file_path,
-                                   num_frames=len(self._initial),
-                                   framerate=self._fps)
-        
+        db = DatabaseWriter.getSingleton()
         vid_time = creation_time or get_datetime_local()
-        vid.title = vid_time.strftime("%A %-d %b %Y, %H:%M:%S")
-        vid.thumbnail_file.save(str(vid.pk).rjust(7,'0')+'.webp', thumbnail)
-        vid.save()
-        logger.debug(f"Created video entry pk={vid.pk} and saved thumbnail")
+        vid = db.run(Video.objects.create, video_file=file_path,
+                     num_frames=len(self._initial),
+                     framerate=self._fps,
+                     title=vid_time.strftime("%A %-d %b %Y, %H:%M:%S"))
+        logger.debug(f"Created video entry pk={vid.pk}")
         
-        #write initial buffer
-        for frame in self._initial:
-            frame = av.VideoFrame.from_ndarray(frame, format="rgb24")            
-            # for packet in stream.encode(frame):
-            #     container.mux(packet)
-            container.mux(stream.encode(frame))
-        logger.debug(f"Wrote first {len(self._initial)} frames")
-        del self._initial #clear mem
-                
-        #write other frames
-        while not self.is_interrupted or not self._frame_queue.empty():
-            try:
-                f = self._frame_queue.get(block=True, timeout=0.1)
-            except:
-                f = None
-                continue
-            frame = av.VideoFrame.from_ndarray(f, format="rgb24")            
-            for packet in stream.encode(frame):
-                container.mux(packet)
-            vid.num_frames += 1
-
-
-        vid.save()
-        logger.debug(f"Wrote all {vid.num_frames} frames and flushing final data")
-        #flush steam
-        for packet in stream.encode():
-            container.mux(packet)
-        container.close()
+        try:
+            #write initial buffer
+            for pts, frame in enumerate(self._initial):
+                job.write(frame, pts)
+            logger.debug(f"Wrote first {len(self._initial)} frames")
+            del self._initial #clear mem
+                    
+            #write other frames
+            queue = self._frame_queue
+            last_log = monotonic()
+            while not self.is_interrupted or not queue.empty():
+                try:
+                    pts, f = queue.get(timeout=0.1)
+                except Empty:
+                    continue
+                job.write(f, pts)
+                vid.num_frames += 1
+                if monotonic() - last_log > VideoWriter.QUEUE_LOG_INTERVAL:
+                    last_log = monotonic()
+                    logger.debug(f"Writer queue: {queue.depth} frames ({queue.queued_bytes/2**20:.1f}MiB"
+                                 f" of {queue.budget_bytes/2**20:.0f}MiB), {queue.dropped} dropped")
+        finally:
+            db.submit(Video.objects.filter(pk=vid.pk).update, num_frames=vid.num_frames)
+            logger.debug(f"Wrote all {vid.num_frames} frames and flushing final data")
+            frames, encode_seconds = job.finish()
+        #includes the pre-roll, the frames dropped before the encoder are not counted
+        vid.num_frames = frames
+        try:
+            vid.file_size = os.path.getsize(file_path)
+        except OSError:
+            vid.file_size = 0
+        #the video may have been starred or tagged meanwhile, from then on the retention may delete it
+        db.submit(vid.save, update_fields=['num_frames', 'file_size'])
+        if not self._retention is None:
+            self._retention.add(vid.file_size)
+        if not self._thumbnails is None and not self._thumbnail_frame is None:
+            self._thumbnails.submit(vid, self._thumbnail_frame, self._format)
+        if not self._previews is None:
+            self._previews.submit(vid)
+        CLIPS.inc()
+        BYTES_WRITTEN.inc(vid.file_size)
         logger.debug(f"Video container written fully")
-        logger.info(f"Video {vid.title} done : written all {vid.num_frames} frames.")
+        encoder_fps = frames/encode_seconds if encode_seconds > 0 else 0
+        queue = self._frame_queue
+        logger.info(f"Video {vid.title} done : written all {vid.num_frames} frames, {queue.dropped} dropped. "
+                    f"Encoder at {encoder_fps:.1f} fps for a capture at {self._fps} fps, "
+                    f"peak queue {queue.peak_depth} frames ({queue.peak_bytes/2**20:.1f}MiB)")
     
     def write_frame(self, frame):
-        self._frame_queue.put_nowait(frame)
+        #never blocks, the frame may be dropped if the encoder is too far behind
+        self._frame_queue.put(self._next_index, frame)
+        self._next_index += 1
     
-    def close(self):
-        if self.is_interrupted:
-            return #already interrupted
-        logger.debug('Stopping writer thread')
-        self.interrupt()
-        self._write_thread.join()
+    def set_thumbnail(self, frame:np.ndarray):
+        """The frame the thumbnail is made from once the clip is written, it must not be changed afterwards"""
+        self._thumbnail_frame = frame
+    
+    @property
+    def done(self) -> bool:
+        return not self._write_thread.is_alive()
+    
+    def close(self, wait=True):
+        #with wait=False the clip keeps being encoded in the background, call close() again to wait for it
+        if not self.is_interrupted:
+            logger.debug('Stopping writer thread')
+            if isinstance(self._job, PrerollClip):
+                self._job.end()
+            self.interrupt()
+        if wait:
+            self._write_thread.join()
         
+class MotionZone:
+    def __init__(self, points, threshold:float, sensitivity:int, exclude:bool=False, name:str='') -> None:
+        """A polygon of the frame to check for motion, or to ignore if `exclude` is set.
+        `points` are (x,y) percentages of the frame width and height.
+        `threshold` is the fraction of the zone's pixels that must change for it to be a movement and
+        `sensitivity` the luminosity change for a pixel to count as changed"""
+        self.points = np.clip(np.asarray(points, dtype=np.float64).reshape(-1, 2), 0, 100)
+        self.threshold = float(threshold)
+        self.sensitivity = int(min(254, max(0, sensitivity)))
+        self.exclude = bool(exclude)
+        self.name = str(name)
+    
+    def polygon(self, width:int, height:int) -> np.ndarray:
+        #pixel coordinates
+        return self.points * (width/100.0, height/100.0)
+    
+    @staticmethod
+    def from_config(default_threshold:float|None=None) -> list['MotionZone']:
+        """Zones from the MOTION_ZONES json config. Without any zone to check, the
+        MOTION_DETECT_AREA_* rectangle is used (exclusion masks still apply)"""
+        default_threshold = config.MOTION_DETECTION_THRESHOLD if default_threshold is None else default_threshold
+        default_sensitivity = config.MOTION_SENSITIVITY_THRESHOLD
+        zones = []
+        try:
+            for zone in loads(config.MOTION_ZONES or '[]'):
+                if len(zone.get('points', [])) < 3:
+                    continue
+                zones.append(MotionZone(zone['points'],
+                                        zone.get('threshold', default_threshold),
+                                        zone.get('sensitivity', default_sensitivity),
+                                        zone.get('exclude', False),
+                                        zone.get('name', '')))
+        except (ValueError, TypeError, AttributeError, KeyError):
+            logger.exception("Invalid MOTION_ZONES config, ignoring it")
+            zones = []
+        if not any(not z.exclude for z in zones):
+            tl_x, tl_y = config.MOTION_DETECT_AREA_TL_X, config.MOTION_DETECT_AREA_TL_Y
+            br_x, br_y = config.MOTION_DETECT_AREA_BR_X, config.MOTION_DETECT_AREA_BR_Y
+            zones.insert(0, MotionZone([(tl_x, tl_y), (br_x, tl_y), (br_x, br_y), (tl_x, br_y)],
+                                       default_threshold, default_sensitivity, name='area'))
+        return zones
+
+class MotionEngine(ABC):
+    name = ''
+    
+    def __init__(self, shape:tuple[int,int], sensitivity:np.ndarray, background_fade_rate:float) -> None:
+        """Background model of the MotionDetector. `shape` is the size of the grayscale images checked
+        and `sensitivity` the luminosity change for each pixel to count as changed"""
+        self._shape = shape
+        self._sensitivity = sensitivity
+        self._background_fade_rate = background_fade_rate
+    
+    @abstractmethod
+    def changed(self, frame:np.ndarray) -> np.ndarray|None:
+        """Boolean mask of the pixels that changed compared to the background, then updates the background.
+        None while there is no background yet"""
+
+class FrameDiffEngine(MotionEngine):
+    name = 'diff'
+    
+    def __init__(self, shape:tuple[int,int], sensitivity:np.ndarray, background_fade_rate:float) -> None:
+        """Difference with a running average of the checked frames, kept as uint8"""
+        super().__init__(shape, sensitivity, background_fade_rate)
+        self._background = None
+    
+    def update_background(self, normalized_frame):
+        self._background = self._background * self._background_fade_rate/(1+self._background_fade_rate) + normalized_frame/(1+self._background_fade_rate)
+        self._background = self._background.astype(np.uint8)
+    
+    def changed(self, frame:np.ndarray) -> np.ndarray|None:
+        if self._background is None: #no background yet
+            self._background = frame.copy()
+            return None
+        diff = cv2.absdiff(self._background, frame)
+        self.update_background(frame)
+        return diff > self._sensitivity
+
+class RunningAverageEngine(MotionEngine):
+    name = 'average'
+    
+    def __init__(self, shape:tuple[int,int], sensitivity:np.ndarray, background_fade_rate:float) -> None:
+        """Same running average as 'diff' without its rounding down, updated in place in float32 with
+        accumulateWeighted. All the buffers are allocated once"""
+        super().__init__(shape, sensitivity, background_fade_rate)
+        self._alpha = 1/(1+background_fade_rate)
+        self._background = np.zeros(shape, dtype=np.float32)
+        self._background_u8 = np.zeros(shape, dtype=np.uint8)
+        self._diff = np.zeros(shape, dtype=np.uint8)
+        self._changed = np.zeros(shape, dtype=bool)
+        self._empty = True
+    
+    def changed(self, frame:np.ndarray) -> np.ndarray|None:
+        if self._empty:
+            self._background[...] = frame
+            self._empty = False
+            return None
+        cv2.convertScaleAbs(self._background, dst=self._background_u8)
+        cv2.absdiff(self._background_u8, frame, dst=self._diff)
+        cv2.accumulateWeighted(frame, self._background, self._alpha)
+        return np.greater(self._diff, self._sensitivity, out=self._changed)
+
+class BackgroundSubtractorEngine(MotionEngine):
+    #number of checks the background model is learned over
+    HISTORY = 50
+    
+    def __init__(self, shape:tuple[int,int], sensitivity:np.ndarray, background_fade_rate:float) -> None:
+        """OpenCV statistical background subtraction. It has its own per pixel thresholds so the
+        sensitivity of the zones is not used. Shadows are not counted as changes"""
+        super().__init__(shape, sensitivity, background_fade_rate)
+        self._subtractor = self._create()
+        self._mask = np.zeros(shape, dtype=np.uint8)
+        self._changed = np.zeros(shape, dtype=bool)
+        self._empty = True
+    
+    @abstractmethod
+    def _create(self) -> cv2.BackgroundSubtractor:
+        """The OpenCV background subtractor"""
+    
+    def changed(self, frame:np.ndarray) -> np.ndarray|None:
+        self._subtractor.apply(frame, self._mask)
+        if self._empty:
+            self._empty = False
+            return None
+        #255 is foreground, 127 a shadow
+        return np.equal(self._mask, 255, out=self._changed)
+
+class Mog2Engine(BackgroundSubtractorEngine):
+    name = 'mog2'
+    
+    def _create(self) -> cv2.BackgroundSubtractor:
+        return cv2.createBackgroundSubtractorMOG2(history=self.HISTORY, detectShadows=True)
+
+class KnnEngine(BackgroundSubtractorEngine):
+    name = 'knn'
+    
+    def _create(self) -> cv2.BackgroundSubtractor:
+        return cv2.createBackgroundSubtractorKNN(history=self.HISTORY, detectShadows=True)
+
+MOTION_ENGINES:dict[str,type[MotionEngine]] = {e.name:e for e in (FrameDiffEngine, RunningAverageEngine, Mog2Engine, KnnEngine)}
+
 class MotionDetector:
-    def __init__(self, check_area:tuple[tuple[float,float],tuple[float,float]],
-                 shrink_ratio=1/16, background_fade_rate=0.8,
-                 mov_check_every=5, mov_on_frame_amount=0.1) -> None:
-        self._check_area = np.rint(check_area).astype(int)
-        #make sure check area is at least 1px by 1px in size Otherwise possible div by 0 errors
-        for i in range(2):
-            if self._check_area[0][i] == self._check_area[1][i]:
-                self._check_area[0][i] = max(0, self._check_area[0][i]-1)
-                if self._check_area[0][i] == 0:
-                    self._check_area[1][i] += 1
+    MAX_ZONES = 255
+    #peak score (fraction of the threshold) from which checks are made at the fastest rate
+    NEAR_SCORE = 0.5
+    #peak score under which the checks slow down
+    QUIET_SCORE = 0.25
+    
+    def __init__(self, zones:list[MotionZone], resolution:tuple[int,int], background_fade_rate=0.8,
+                 mov_check_every=5, capture_format:CaptureFormat|None=None,
+                 fast_check_every:int|None=None, slow_check_every:int|None=None, engine:str='average') -> None:
+        """Checks any number of zones for motion in a single pass.
+        
+        Only the bounding box of the zones is read, as a grayscale image shrunk to about 60px.
+        Each pixel of that image is labelled with the zone it belongs to (later zones are drawn over
+        earlier ones and exclusion masks over all of them) and holds that zone's sensitivity.
+        A check is then a diff against the background, one comparison with the sensitivity map and
+        one bincount of the labels of the changed pixels, whatever the number of zones.
+        
+        A check is made every `mov_check_every` frames. When a check's scores get close to the threshold
+        or while recording, checks are made every `fast_check_every` frames. On a quiet scene the
+        interval doubles after each quiet check up to `slow_check_every` frames.
+        
+        The background model is one of the MOTION_ENGINES.
+        """
+        height, width = resolution
+        masks = [z for z in zones if z.exclude]
+        zones = [z for z in zones if not z.exclude][:self.MAX_ZONES]
+        self._zones = zones
+        
+        #bounding box of the zones, at least 1px by 1px in size Otherwise possible div by 0 errors
+        corners = np.concatenate([z.polygon(width, height) for z in zones])
+        x0, y0 = np.floor(corners.min(axis=0)).astype(int)
+        x1, y1 = np.ceil(corners.max(axis=0)).astype(int)
+        x0, y0 = min(max(0, x0), width-1), min(max(0, y0), height-1)
+        x1, y1 = min(max(x0+1, x1), width), min(max(y0+1, y1), height)
+        self._rows, self._cols = slice(y0, y1), slice(x0, x1)
+        
         # _shrink_ratio is how much to scale the frame before doing motion detection on: Less pixels = less power needed
         # Here we calculate the shrink ratio to make both the X and Y 60 pix wide/tall and average the two. 
-        self._shrink_ratio = (60/(check_area[1][1] - check_area[0][1]) + 60/(check_area[1][0] - check_area[0][0]))/2
         #we make sure the image is not upscaled (useless just adds noise and more overhead)
-        self._shrink_ratio = min(1, self._shrink_ratio)
-        self._motion_sensitivity = config.MOTION_SENSITIVITY_THRESHOLD
-        self._background = np.zeros((0,0)) #no detected background yet
-        self._background_fade_rate = background_fade_rate
-        self._mov_check_every = mov_check_every
+        self._shrink_ratio = min(1, (60/(x1-x0) + 60/(y1-y0))/2)
+        self._size = (max(1, round((x1-x0)*self._shrink_ratio)), max(1, round((y1-y0)*self._shrink_ratio)))
+        
+        #precompute the label and sensitivity maps at the shrunk resolution
+        scale = (self._size[0]/(x1-x0), self._size[1]/(y1-y0))
+        def to_small(zone:MotionZone):
+            return [np.rint((zone.polygon(width, height) - (x0, y0)) * scale).astype(np.int32)]
+        self._labels = np.zeros((self._size[1], self._size[0]), dtype=np.uint8)
+        self._sensitivity = np.full(self._labels.shape, 255, dtype=np.uint8)
+        for label, zone in enumerate(zones, 1):
+            cv2.fillPoly(self._labels, to_small(zone), label)
+            cv2.fillPoly(self._sensitivity, to_small(zone), zone.sensitivity)
+        for mask in masks:
+            cv2.fillPoly(self._labels, to_small(mask), 0)
+        self._zone_sizes = np.bincount(self._labels.ravel(), minlength=len(zones)+1)[1:]
+        self._thresholds = np.array([z.threshold for z in zones], dtype=np.float64)
+        #number of changed pixels above which each zone has movement
+        self._pixel_thresholds = self._thresholds * self._zone_sizes
+        self._scores = np.zeros(len(zones))
+        
+        if not engine in MOTION_ENGINES:
+            logger.warning(f"Unknown motion engine '{engine}', using '{RunningAverageEngine.name}'")
+            engine = RunningAverageEngine.name
+        self._engine = MOTION_ENGINES[engine](self._labels.shape, self._sensitivity, background_fade_rate)
+        self._small = np.zeros(self._labels.shape, dtype=np.uint8)
+        self._mov_check_every = max(1, int(mov_check_every))
+        self._fast_check_every = self._mov_check_every if fast_check_every is None else max(1, min(self._mov_check_every, int(fast_check_every)))
+        self._slow_check_every = self._mov_check_every if slow_check_every is None else max(self._mov_check_every, int(slow_check_every))
+        self._check_every = self._mov_check_every
         self._frame_check_num = 0
-        self._mov_on_frame_amount = mov_on_frame_amount
-        logger.debug("Starting Motion Detector")
+        self.checks = 0
+        self._format = capture_format or CaptureFormat()
+        logger.debug(f"Starting Motion Detector with {len(zones)} zones and {len(masks)} masks on a {self._size} image"
+                     f" with the '{engine}' engine")
     
     def _gray_and_resize_frame(self, frame:cv2.typing.MatLike) -> cv2.typing.MatLike:
-        #select only the part of the frame to consider
-        frame = frame[self._check_area[0][0]:self._check_area[1][0],
-                      self._check_area[0][1]:self._check_area[1][1],:]
-        frame = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
-        #pass a (0,0) destination size so that it will be auto determined by the shrink ratio
+        #select only the part of the frame to consider (a view on the luma plane for yuv formats)
+        frame = self._format.luma(frame, self._rows, self._cols)
         if self._shrink_ratio == 1:
             return frame #no resize needed
-        return cv2.resize(frame, (0,0), fx=self._shrink_ratio, fy=self._shrink_ratio)
+        return cv2.resize(frame, self._size, dst=self._small)
     
-    def update_background(self, normalized_frame):
-        self._background = self._background * self._background_fade_rate/(1+self._background_fade_rate) + normalized_frame/(1+self._background_fade_rate)
-        self._background = self._background.astype(np.uint8)
+    @property
+    def scores(self) -> dict[str,float]:
+        """Last changed fraction of each zone relative to its threshold (>1 is movement)"""
+        return {z.name or str(i): float(s) for i, (z, s) in enumerate(zip(self._zones, self._scores))}
+    
+    @property
+    def peak_score(self) -> float:
+        """Highest score of the zones at the last check"""
+        return float(self._scores.max()) if len(self._scores) > 0 else 0.0
     
-    def has_movement(self, frame:cv2.typing.MatLike) -> bool:
+    @property
+    def check_every(self) -> int:
+        """Current number of frames between two checks"""
+        return self._check_every
+    
+    def _schedule(self, recording:bool):
+        peak = self._scores.max() if len(self._scores) > 0 else 0
+        if recording or peak >= self.NEAR_SCORE:
+            check_every = self._fast_check_every
+        elif peak >= self.QUIET_SCORE or self._check_every < self._mov_check_every:
+            check_every = self._mov_check_every
+        else:
+            check_every = min(self._slow_check_every, self._check_every*2)
+        if check_every != self._check_every:
+            logger.debug(f"Motion checks every {check_every} frames (peak score {peak:.2f})")
+            self._check_every = check_every
+    
+    @property
+    def engine(self) -> str:
+        return self._engine.name
+    
+    def has_movement(self, frame:cv2.typing.MatLike, recording:bool=False) -> bool:
         #need movement check?
         self._frame_check_num += 1
-        if self._frame_check_num <= self._mov_check_every:
+        if recording and self._check_every > self._fast_check_every:
+            self._check_every = self._fast_check_every
+        if self._frame_check_num < self._check_every:
             return False #no check
         self._frame_check_num = 0
-        
+        self.checks += 1
+        MOTION_CHECKS.inc()
+        start = perf_counter()
+        try:
+            return self._check(frame, recording)
+        finally:
+            MOTION_CHECK_SECONDS.observe(perf_counter() - start)
+    
+    def _check(self, frame:cv2.typing.MatLike, recording:bool) -> bool:
         frame = self._gray_and_resize_frame(frame)
-        if self._background.shape[0] == 0: #no background yet
-            self._background = frame
+        changed = self._engine.changed(frame)
+        if changed is None: #no background yet
             return False
         
-        diff = cv2.absdiff(self._background, frame)
-        self.update_background(frame)
-        _,diff = cv2.threshold(diff, self._motion_sensitivity, 255, cv2.THRESH_BINARY)
-        num_pixels_theshold = self._mov_on_frame_amount*diff.shape[0]*diff.shape[1]
-        nonZero = cv2.countNonZero(diff)
-        if nonZero > num_pixels_theshold/2 and not nonZero > num_pixels_theshold:
-            logging.debug(f"Motion check 1/2-MVNT {nonZero}/{num_pixels_theshold}")
-        if nonZero > num_pixels_theshold:
-            logging.debug(f"Motion check MOVEMENT {nonZero}/{num_pixels_theshold}")
+        #pixels changed by more than the sensitivity of their zone, counted per zone in one pass
+        changed = np.bincount(self._labels[changed], minlength=len(self._zones)+1)[1:]
+        self._scores = changed / np.maximum(self._pixel_thresholds, 1e-9)
+        self._scores[self._zone_sizes == 0] = 0
+        self._schedule(recording)
+        if (self._scores > 1).any():
+            logging.debug(f"Motion check MOVEMENT {self.scores}")
+            MOTION_DETECTED.inc()
             return True
-        logging.debug(f"Motion check nothing: {nonZero}/{num_pixels_theshold}")
+        if (self._scores > 0.5).any():
+            logging.debug(f"Motion check 1/2-MVNT {self.scores}")
+        else:
+            logging.debug(f"Motion check nothing: {self.scores}")
         return False
 
 class CamInterface:
@@ -223,6 +1676,7 @@ class CamInterface:
         # logger.debug(f"Starting CamInterface on {settings.VID_CAMERA_DEVICE} with options: {options}")
         logger.debug("Starting CamInterface with CV2 v4l2")
         self._inner_gen = None
+        self._format = CaptureFormat()
         self._start_cam()
         
         frame = self._frame_generator.__next__()
@@ -234,7 +1688,7 @@ class CamInterface:
         self._fps = int(math.ceil(frame_setup_count/(perf_counter()-start)))
 
         logger.debug(f"Read {frame_setup_count} frames in {(perf_counter()-start)} seconds for {self._fps} fps")
-        self._resolution = frame.shape[:2]
+        self._resolution = self._format.resolution(frame)
         logger.debug(f"CamInterface started with resolution {self._resolution} and {self._fps} FPS")
         
     def get_next_frame(self):
@@ -242,23 +1696,27 @@ class CamInterface:
     
     def _start_cam(self):
         if settings.DEVICE_DUPLICATION.lower() == 'socket':
-            self._camera = FrameConsumer()
+            #the recorder must not lose frames: have the publisher wait for it
+            self._camera = FrameConsumer(policy='block', max_queue=4)
+        elif settings.DEVICE_DUPLICATION.lower() == 'shm':
+            #frames are read-only views into shared memory, they are copied out below
+            self._camera = SharedFrameConsumer(policy='block', max_queue=max(1, settings.FRAME_BUS_SLOTS//2))
         else:
-            self._camera = cv2.VideoCapture(settings.VID_CAMERA_DEVICE, cv2.CAP_V4L2)
-            try:
-                width, height = str(config.VID_RESOLUTION).split('x',1)
-                self._camera.set(cv2.CAP_PROP_FRAME_WIDTH, int(width))
-                self._camera.set(cv2.CAP_PROP_FRAME_HEIGHT, int(height))
-            except: pass
+            self._camera = open_video_capture(settings.VID_CAMERA_DEVICE)
     
     def _get_frame_gen(self):
         try:
             while 1:
                 if self._camera is None:
                     self._start_cam()
-                check, frame = self._camera.read()
+                start = perf_counter()
+                check, frame = self._format.read(self._camera)
                 if check:
-                    yield cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                    CAPTURE_SECONDS.observe(perf_counter() - start)
+                    FRAMES_CAPTURED.inc()
+                    #frames are kept in the capture format, no color conversion here.
+                    #A read-only frame is a view in shared memory, copy it since it is buffered
+                    yield frame if frame.flags.writeable else frame.copy()
                 else:
                     logger.info("Camera issue. Stopping recorder")
                     break
@@ -274,6 +1732,10 @@ class CamInterface:
             self._inner_gen = self._get_frame_gen()
         return self._inner_gen
     
+    @property
+    def capture_format(self) -> CaptureFormat:
+        return self._format
+    
     @property
     def frame_rate(self):
         return self._fps
@@ -287,36 +1749,160 @@ class CamInterface:
             self._camera.release()
             self._camera = None
         
+class SyntheticScene:
+    NOISE_FRAMES = 8
+    
+    def __init__(self, width:int, height:int, frames:int, seed:int=0) -> None:
+        """A still scene with sensor noise and a slow lighting change over `frames` frames, with a "bird"
+        of about twice the default detection threshold crossing it twice. `visits` are the frame ranges
+        of the bird's visits"""
+        rng = np.random.default_rng(seed)
+        x = np.linspace(60, 180, width, dtype=np.float32)
+        y = np.linspace(0, 40, height, dtype=np.float32)[:,None]
+        self._scene = x + y
+        #a few noise images used in turn, generating noise for each frame would be slower than the pipeline
+        self._noise = [rng.normal(0, 4, (height, width)).astype(np.float32) for _ in range(self.NOISE_FRAMES)]
+        self._size = min(width, height, int((0.15*width*height)**0.5))
+        self.width, self.height, self.frames = width, height, frames
+        self.visits = [(frames//5, frames//5 + frames//10), (frames//2, frames//2 + frames//20)]
+    
+    def frame(self, i:int) -> np.ndarray:
+        """The BGR frame `i`"""
+        frame = self._scene + 25*np.sin(2*np.pi*i/max(1, self.frames)) + self._noise[i % len(self._noise)]
+        for start, end in self.visits:
+            if start <= i < end:
+                x = int((i-start)/(end-start)*(self.width-self._size))
+                y = self.height//3 + int(self.height/6*np.sin(i/5))
+                frame[y:y+self._size, x:x+self._size] = 30
+        return cv2.cvtColor(np.clip(frame, 0, 255).astype(np.uint8), cv2.COLOR_GRAY2BGR)
+
+class ReplayCamInterface(CamInterface):
+    def __init__(self, video:str|None=None, resolution:tuple[int,int]=(400,640), fps:float|None=None,
+                 frames:int=0, realtime:bool=True, preload:bool=False) -> None:
+        """Replays a video file, or a SyntheticScene of `frames` frames at `resolution` (height, width), in
+        place of the camera. In real time the frames that are due while the recorder is still busy are
+        skipped and counted in `dropped`, as a camera would drop them. Otherwise frames are read as fast
+        as they are consumed. With `preload` the video is decoded before the replay starts"""
+        self._inner_gen = None
+        self._camera = None
+        self._format = CaptureFormat('bgr')
+        self._video = video
+        self._realtime = realtime
+        self._frames = frames
+        self._scene = None
+        self._preloaded = None
+        self.dropped = 0
+        self.frames_read = 0
+        if video is None:
+            self._scene = SyntheticScene(resolution[1], resolution[0], frames or 900)
+            self._fps = fps or 30
+            self._resolution = tuple(resolution)
+        else:
+            with av.open(video) as container:
+                stream = container.streams.video[0]
+                self._fps = fps or float(stream.average_rate or 30)
+                self._resolution = (stream.codec_context.height, stream.codec_context.width)
+            if preload:
+                self._preloaded = list(self._source())
+        logger.debug(f"Replaying {video or 'a synthetic scene'} at {self._resolution} and {self._fps} fps")
+    
+    def _source(self):
+        if not self._preloaded is None:
+            yield from self._preloaded
+        elif not self._scene is None:
+            for i in range(self._scene.frames):
+                yield self._scene.frame(i)
+        else:
+            with av.open(self._video) as container:
+                for i, frame in enumerate(container.decode(video=0)):
+                    if self._frames > 0 and i >= self._frames:
+                        break
+                    yield frame.to_ndarray(format='bgr24')
+    
+    @property
+    def visits(self) -> list[tuple[int,int]]|None:
+        """Frame ranges with movement of a synthetic scene"""
+        return None if self._scene is None else self._scene.visits
+    
+    def _get_frame_gen(self):
+        start = perf_counter()
+        for i, frame in enumerate(self._source()):
+            if self._realtime:
+                due = start + i/self._fps
+                now = perf_counter()
+                if now < due:
+                    sleep(due - now)
+                elif now - due > 1/self._fps:
+                    self.dropped += 1
+                    DROPPED_CAMERA.inc()
+                    continue
+            self.frames_read += 1
+            FRAMES_CAPTURED.inc()
+            yield frame
+    
+    def get_next_frame(self):
+        #None once the replay is over
+        return next(self._frame_generator, None)
+    
+    def close(self):
+        self._inner_gen = None
+
 class CapAndRecord(Interruptable):
     def __init__(self, movement_check=0.5, after_movement=3, before_movement=3, motion_threshold=0.07,
-                 cam_options=None) -> None:
+                 cam_options=None, fast_movement_check=None, slow_movement_check=None,
+                 cam:CamInterface|None=None) -> None:
         if cam_options is None:
             cam_options = {}
-        self._cam = CamInterface(options=cam_options)
-        self._check_area = (
-            (config.MOTION_DETECT_AREA_TL_X*self._cam.resolution[0]/100.0,
-             config.MOTION_DETECT_AREA_TL_Y*self._cam.resolution[1]/100.0),
-            
-            (config.MOTION_DETECT_AREA_BR_X*self._cam.resolution[0]/100.0,
-             config.MOTION_DETECT_AREA_BR_Y*self._cam.resolution[1]/100.0)
-        )
+        #start the encoder processes before any other thread is running
+        self._preroll = None
+        self._segments = None
+        self._thumbnails = ThumbnailWriter()
+        self._previews = PreviewWriter()
+        self._retention = RetentionManager()
+        if settings.VID_RECORDING_MODE.lower() == 'segments':
+            #movements are time ranges in the continuous recording
+            self._segments = SegmentRecorder(before_movement, settings.VID_ENCODER_BUFFER_FRAMES, self._thumbnails,
+                                             self._previews, self._retention)
+            self._encoder_pool = EncoderPool(0)
+        elif settings.VID_PREROLL_MODE.lower() == 'packets':
+            #clips are cut from the continuously encoded stream, the pool isn't needed
+            self._preroll = PrerollEncoder(before_movement, settings.VID_ENCODER_BUFFER_FRAMES)
+            self._encoder_pool = EncoderPool(0)
+        else:
+            self._encoder_pool = EncoderPool(settings.VID_ENCODER_PROCESSES, settings.VID_ENCODER_BUFFER_FRAMES)
+        self._closing_writers:list[VideoWriter] = []
+        self._cam = cam or CamInterface(options=cam_options)
         self._capThread = Thread(target=self._run, daemon=False)
         super().__init__(self._capThread)
         self._frame_movement_check = self._cam.frame_rate*movement_check
+        #adaptive check rate bounds, in frames
+        self._frame_fast_movement_check = None if fast_movement_check is None else self._cam.frame_rate*fast_movement_check
+        self._frame_slow_movement_check = None if slow_movement_check is None else self._cam.frame_rate*slow_movement_check
+        self._motion:MotionDetector|None = None
         self._record_n_frames_without_movement = self._cam.frame_rate*after_movement
-        self._frame_ring_buffer = deque(maxlen=int(self._cam.frame_rate*before_movement))
+        self._frame_ring_buffer = deque(maxlen=0 if self._preroll or self._segments else int(self._cam.frame_rate*before_movement))
         self._motion_threshold = motion_threshold
+        self._zones = MotionZone.from_config(default_threshold=motion_threshold)
+        metrics.gauge('birdwatcher_capture_fps', "Frame rate of the camera", function=lambda: self._cam.frame_rate)
+        metrics.gauge('birdwatcher_motion_checks_per_second', "Current rate of the adaptive motion checks",
+                      function=lambda: self.motion_checks_per_second)
         logger.debug(f"Motion Detection and capture created: Check every {self._frame_movement_check} frames")
     
     def _run(self):
         try:
             logger.info("Motion Detection and Capture starting")
-            motion = MotionDetector(self._check_area,
-                                    shrink_ratio=max(0.001,min(100/max(self._check_area[1][0]-self._check_area[0][0], self._check_area[1][1]-self._check_area[1][0]),1)),
-                                    mov_on_frame_amount=self._motion_threshold,
-                                    mov_check_every=int(self._frame_movement_check))
+            motion = MotionDetector(self._zones, self._cam.resolution,
+                                    mov_check_every=int(self._frame_movement_check),
+                                    capture_format=self._cam.capture_format,
+                                    fast_check_every=self._frame_fast_movement_check,
+                                    slow_check_every=self._frame_slow_movement_check,
+                                    engine=config.MOTION_ENGINE)
+            self._motion = motion
             writer = None
+            event = None
             frames_without_motion = 0
+            #the thumbnail of a movement is the frame of its highest motion score
+            thumbnail_frame, thumbnail_score = None, 0.0
             
             frame = self._cam.get_next_frame()
             frame_path = str(path.join(settings.STATICFILES_DIRS[0], "single_frame.webp"))
@@ -325,45 +1911,114 @@ class CapAndRecord(Interruptable):
             except:
                 pass
             cv2.imwrite(frame_path,
-                        cv2.cvtColor(frame, cv2.COLOR_BGR2RGB),
+                        self._cam.capture_format.to_bgr(frame),
                         [cv2.IMWRITE_WEBP_QUALITY, 95])
             
             while not self.is_interrupted:
                 frame = self._cam.get_next_frame()
+                start = perf_counter()
                 frames_without_motion -= 1
                 if frame is None:
                     raise EOFError('Camera interface is closed')
-                self._frame_ring_buffer.append(frame)
-                #on every nth frame check for movement
-                if motion.has_movement(frame):
+                if not self._segments is None:
+                    self._segments.write(frame, self._cam.frame_rate, self._cam.capture_format)
+                elif not self._preroll is None:
+                    self._preroll.write(frame, self._cam.frame_rate, self._cam.capture_format)
+                else:
+                    self._frame_ring_buffer.append(frame)
+                #check for movement at a rate depending on recent scores, faster while recording
+                checks = motion.checks
+                if motion.has_movement(frame, recording=frames_without_motion > 0):
                     frames_without_motion = self._record_n_frames_without_movement
-                        
+                if frames_without_motion > 0 and motion.checks > checks and (
+                        thumbnail_frame is None or motion.peak_score > thumbnail_score):
+                    #copied, frames from the frame bus are overwritten after a few frames
+                    thumbnail_frame, thumbnail_score = frame.copy(), motion.peak_score
+                    if not writer is None:
+                        writer.set_thumbnail(thumbnail_frame)
+                
+                if not self._segments is None:
+                    #the frames are already recorded, only the time range of the movement is kept
+                    if frames_without_motion > 0 and event is None:
+                        self._retention.check_space()
+                        event = self._segments.start_event(get_datetime_local())
+                    elif frames_without_motion <= 0 and not event is None:
+                        self._segments.end_event(event, get_datetime_local(), thumbnail_frame, self._cam.capture_format)
+                        event = None
+                        thumbnail_frame = None
                 #motion detected within frame limit
-                if frames_without_motion > 0:
+                elif frames_without_motion > 0:
                     if writer is None:
+                        self._retention.check_space()
                         localtime = get_datetime_local()
                         writer = VideoWriter(localtime.strftime("%Y-%m-%d_%H-%M-%S.mp4"),
                                              creation_time=localtime,
                                             initial=list(self._frame_ring_buffer),
                                             fps=self._cam.frame_rate,
                                             height=self._cam.resolution[0],
-                                            width=self._cam.resolution[1])
+                                            width=self._cam.resolution[1],
+                                            capture_format=self._cam.capture_format,
+                                            encoder_pool=self._encoder_pool,
+                                            preroll=self._preroll,
+                                            thumbnails=self._thumbnails,
+                                            previews=self._previews,
+                                            retention=self._retention)
+                        if not thumbnail_frame is None:
+                            writer.set_thumbnail(thumbnail_frame)
                         # self._frame_ring_buffer.clear()
                     writer.write_frame(frame)
                 elif not writer is None: #otherwise close writer if open
                     logger.debug(f"No motion detected for {frames_without_motion}. Stopping writer")
-                    writer.close()
+                    #do not wait for the end of the encoding, keep capturing
+                    writer.close(wait=False)
+                    self._closing_writers = [w for w in self._closing_writers if not w.done] + [writer]
                     writer = None
+                    thumbnail_frame = None
+                RECORDING.set(int(frames_without_motion > 0))
+                FRAME_SECONDS.observe(perf_counter() - start)
+        except EOFError:
+            logger.info("No more frames from the camera")
         except:
             logger.exception("Error in CapAndRecord")
         finally:
+            RECORDING.set(0)
             #flush and close all
             if not writer is None:
-                writer.close()
+                writer.close(wait=False)
+                self._closing_writers.append(writer)
+            if not event is None:
+                self._segments.end_event(event, get_datetime_local(), thumbnail_frame, self._cam.capture_format)
+            if not self._segments is None:
+                self._segments.close()
+            if not self._preroll is None:
+                #the last frames are still in the encoder, the open clip only ends once they are flushed
+                self._preroll.stop()
+            for closing_writer in self._closing_writers:
+                closing_writer.close()
+            self._encoder_pool.close()
+            if not self._preroll is None:
+                self._preroll.close()
+            self._thumbnails.close()
+            self._previews.close()
+            self._retention.close()
+            #the writes of all the others
+            self._db_writer.close()
             self._cam.close()
             logger.info("Motion Detection and Capture Thread stopping")
             
+    @property
+    def motion_checks_per_second(self) -> float:
+        """Current rate of the adaptive motion checks"""
+        if self._motion is None:
+            return 0.0
+        return self._cam.frame_rate/self._motion.check_every
+    
     def start(self):
+        #threads of their own, after the encoder processes
+        self._db_writer = DatabaseWriter.getSingleton()
+        self._thumbnails.start()
+        self._previews.start()
+        self._retention.start()
         self._capThread.start()
 
     def stop(self):
@@ -388,9 +2043,13 @@ class Command(BaseCommand):
         c = CapAndRecord(cam_options={"input_format":settings.VID_INPUT_FORMAT,
                                     "videosize":config.VID_RESOLUTION, **cam_options},
                         movement_check=1.0/config.MOTION_CHECKS_PER_SECOND,
+                        fast_movement_check=1.0/config.MOTION_MAX_CHECKS_PER_SECOND if config.MOTION_MAX_CHECKS_PER_SECOND > 0 else 0,
+                        slow_movement_check=1.0/config.MOTION_MIN_CHECKS_PER_SECOND if config.MOTION_MIN_CHECKS_PER_SECOND > 0 else None,
                         before_movement=config.RECORD_SECONDS_BEFORE_MOVEMENT,
                         after_movement=config.RECORD_SECONDS_AFTER_MOVEMENT,
                         motion_threshold=config.MOTION_DETECTION_THRESHOLD)
+        #after the encoder processes are started
+        serve_metrics()
         #register sigterm signal handler
         signal.signal(signal.SIGTERM, lambda *a, **kw : c.stop())
         c.start()
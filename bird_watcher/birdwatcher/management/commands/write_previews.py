@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.core.management import BaseCommand
+from birdwatcher.management.commands.watch_motion import PreviewWriter
+from birdwatcher.models import Video
+from birdwatcher.utils import setup_logging
+from pathlib import Path
+from time import perf_counter
+
+class Command(BaseCommand):
+    help = ("Writes the hover previews of the videos that don't have one, like the videos recorded before previews "
+            "existed. The recorder writes them for new videos")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=None, help="Maximum number of videos, the newest first")
+
+    def handle(self, *args, **options):
+        setup_logging()
+        Path(settings.MEDIA_ROOT).joinpath(settings.THUMBNAIL_DIRECTORY).mkdir(0o755, True, True)
+        pks = list(Video.objects.filter(preview_tiles=0).order_by('-date_created', '-id').values_list('pk', flat=True)[:options['limit']])
+        writer = PreviewWriter()
+        written, failed = 0, 0
+        start = perf_counter()
+        for pk in pks:
+            try:
+                if writer.write(Video(pk=pk)):
+                    written += 1
+                else:
+                    failed += 1
+            except Exception as e:
+                failed += 1
+                self.stderr.write(f"Video {pk}: {e}")
+        self.stdout.write(f"Wrote {written} previews in {perf_counter() - start:.1f}s, {failed} videos without one")
@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:59
+
+import birdwatcher.utils
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('birdwatcher', '0003_video_title'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Segment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('segment_file', models.FilePathField(path='segments')),
+                ('start', models.DateTimeField(db_index=True)),
+                ('end', models.DateTimeField(db_index=True)),
+                ('num_frames', models.IntegerField()),
+                ('framerate', models.FloatField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='video',
+            name='event_end',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='video',
+            name='event_start',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AlterField(
+            model_name='video',
+            name='date_created',
+            field=models.DateTimeField(auto_created=True, default=birdwatcher.utils.get_datetime_local, editable=False),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('birdwatcher', '0004_segments'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='video',
+            index=models.Index(fields=['-date_created', '-id'], name='video_newest_idx'),
+        ),
+    ]
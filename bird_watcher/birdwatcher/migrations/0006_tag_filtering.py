@@ -0,0 +1,67 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:24
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def merge_duplicate_tags(apps, schema_editor):
+    """Normalizes tag names and merges the tags with the same name, before they are made unique"""
+    Tag = apps.get_model('birdwatcher', 'Tag')
+    VideoTags = apps.get_model('birdwatcher', 'Video').tags.through
+    kept = {}
+    for tag in Tag.objects.order_by('pk'):
+        name = ' '.join(tag.name.split()).title()
+        if not name in kept:
+            kept[name] = tag
+            if tag.name != name:
+                tag.name = name
+                tag.save()
+            continue
+        keep = kept[name]
+        tagged = set(VideoTags.objects.filter(tag_id=keep.pk).values_list('video_id', flat=True))
+        for video_id in VideoTags.objects.filter(tag_id=tag.pk).values_list('video_id', flat=True):
+            if not video_id in tagged:
+                VideoTags.objects.create(video_id=video_id, tag_id=keep.pk)
+        tag.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('birdwatcher', '0005_video_newest_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_tags, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='tag',
+            name='name',
+            field=models.CharField(max_length=32, unique=True),
+        ),
+        # Video.tags keeps its table, only declared as a model
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='VideoTag',
+                    fields=[
+                        ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                        ('tag', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='birdwatcher.tag')),
+                        ('video', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='birdwatcher.video')),
+                    ],
+                    options={
+                        'db_table': 'birdwatcher_video_tags',
+                        'unique_together': {('video', 'tag')},
+                    },
+                ),
+                migrations.AlterField(
+                    model_name='video',
+                    name='tags',
+                    field=models.ManyToManyField(default=[], related_name='videos', through='birdwatcher.VideoTag', to='birdwatcher.tag'),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='videotag',
+            index=models.Index(fields=['tag', 'video'], name='videotag_tag_video_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('birdwatcher', '0006_tag_filtering'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='video',
+            name='thumbnail_avif',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='video',
+            name='thumbnail_widths',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
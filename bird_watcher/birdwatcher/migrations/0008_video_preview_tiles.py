@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('birdwatcher', '0007_video_thumbnail_variants'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='video',
+            name='preview_tiles',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+    ]
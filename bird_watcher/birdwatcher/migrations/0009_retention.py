@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('birdwatcher', '0008_video_preview_tiles'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='segment',
+            name='file_size',
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='video',
+            name='file_size',
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='video',
+            name='starred',
+            field=models.BooleanField(default=False),
+        ),
+    ]
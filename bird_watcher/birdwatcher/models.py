@@ -1,24 +1,127 @@
 from django.db import models
 from django.conf import settings
 from birdwatcher.utils import get_datetime_local
+from time import monotonic
+import os
 
 class Tag(models.Model):
-    name = models.CharField(max_length=32)
+    #always normalized, see normalize_name
+    name = models.CharField(max_length=32, unique=True)
     #videos = related_name
+    #names of all tags shown on every page and when they were loaded, dropped when a tag is saved or deleted.
+    #Other processes change tags too so they are reloaded after NAMES_MAX_AGE seconds
+    _names:tuple[float, list[str]]|None = None
+    NAMES_MAX_AGE = 60
+    
+    @staticmethod
+    def normalize_name(name:str) -> str:
+        return ' '.join(name.split()).title()
     
     def save(self, *args, **kwargs):
-        self.name = self.name.title()
+        self.name = Tag.normalize_name(self.name)
         super().save(*args ,**kwargs)
     
+    @classmethod
+    def all_names(cls) -> list[str]:
+        names = cls._names
+        if names is None or monotonic() - names[0] > cls.NAMES_MAX_AGE:
+            names = (monotonic(), list(cls.objects.order_by('name').values_list('name', flat=True)))
+            cls._names = names
+        return names[1]
+    
+    @classmethod
+    def forget_names(cls):
+        cls._names = None
+    
 class Video(models.Model):
     video_file = models.FilePathField(path=settings.VIDEOS_DIRECTORY)
     thumbnail_file = models.ImageField(upload_to=settings.THUMBNAIL_DIRECTORY, blank=True)
+    #widths of the smaller copies of the thumbnail, next to it as <name>-<width>.webp (and .avif)
+    thumbnail_widths = models.CharField(max_length=64, blank=True, default='')
+    #whether there are AVIF copies of the thumbnail too
+    thumbnail_avif = models.BooleanField(default=False)
+    #frames in the hover preview sprite, 0 until it is written. See preview_url and preview_index_url
+    preview_tiles = models.PositiveSmallIntegerField(default=0)
     num_frames = models.IntegerField()
     framerate = models.FloatField()
     date_created = models.DateTimeField(auto_created=True, default=get_datetime_local, editable=False)
-    tags = models.ManyToManyField(Tag, related_name='videos', default=[])
+    tags = models.ManyToManyField(Tag, related_name='videos', default=[], through='VideoTag')
     title = models.TextField(null=False, blank=False, default="temporary_title")
+    #with segmented recording, the time range of the motion event in the segments.
+    #The video file is only written from the segments when it is first played
+    event_start = models.DateTimeField(null=True, blank=True, editable=False)
+    event_end = models.DateTimeField(null=True, blank=True, editable=False)
+    #starred videos, like tagged ones, are never deleted by the retention
+    starred = models.BooleanField(default=False)
+    #bytes of the video file, or of its segments until the file is written. None while it is recorded
+    file_size = models.BigIntegerField(null=True, blank=True, editable=False)
+    
+    class Meta:
+        #the video list pages through videos from the newest
+        indexes = [models.Index(fields=['-date_created', '-id'], name='video_newest_idx')]
     
     @property
     def thumbnail_url(self):
-        return "/"+self.thumbnail_file.name
\ No newline at end of file
+        return "/"+self.thumbnail_file.name
+    
+    def _thumbnail_variants(self, extension:str) -> list[tuple[str,int]]:
+        base = self.thumbnail_file.name.rsplit('.', 1)[0]
+        return [(f"{base}-{w}.{extension}", int(w)) for w in self.thumbnail_widths.split(',') if w]
+    
+    @property
+    def thumbnail_srcset(self) -> str:
+        return ", ".join(f"/{name} {width}w" for name, width in self._thumbnail_variants('webp'))
+    
+    @property
+    def thumbnail_avif_srcset(self) -> str:
+        if not self.thumbnail_avif:
+            return ""
+        return ", ".join(f"/{name} {width}w" for name, width in self._thumbnail_variants('avif'))
+    
+    @property
+    def preview_name(self) -> str:
+        #the sprite is <name>.webp and its keyframe index <name>.json
+        return f"{settings.THUMBNAIL_DIRECTORY}/{str(self.pk).rjust(7,'0')}-preview"
+    
+    @property
+    def preview_url(self) -> str|None:
+        return f"/{self.preview_name}.webp" if self.preview_tiles > 0 else None
+    
+    @property
+    def preview_index_url(self) -> str|None:
+        return f"/{self.preview_name}.json" if self.preview_tiles > 0 else None
+    
+    @property
+    def thumbnail_files(self) -> list[str]:
+        """Paths of all the files of the thumbnail and the hover preview"""
+        names = []
+        if self.thumbnail_file:
+            names += [self.thumbnail_file.name] + [n for n, _ in self._thumbnail_variants('webp')]
+        if self.thumbnail_file and self.thumbnail_avif:
+            names += [self.thumbnail_file.name.rsplit('.', 1)[0]+'.avif'] + [n for n, _ in self._thumbnail_variants('avif')]
+        if self.preview_tiles > 0:
+            names += [self.preview_name+'.webp', self.preview_name+'.json']
+        return [os.path.join(settings.MEDIA_ROOT, n) for n in names]
+    
+    @property
+    def files(self) -> list[str]:
+        """Paths of all the files of the video, its segments excepted"""
+        return [self.video_file] + self.thumbnail_files
+
+class VideoTag(models.Model):
+    #the table of Video.tags, declared to index it by tag for filtering videos by tag
+    video = models.ForeignKey(Video, on_delete=models.CASCADE)
+    tag = models.ForeignKey(Tag, on_delete=models.CASCADE)
+    
+    class Meta:
+        db_table = 'birdwatcher_video_tags'
+        unique_together = [('video', 'tag')]
+        indexes = [models.Index(fields=['tag', 'video'], name='videotag_tag_video_idx')]
+
+class Segment(models.Model):
+    segment_file = models.FilePathField(path=settings.SEGMENTS_DIRECTORY)
+    start = models.DateTimeField(db_index=True)
+    end = models.DateTimeField(db_index=True)
+    num_frames = models.IntegerField()
+    framerate = models.FloatField()
+    file_size = models.BigIntegerField(null=True, blank=True, editable=False)
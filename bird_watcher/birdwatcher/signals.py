@@ -1,7 +1,19 @@
 from django.dispatch import receiver
+from django.db.models.signals import post_save, post_delete
 from constance.signals import config_updated
-from birdwatcher.utils import start_or_restart_birdwatcher, watcher_is_running
+from birdwatcher.models import Video, Tag
+from birdwatcher.utils import start_or_restart_birdwatcher, watcher_is_running, VideoFileCache
 from django.conf import settings
 import logging
 
 logger = logging.getLogger(settings.PROJECT_NAME)
+
+@receiver(post_save, sender=Video)
+@receiver(post_delete, sender=Video)
+def forget_video_file(sender, instance:Video, **kwargs):
+    VideoFileCache.getSingleton().invalidate(instance.pk)
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+def forget_tag_names(sender, **kwargs):
+    Tag.forget_names()
@@ -1,3 +1,191 @@
-from django.test import TestCase
-
-# Create your tests here.
+from django.db import IntegrityError, transaction
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from datetime import datetime, timedelta, timezone
+from fastapi import HTTPException
+from json import dumps
+from tempfile import TemporaryDirectory
+from unittest import mock
+from birdwatcher.models import Video, VideoTag, Tag
+from birdwatcher.utils import FileRemover
+from birdwatcher.views import VideoListView, SingleVideoView, BulkVideosView, videos_page, list_videos, filter_videos, tag_counts
+import asyncio, os
+
+def make_video(date_created:datetime, **kwargs) -> Video:
+    #dates are stored in local time, as if it were UTC
+    return Video.objects.create(video_file=f"/videos/{date_created.isoformat()}.mp4", num_frames=30, framerate=30,
+                                date_created=date_created.replace(tzinfo=timezone.utc), **kwargs)
+
+class VideoPageTests(TestCase):
+    def setUp(self):
+        start = datetime(2024, 5, 1, 12)
+        self.videos = [make_video(start + timedelta(minutes=i)) for i in range(5)]
+        #same date as the newest, the id breaks the tie
+        self.videos.append(make_video(start + timedelta(minutes=4)))
+        self.newest_first = sorted(self.videos, key=lambda v: (v.date_created, v.pk), reverse=True)
+
+    def test_pages_go_through_all_videos_once(self):
+        seen, cursor = [], None
+        for _ in range(len(self.videos)):
+            page, cursor = videos_page(Video.objects.all(), cursor, 2)
+            seen += page
+            if cursor is None:
+                break
+        self.assertEqual(seen, self.newest_first)
+        self.assertIsNone(cursor)
+
+    def test_full_last_page_has_no_next_cursor(self):
+        page, cursor = videos_page(Video.objects.all(), None, len(self.videos))
+        self.assertEqual(len(page), len(self.videos))
+        self.assertIsNone(cursor)
+        page, cursor = videos_page(Video.objects.all(), None, len(self.videos)-1)
+        self.assertIsNotNone(cursor)
+        self.assertEqual(videos_page(Video.objects.all(), cursor, 10)[0], self.newest_first[-1:])
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(ValueError):
+            videos_page(Video.objects.all(), "not a cursor", 2)
+
+    def test_list_view_pages(self):
+        with mock.patch.object(VideoListView, 'page_size', 4):
+            response = self.client.get(reverse(VideoListView.url_name))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(list(response.context['video_list']), self.newest_first[:4])
+            cursor = response.context['next_cursor']
+            response = self.client.get(reverse(VideoListView.url_name), {'cursor':cursor})
+            self.assertEqual(list(response.context['video_list']), self.newest_first[4:])
+            self.assertIsNone(response.context['next_cursor'])
+
+    def test_list_view_invalid_cursor(self):
+        response = self.client.get(reverse(VideoListView.url_name), {'cursor':'garbage'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_api_invalid_cursor(self):
+        with self.assertRaises(HTTPException) as raised:
+            asyncio.run(list_videos(cursor='garbage', tag=[]))
+        self.assertEqual(raised.exception.status_code, 400)
+
+class TagFilterTests(TestCase):
+    def setUp(self):
+        Tag.forget_names()
+        self.robin, self.tit, self.wren = [Tag.objects.create(name=n) for n in ('Robin', 'Tit', 'Wren')]
+        self.both = make_video(datetime(2024, 5, 1, 8))
+        self.only_robin = make_video(datetime(2024, 5, 1, 23, 30))
+        self.untagged = make_video(datetime(2024, 5, 2, 0, 0))
+        for video, tags in ((self.both, (self.robin, self.tit)), (self.only_robin, (self.robin,))):
+            for tag in tags:
+                VideoTag.objects.create(video=video, tag=tag)
+
+    def _filter(self, *args, **kwargs) -> set[Video]:
+        return set(filter_videos(Video.objects.all(), *args, **kwargs))
+
+    def test_tag_names_are_normalized_and_unique(self):
+        self.assertEqual(Tag.objects.create(name="  blue   tit ").name, "Blue Tit")
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Tag.objects.create(name="blue TIT")
+
+    def test_match_all_and_any(self):
+        self.assertEqual(self._filter(['robin', 'tit']), {self.both})
+        self.assertEqual(self._filter(['robin', 'tit'], 'any'), {self.both, self.only_robin})
+        self.assertEqual(self._filter([' ROBIN ']), {self.both, self.only_robin})
+        self.assertEqual(self._filter(['wren']), set())
+        with self.assertRaises(ValueError):
+            self._filter(['robin'], 'some')
+
+    def test_before_a_day_includes_the_whole_day(self):
+        self.assertEqual(self._filter(before='2024-05-01'), {self.both, self.only_robin})
+        self.assertEqual(self._filter(before='2024-05-01T08:00:00'), {self.both})
+        self.assertEqual(self._filter(after='2024-05-02'), {self.untagged})
+        self.assertEqual(self._filter(after='2024-05-01', before='2024-05-01'), {self.both, self.only_robin})
+        with self.assertRaises(ValueError):
+            self._filter(before='yesterday')
+
+    def test_tag_counts(self):
+        self.assertEqual(tag_counts(), [('Robin', 2), ('Tit', 1), ('Wren', 0)])
+        self.assertEqual(tag_counts(after='2024-05-01T12:00:00'), [('Robin', 1), ('Tit', 0), ('Wren', 0)])
+
+    def test_list_view_filters(self):
+        response = self.client.get(reverse(VideoListView.url_name), {'tag':['Robin', 'Tit'], 'match':'any',
+                                                                     'before':'2024-05-01'})
+        self.assertEqual(set(response.context['video_list']), {self.both, self.only_robin})
+        self.assertIn(('Robin', 2, True), response.context['tag_counts'])
+        for invalid in ({'match':'some'}, {'after':'tomorrow'}):
+            self.assertEqual(self.client.get(reverse(VideoListView.url_name), invalid).status_code, 400)
+
+class BulkVideosTests(TestCase):
+    def setUp(self):
+        Tag.forget_names()
+        self.robin = Tag.objects.create(name='Robin')
+        self.videos = [make_video(datetime(2024, 5, day, 12)) for day in (1, 2, 3)]
+        VideoTag.objects.create(video=self.videos[0], tag=self.robin)
+
+    def _post(self, data, status=200):
+        body = data if isinstance(data, str) else dumps(data)
+        response = self.client.post(reverse(BulkVideosView.url_name), body, content_type='application/json')
+        self.assertEqual(response.status_code, status, response.content)
+        return response.json()
+
+    def _pks(self, videos) -> list[int]:
+        return [v.pk for v in videos]
+
+    def test_tag_and_untag(self):
+        self.assertEqual(self._post({'action':'tag', 'tag':' blue  tit', 'ids':self._pks(self.videos[:2])})['videos'], 2)
+        self.assertEqual(set(Tag.objects.get(name='Blue Tit').videos.all()), set(self.videos[:2]))
+        #the video already tagged is kept once
+        self._post({'action':'tag', 'tag':'robin', 'ids':self._pks(self.videos[:2])})
+        self.assertEqual(VideoTag.objects.filter(tag=self.robin).count(), 2)
+        self.assertEqual(self._post({'action':'untag', 'tag':'Robin', 'filter':{'tag':'robin'}})['videos'], 2)
+        self.assertFalse(VideoTag.objects.filter(tag=self.robin).exists())
+
+    def test_retitle_by_filter(self):
+        self.assertEqual(self._post({'action':'retitle', 'title':' Wind ', 'filter':{'before':'2024-05-02'}})['videos'], 2)
+        self.assertEqual([v.title for v in Video.objects.order_by('date_created')],
+                         ['Wind', 'Wind', 'temporary_title'])
+
+    def _video_with_files(self, directory:str) -> tuple[Video, list[str]]:
+        video = make_video(datetime(2024, 5, 4, 12), thumbnail_file='thumbnails/video.webp',
+                           thumbnail_widths='320', preview_tiles=3)
+        video.video_file = os.path.join(directory, 'video.mp4')
+        video.save()
+        for path in video.files:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'wb').close()
+        return video, video.files
+
+    def _delete_files(self, request) -> list[str]:
+        """Runs the delete `request` and the removal of the files once committed. Returns the files left"""
+        with TemporaryDirectory() as directory, override_settings(MEDIA_ROOT=directory):
+            video, files = self._video_with_files(directory)
+            remover = FileRemover()
+            with mock.patch.object(FileRemover, 'getSingleton', return_value=remover):
+                with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                    request(video)
+                    #nothing is removed before the transaction is committed
+                    self.assertTrue(all(os.path.exists(p) for p in files))
+            remover.close()
+            self.assertEqual(len(callbacks), 1)
+            return [p for p in files if os.path.exists(p)]
+
+    def test_delete_removes_files_after_commit(self):
+        def request(video):
+            self.assertEqual(self._post({'action':'delete', 'ids':[video.pk, self.videos[0].pk]})['videos'], 2)
+        self.assertEqual(self._delete_files(request), [])
+        self.assertEqual(set(Video.objects.all()), set(self.videos[1:]))
+
+    def test_single_delete_removes_files_after_commit(self):
+        def request(video):
+            self.assertEqual(self.client.delete(reverse(SingleVideoView.url_name, args=(video.pk,))).status_code, 204)
+        self.assertEqual(self._delete_files(request), [])
+        self.assertEqual(set(Video.objects.all()), set(self.videos))
+
+    def test_invalid_requests(self):
+        for data in ('[1]', 'not json', {'action':'archive', 'ids':[1]},
+                     {'action':'delete'}, {'action':'delete', 'filter':{}}, {'action':'delete', 'ids':[True]},
+                     {'action':'delete', 'ids':'1,2'}, {'action':'delete', 'filter':{'tag':5}},
+                     {'action':'delete', 'ids':list(range(BulkVideosView.MAX_IDS+1))},
+                     {'action':'delete', 'filter':{'after':'yesterday'}},
+                     {'action':'tag', 'ids':[1]}, {'action':'tag', 'tag':'x'*40, 'ids':[1]},
+                     {'action':'retitle', 'title':'  ', 'ids':[1]}):
+            self.assertIn('error', self._post(data, 400))
+        self.assertEqual(Video.objects.count(), len(self.videos))
+        self.assertEqual(Tag.objects.count(), 1)
@@ -1,22 +1,30 @@
 import logging
 import logging.config
 import logging.handlers
-import sys, os, select
-import cv2
+import sys, os, select, signal
+import cv2, av
 import zoneinfo
-from datetime import datetime
-from socket import socket, AF_UNIX, SOCK_STREAM, SO_REUSEADDR, SOL_SOCKET
+from datetime import datetime, timedelta
+from fractions import Fraction
+from socket import socket, socketpair, AF_UNIX, SOCK_STREAM, SOCK_SEQPACKET, SO_REUSEADDR, SO_SNDBUF, SOL_SOCKET, MSG_DONTWAIT
 import numpy as np
 from io import BytesIO
+from json import dumps, loads
 from django.conf import settings
 from constance import config
 import atexit
 from struct import pack, unpack
-from time import sleep
-from multiprocessing import Semaphore, Condition, Lock, Queue
-from multiprocessing.synchronize import Semaphore as _Semaphore_TYPE
+from time import sleep, perf_counter, time, monotonic
+from multiprocessing import Condition, Lock, Queue, shared_memory, resource_tracker
 from pystemd.systemd1 import Unit
-from threading import Thread
+from threading import Thread, Condition as ThreadCondition, Lock as ThreadLock
+from collections import deque, OrderedDict
+from queue import Queue as ThreadQueue, Full
+import selectors
+from bisect import bisect_left
+from http.client import HTTPConnection
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
 
 motion_detect_unit = Unit("birdwatcher-motion-detection.service")
 motion_detect_unit.load()
@@ -64,8 +72,8 @@ class ColoredSimpleFormatter(logging.Formatter):
                                  validate=self.validate
                                  ).format(record)
 
-def get_datetime_local():
-    utc_time = datetime.now(zoneinfo.ZoneInfo("UTC"))
+def get_datetime_local(timestamp:float|None=None):
+    utc_time = datetime.now(zoneinfo.ZoneInfo("UTC")) if timestamp is None else datetime.fromtimestamp(timestamp, zoneinfo.ZoneInfo("UTC"))
     localtz = settings.LOCAL_TIMEZONE
     offset_from_utc = localtz.utcoffset(utc_time)
     return utc_time+offset_from_utc
@@ -110,11 +118,554 @@ def setup_logging():
     logger = logging.getLogger(settings.PROJECT_NAME)    
     logger.debug(f"Logging successfully setup with level: {logging.getLevelName(stdout_handler.level)}")
 
+class CaptureFormat:
+    FORMATS = ('bgr', 'yuyv', 'nv12')
+    _FOURCC = {'yuyv':'YUYV', 'nv12':'NV12'}
+    _TO_BGR = {'yuyv':cv2.COLOR_YUV2BGR_YUY2, 'nv12':cv2.COLOR_YUV2BGR_NV12}
+    _AV_FORMAT = {'bgr':'bgr24', 'yuyv':'yuyv422', 'nv12':'nv12'}
+    
+    def __init__(self, name:str|None=None) -> None:
+        """Pixel layout of the frames going through the pipeline (settings.VID_CAPTURE_FORMAT).
+        
+        - bgr: frames as decoded by OpenCV, shape (height, width, 3)
+        - yuyv: the camera's packed YUYV 4:2:2, shape (height, width, 2). Channel 0 is the luma
+        - nv12: the camera's semi-planar YUV 4:2:0, shape (height*3/2, width). The first `height` rows are the luma
+        
+        With yuyv and nv12 frames are never converted on the capture path: motion detection reads
+        the luma plane as a view, the encoder gets the YUV data and only thumbnails and the livestream
+        convert to BGR.
+        """
+        self.name = (name or settings.VID_CAPTURE_FORMAT).lower()
+        if not self.name in self.FORMATS:
+            logger.warning(f"Unknown capture format {self.name}, using bgr")
+            self.name = 'bgr'
+    
+    @property
+    def native(self) -> bool:
+        return self.name != 'bgr'
+    
+    @property
+    def av_format(self) -> str:
+        #format given to av.VideoFrame.from_ndarray
+        return self._AV_FORMAT[self.name]
+    
+    @property
+    def encoder_pix_fmt(self) -> str:
+        #libx264 takes nv12 as is, other layouts are converted to the browser friendly yuv420p
+        return 'nv12' if self.name == 'nv12' else 'yuv420p'
+    
+    def configure(self, camera:cv2.VideoCapture):
+        if not self.native:
+            return
+        camera.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*self._FOURCC[self.name]))
+        camera.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+    
+    def read(self, camera, out:np.ndarray|None=None):
+        """Reads a frame from a cv2.VideoCapture (or anything with the same read()) in this layout.
+        If `out` is given the frame is decoded into it when possible"""
+        if out is None:
+            check, frame = camera.read()
+        else:
+            dst = out.reshape(1, -1) if self.native else out
+            check, frame = camera.read(dst)
+            if check and not frame is dst:
+                np.copyto(out, frame.reshape(out.shape))
+            return check, (out if check else None)
+        if check and self.native and frame.ndim == 2 and frame.shape[0] == 1:
+            #raw buffer from V4L2, give it its 2D shape (a view, no copy)
+            height = int(camera.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            width = int(camera.get(cv2.CAP_PROP_FRAME_WIDTH))
+            if self.name == 'yuyv':
+                frame = frame.reshape(height, width, 2)
+            else:
+                frame = frame.reshape(height*3//2, width)
+        return check, frame
+    
+    def resolution(self, frame:np.ndarray) -> tuple[int,int]:
+        if self.name == 'nv12':
+            return frame.shape[0]*2//3, frame.shape[1]
+        return frame.shape[:2]
+    
+    def luma(self, frame:np.ndarray, rows:slice=slice(None), cols:slice=slice(None)) -> np.ndarray:
+        """Grayscale image of the area. A strided view on the frame for yuyv and nv12"""
+        if self.name == 'yuyv':
+            return frame[rows, cols, 0]
+        if self.name == 'nv12':
+            return frame[:self.resolution(frame)[0]][rows, cols]
+        return cv2.cvtColor(frame[rows, cols], cv2.COLOR_BGR2GRAY)
+    
+    def to_bgr(self, frame:np.ndarray) -> np.ndarray:
+        if not self.native:
+            return frame
+        return cv2.cvtColor(frame, self._TO_BGR[self.name])
+
+def open_video_capture(device) -> cv2.VideoCapture:
+    """Opens a V4L2 camera device and sets the resolution from the constance config"""
+    camera = cv2.VideoCapture(device, cv2.CAP_V4L2)
+    try:
+        width, height = str(config.VID_RESOLUTION).split('x',1)
+        camera.set(cv2.CAP_PROP_FRAME_WIDTH, int(width))
+        camera.set(cv2.CAP_PROP_FRAME_HEIGHT, int(height))
+    except:
+        pass
+    CaptureFormat().configure(camera)
+    return camera
+
+def available_memory() -> int:
+    """Memory in bytes that can be used without swapping"""
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1])*1024
+    except (OSError, ValueError, IndexError):
+        pass
+    #free pages only, an underestimate of what the kernel could reclaim
+    return os.sysconf('SC_AVPHYS_PAGES')*os.sysconf('SC_PAGE_SIZE')
+
+def concat_segments(segments, out_path:str, start:datetime, end:datetime) -> int:
+    """Joins the recording segments (in order) covering `start` to `end` into an mp4 without re-encoding.
+    The video starts on the last keyframe before `start`. Returns the number of frames written"""
+    tmp_path = out_path + '.part'
+    output = None
+    out_stream = None
+    pending = [] #packets from the last keyframe until the start of the video is found
+    started = False
+    done = False
+    base = None
+    time_base = None
+    frames = 0
+    offset = 0 #frames in the previous segments
+    
+    def mux(packets):
+        nonlocal base, frames
+        for data, pts, dts, keyframe in packets:
+            if base is None:
+                base = pts
+            out_packet = av.Packet(data)
+            out_packet.pts, out_packet.dts = pts - base, dts - base
+            out_packet.time_base = time_base
+            out_packet.is_keyframe = keyframe
+            out_packet.stream = out_stream
+            output.mux(out_packet)
+            frames += 1
+    
+    try:
+        for segment in segments:
+            if done:
+                break
+            fps = Fraction(segment.framerate).limit_denominator(1001)
+            with av.open(segment.segment_file) as source:
+                in_stream = source.streams.video[0]
+                if output is None:
+                    output = av.open(tmp_path, mode="w", format='mp4', options={'movflags':'+faststart'})
+                    out_stream = output.add_mux_stream(in_stream.codec_context.name, rate=fps,
+                                                       width=in_stream.codec_context.width,
+                                                       height=in_stream.codec_context.height)
+                    time_base = out_stream.time_base = 1/fps
+                first = None
+                last = offset
+                for packet in source.demux(in_stream):
+                    if packet.pts is None or packet.dts is None:
+                        continue #flush packet
+                    #timestamps as frame indexes, segments start with a keyframe
+                    if first is None:
+                        first = packet.pts
+                    pts = round((packet.pts - first) * packet.time_base * fps)
+                    dts = round((packet.dts - first) * packet.time_base * fps)
+                    if segment.start + timedelta(seconds=float(dts/fps)) > end:
+                        done = True
+                        break
+                    data = (bytes(packet), pts + offset, dts + offset, packet.is_keyframe)
+                    last = max(last, pts + offset + 1)
+                    if started:
+                        mux([data])
+                        continue
+                    if packet.is_keyframe:
+                        if segment.start + timedelta(seconds=float(pts/fps)) > start and len(pending) > 0:
+                            #the previous keyframe was the last one before the start
+                            started = True
+                            mux(pending + [data])
+                            continue
+                        pending = []
+                    pending.append(data)
+                offset = last
+        if not started:
+            #the whole range is after the last keyframe read
+            mux(pending)
+    finally:
+        if not output is None:
+            output.close()
+    if output is None:
+        raise FileNotFoundError("No segment to join")
+    os.replace(tmp_path, out_path)
+    return frames
+
+def decode_keyframes(file_path:str, width:int):
+    """Yields (seconds from the start of the video, BGR image `width` wide) for each keyframe of the video.
+    The other frames are skipped by the decoder"""
+    with av.open(file_path) as container:
+        stream = container.streams.video[0]
+        stream.codec_context.skip_frame = 'NONKEY'
+        start = float(stream.start_time*stream.time_base) if not stream.start_time is None else 0.0
+        for frame in container.decode(stream):
+            if frame.time is None:
+                continue
+            height = max(2, round(frame.height*width/frame.width/2)*2)
+            yield frame.time - start, frame.reformat(width=width, height=height, format='bgr24').to_ndarray()
+
+def remove_files(paths) -> int:
+    """Deletes the files, missing ones are ignored. Returns the number of bytes freed"""
+    freed = 0
+    for file_path in paths:
+        try:
+            size = os.stat(file_path).st_size
+            os.remove(file_path)
+            freed += size
+        except FileNotFoundError:
+            pass
+        except:
+            logger.exception(f"Unable to delete '{file_path}'")
+    return freed
+
 def watcher_is_running() -> bool:
     try:
         return motion_detect_unit.Unit.ActiveState == b'active'
     except:
         return False
+
+class VideoFileCache:
+    _singelton = None
+    #entries are dropped after this long too, videos are also changed or deleted by other processes
+    MAX_AGE = 60
+    
+    def __init__(self, size:int=512):
+        """The files of the most recently played videos of this process, by pk, so the range requests of a
+        player don't query the database (written by the recorder at the same time) nor stat the file again, only
+        check it still exists. Saving or deleting a video drops its entry"""
+        self._size = size
+        self._entries:OrderedDict[int, tuple[str, os.stat_result, float]] = OrderedDict()
+        self._lock = ThreadLock()
+    
+    def get(self, pk:int) -> tuple[str, os.stat_result]|None:
+        """The path and stat of the video file, None if not cached"""
+        with self._lock:
+            entry = self._entries.get(pk)
+            if entry is None:
+                return None
+            if monotonic() - entry[2] > VideoFileCache.MAX_AGE:
+                del self._entries[pk]
+                return None
+            self._entries.move_to_end(pk)
+            return entry[0], entry[1]
+    
+    def put(self, pk:int, file_path:str, stat_result:os.stat_result):
+        with self._lock:
+            self._entries[pk] = (file_path, stat_result, monotonic())
+            self._entries.move_to_end(pk)
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+    
+    def invalidate(self, pk:int):
+        with self._lock:
+            self._entries.pop(pk, None)
+    
+    @staticmethod
+    def getSingleton():
+        if VideoFileCache._singelton is None:
+            VideoFileCache._singelton = VideoFileCache()
+        return VideoFileCache._singelton
+
+class FileRemover:
+    _singelton = None
+    
+    def __init__(self):
+        """Deletes files in a thread of its own so requests don't wait for the disk. The files still waiting are
+        deleted before the process exits"""
+        self._jobs:ThreadQueue[list[str]|None] = ThreadQueue()
+        self._thread = Thread(target=self._run, name="file-remover", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+    
+    def remove(self, paths):
+        self._jobs.put(list(paths))
+    
+    def _run(self):
+        while True:
+            paths = self._jobs.get()
+            if paths is None:
+                break
+            freed = remove_files(paths)
+            logger.debug(f"Deleted {len(paths)} files, {freed/2**20:.1f}MiB freed")
+    
+    def close(self):
+        if self._thread.is_alive():
+            self._jobs.put(None)
+            self._thread.join()
+    
+    @staticmethod
+    def getSingleton():
+        if FileRemover._singelton is None:
+            FileRemover._singelton = FileRemover()
+        return FileRemover._singelton
+
+#histogram buckets in seconds for the time spent in a stage of the pipeline
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+class _Metric:
+    TYPE = 'untyped'
+    
+    def __init__(self, name:str, help:str, labels:dict[str,str]) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = ThreadLock()
+    
+    def _label_text(self, extra:dict[str,str]|None=None) -> str:
+        labels = {**self.labels, **(extra or {})}
+        if len(labels) == 0:
+            return ''
+        return '{' + ','.join(f'{k}="{v}"' for k, v in labels.items()) + '}'
+    
+    def lines(self) -> list[str]:
+        """The samples of the metric in the Prometheus text format"""
+        return [f"{self.name}{self._label_text()} {self.value}"]
+    
+    def snapshot(self) -> dict:
+        return {'labels':self.labels, 'value':self.value}
+
+class MetricCounter(_Metric):
+    TYPE = 'counter'
+    
+    def __init__(self, name:str, help:str, labels:dict[str,str]) -> None:
+        super().__init__(name, help, labels)
+        self._value = 0
+    
+    def inc(self, amount:int|float=1):
+        with self._lock:
+            self._value += amount
+    
+    @property
+    def value(self) -> int|float:
+        return self._value
+
+class MetricGauge(_Metric):
+    TYPE = 'gauge'
+    
+    def __init__(self, name:str, help:str, labels:dict[str,str], function=None) -> None:
+        """A value that goes up and down. If `function` is set it is called for the value when read"""
+        super().__init__(name, help, labels)
+        self._value = 0
+        self.function = function
+    
+    def set(self, value:int|float):
+        self._value = value
+    
+    def inc(self, amount:int|float=1):
+        with self._lock:
+            self._value += amount
+    
+    def dec(self, amount:int|float=1):
+        self.inc(-amount)
+    
+    @property
+    def value(self) -> int|float:
+        if self.function is None:
+            return self._value
+        try:
+            return self.function()
+        except:
+            return 0
+
+class MetricHistogram(_Metric):
+    TYPE = 'histogram'
+    
+    def __init__(self, name:str, help:str, labels:dict[str,str], buckets=LATENCY_BUCKETS) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        #not cumulative, the last one is for values above all buckets
+        self._counts = [0]*(len(self.buckets)+1)
+        self._sum = 0.0
+    
+    def observe(self, value:float):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+    
+    @property
+    def value(self) -> int:
+        return sum(self._counts)
+    
+    def _cumulative(self) -> tuple[list[int],float]:
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+        for i in range(1, len(counts)):
+            counts[i] += counts[i-1]
+        return counts, total
+    
+    def lines(self) -> list[str]:
+        counts, total = self._cumulative()
+        lines = [f"{self.name}_bucket{self._label_text({'le':f'{le:g}'})} {count}"
+                 for le, count in zip(self.buckets, counts)]
+        lines.append(f"{self.name}_bucket{self._label_text({'le':'+Inf'})} {counts[-1]}")
+        lines.append(f"{self.name}_sum{self._label_text()} {total}")
+        lines.append(f"{self.name}_count{self._label_text()} {counts[-1]}")
+        return lines
+    
+    def snapshot(self) -> dict:
+        counts, total = self._cumulative()
+        return {'labels':self.labels, 'count':counts[-1], 'sum':total,
+                'buckets':[[le, count] for le, count in zip(self.buckets, counts)]}
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        """Counters, gauges and histograms of this process, by name and labels.
+        Getting a metric that already exists returns it so modules can share them"""
+        self._metrics:dict[tuple[str,tuple],_Metric] = {}
+        self._lock = ThreadLock()
+    
+    def _get(self, cls, name:str, help:str, labels:dict[str,str], **kwargs) -> _Metric:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            metric = self._metrics.get(key)
+            if metric is None:
+                metric = self._metrics[key] = cls(name, help, {k:str(v) for k, v in labels.items()}, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"Metric {name} already exists as a {metric.TYPE}")
+            return metric
+    
+    def counter(self, name:str, help:str='', **labels) -> MetricCounter:
+        return self._get(MetricCounter, name, help, labels)
+    
+    def gauge(self, name:str, help:str='', function=None, **labels) -> MetricGauge:
+        gauge = self._get(MetricGauge, name, help, labels)
+        if not function is None:
+            gauge.function = function
+        return gauge
+    
+    def histogram(self, name:str, help:str='', buckets=LATENCY_BUCKETS, **labels) -> MetricHistogram:
+        return self._get(MetricHistogram, name, help, labels, buckets=buckets)
+    
+    def _by_name(self) -> dict[str,list[_Metric]]:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        by_name = {}
+        for metric in metrics:
+            by_name.setdefault(metric.name, []).append(metric)
+        return by_name
+    
+    def render(self) -> str:
+        """All the metrics in the Prometheus text exposition format"""
+        lines = []
+        for name, metrics in self._by_name().items():
+            lines.append(f"# HELP {name} {metrics[0].help}")
+            lines.append(f"# TYPE {name} {metrics[0].TYPE}")
+            for metric in metrics:
+                lines.extend(metric.lines())
+        return '\n'.join(lines) + '\n'
+    
+    def snapshot(self) -> dict:
+        """All the metrics as JSON serializable values, with the time they were read at"""
+        return {'time':time(), 'metrics':{name:[m.snapshot() for m in metrics]
+                                          for name, metrics in self._by_name().items()}}
+
+metrics = MetricsRegistry()
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = self.path.split('?', 1)[0]
+        if url == '/metrics':
+            body, content_type = metrics.render().encode(), 'text/plain; version=0.0.4; charset=utf-8'
+        elif url == '/metrics.json':
+            body, content_type = dumps(metrics.snapshot()).encode(), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        #scraped every few seconds, not worth a log line
+        pass
+
+class _UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+    
+    def get_request(self):
+        request, _ = super().get_request()
+        #the request handler expects a (host, port) client address
+        return request, ('unix', 0)
+
+class _UnixHTTPConnection(HTTPConnection):
+    def __init__(self, socket_path:str, timeout:float) -> None:
+        super().__init__('localhost', timeout=timeout)
+        self._socket_path = socket_path
+    
+    def connect(self):
+        self.sock = socket(AF_UNIX, SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self._socket_path)
+
+def _metrics_target(address:str) -> str|tuple[str,int]:
+    """The path of the unix socket or the (host, port) of a METRICS_ADDRESS"""
+    if address.startswith('unix:'):
+        return address[len('unix:'):]
+    if '/' in address:
+        return address
+    host, _, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+def serve_metrics(address:str|None=None):
+    """Serves `metrics` from a daemon thread, in the Prometheus text format on /metrics and as JSON on
+    /metrics.json. `address` (METRICS_ADDRESS by default) is 'host:port' or the path of a unix socket,
+    empty to disable. Returns the server or None"""
+    address = settings.METRICS_ADDRESS if address is None else address
+    if not address:
+        return None
+    target = _metrics_target(address)
+    try:
+        if isinstance(target, str):
+            try:
+                os.unlink(target)
+            except FileNotFoundError:
+                pass
+            server = _UnixHTTPServer(target, _MetricsHandler)
+            #the webapp may run as another user
+            os.chmod(target, 0o666)
+        else:
+            server = ThreadingHTTPServer(target, _MetricsHandler)
+            server.daemon_threads = True
+    except OSError:
+        logger.exception(f"Unable to serve metrics on {address}")
+        return None
+    Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logger.info(f"Serving metrics on {address}")
+    return server
+
+def fetch_metrics(address:str|None=None, timeout:float=1.0) -> dict|None:
+    """The snapshot of the metrics served by the motion detector, None if it can't be reached"""
+    address = settings.METRICS_ADDRESS if address is None else address
+    if not address:
+        return None
+    target = _metrics_target(address)
+    if isinstance(target, str):
+        connection = _UnixHTTPConnection(target, timeout)
+    else:
+        connection = HTTPConnection(*target, timeout=timeout)
+    try:
+        connection.request('GET', '/metrics.json')
+        response = connection.getresponse()
+        if response.status != 200:
+            return None
+        return loads(response.read())
+    except (OSError, ValueError):
+        return None
+    finally:
+        connection.close()
     
 class BlockingSingleQueue:
     def __init__(self):
@@ -134,131 +685,354 @@ class BlockingSingleQueue:
             self._value, tmp = None,self._value
         return tmp
 
+def _hello_message(policy:str, max_queue:int) -> bytes:
+    #first message sent by a consumer, tells the publisher how to queue frames for it
+    body = dumps({'policy':policy, 'queue':max_queue}).encode()
+    return pack('>I', len(body)) + body
+
+class _Subscriber:
+    POLICIES = ('drop-oldest', 'drop-newest', 'block')
+    
+    def __init__(self, sock:socket, policy:str='drop-oldest', max_queue:int=2) -> None:
+        """A consumer connected to a FramePublisher with its own bounded outbound queue.
+        
+        When the queue is full the policy decides what happens to a new frame:
+        - drop-oldest: the oldest queued frame is discarded (for live views)
+        - drop-newest: the new frame is discarded
+        - block: the publisher waits for this subscriber (for the recorder, no frame is lost)
+        """
+        self.sock = sock
+        self.policy = policy if policy in self.POLICIES else 'drop-oldest'
+        self.max_queue = max(1, int(max_queue))
+        self.queue:deque[tuple[int|None,memoryview]] = deque()
+        #message being sent and how much of it has already been sent
+        self.current:memoryview|None = None
+        self.current_seq:int|None = None
+        self.offset = 0
+        self.registered = False
+        self.closed = False
+        #counters
+        self.sent = 0
+        self.dropped = 0
+        self.last_sent_seq = -1
+        self.lag = 0
+    
+    @property
+    def full(self) -> bool:
+        return len(self.queue) >= self.max_queue
+    
+    def stats(self) -> dict:
+        return {'fd':self.sock.fileno(), 'policy':self.policy, 'queued':len(self.queue),
+                'sent':self.sent, 'dropped':self.dropped, 'lag':self.lag}
+
+class _Handshake:
+    def __init__(self, sock:socket, deadline:float) -> None:
+        """A consumer connected to a FramePublisher that hasn't sent its whole hello yet. It is dropped
+        if the hello isn't received by `deadline` (monotonic time)"""
+        self.sock = sock
+        self.deadline = deadline
+        self.data = bytearray()
+
 class FramePublisher:
     SOCKET_PATH = os.path.join(str(settings.BASE_DIR), "video_duplication_sock.s")
+    SOCKET_TYPE = SOCK_STREAM
+    MAX_SUBSCRIBER_QUEUE = 8
+    STATS_LOG_INTERVAL = 30
+    #seconds a consumer has to send its hello once connected
+    HELLO_TIMEOUT = 1
     
     def __init__(self) -> None:
+        """Reads the camera and fans the frames out to the connected consumers.
+        
+        A selector loop (run by start()) accepts consumers, reads their hello and sends each one its
+        queued messages without ever blocking, so a stalled consumer cannot delay the others.
+        The camera is read on a separate thread that enqueues every message once per subscriber
+        following the subscriber's policy.
+        """
         self._camera: cv2.VideoCapture|None = None
-        self._connections:dict[socket,_Semaphore_TYPE] = dict()
-        self._threads:list[Thread] = []
+        self._format = CaptureFormat()
+        self._subscribers:dict[socket,_Subscriber] = dict()
+        #consumers connected whose hello isn't received yet, only used by the selector loop
+        self._handshakes:dict[socket,_Handshake] = dict()
+        self._queues_changed = ThreadCondition()
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._seq = -1
         self._stop = False
         self._broadcast_thread = Thread(target=self._broadcast_messages)
         
-    def _send(self, sock, message):
-        # Prefix each message with a 4-byte length (network byte order)
-        message_length = len(message)
-        message_header = pack('>I', message_length)
-        sock.sendall(message_header + message)
-        
     @property
     def _pause(self):
-        return len(self._connections) == 0
-
-    def handle_connection(self, connection:socket, release_sem:_Semaphore_TYPE):
+        return len(self._subscribers) == 0
+    
+    def subscriber_stats(self) -> list[dict]:
+        with self._queues_changed:
+            return [sub.stats() for sub in self._subscribers.values()]
+    
+    @staticmethod
+    def _parse_hello(data:bytearray) -> dict|None:
+        #the hello once all of it is received, a length header then a json body
+        if len(data) < 4:
+            return None
+        length = unpack('>I', data[:4])[0]
+        if len(data) < 4 + length:
+            return None
+        return loads(data[4:4+length])
+    
+    def _on_attach(self, subscriber:_Subscriber):
+        #called with the queue lock held before the subscriber gets any frame
+        pass
+    
+    def handle_connection(self, connection:socket):
+        """Waits for the hello of a new consumer in the selector loop, it only becomes a subscriber once received"""
         logger.debug("Handling new connection")
-        connection.shutdown(0) #do not read (reads will not block and return wither b'' ot whatever is in its read buffer)
-        self._connections[connection] = release_sem
+        connection.setblocking(False)
+        handshake = _Handshake(connection, monotonic() + self.HELLO_TIMEOUT)
+        self._handshakes[connection] = handshake
+        self._selector.register(connection, selectors.EVENT_READ, handshake)
+    
+    def _end_handshake(self, handshake:_Handshake):
+        self._handshakes.pop(handshake.sock, None)
+        self._selector.unregister(handshake.sock)
+    
+    def _reject(self, handshake:_Handshake, reason:str):
+        logger.debug(f"{reason}, closing connection")
+        self._end_handshake(handshake)
         try:
-            #wait forever until released, connection closed or force closed
-            release_sem.acquire(True)
-        finally:
-            logger.debug("Connection released, clearing")
-            connection.shutdown(2)
-            connection.close()
-            self._connections.pop(connection, None)
-
-    def _broadcast_messages(self):
-        logger.debug("Broadcasting to connected elements")
+            handshake.sock.close()
+        except:
+            pass
+    
+    def _read_hello(self, handshake:_Handshake):
+        connection = handshake.sock
         try:
-            while not self._stop:
-                while self._pause:
-                    # do not read frames for now
-                    # Wait until frame request
-                    sleep(0.3)
-                    if self._stop:
-                        return
-                #get frame here
-                check, frame = self._camera.read()
-                buffer = BytesIO()
-                if check:
-                    np.save(buffer, frame, allow_pickle=False)
-                    for conn,sem in list(self._connections.items()):
-                        try:
-                            self._send(conn, buffer.getbuffer())
-                        except: 
-                            #connection failed. Maybe it's closed?
-                            sem.release()
-        finally:
-            logger.debug("Releasing all connections")
-            for sem in self._connections.values():
-                sem.release()
-
-    def start(self):
-        self._camera = cv2.VideoCapture(settings.VID_CAMERA_DEVICE, cv2.CAP_V4L2)
+            data = connection.recv(4096)
+            if len(data) == 0:
+                raise EOFError("Connection closed during hello")
+            handshake.data += data
+            hello = self._parse_hello(handshake.data)
+            if hello is None:
+                return #the rest is not received yet
+            self._end_handshake(handshake)
+            connection.shutdown(0) #do not read anymore, consumers only send the hello
+        except BlockingIOError:
+            return
+        except:
+            self._reject(handshake, "Invalid hello from consumer")
+            return
+        subscriber = _Subscriber(connection, hello.get('policy', 'drop-oldest'),
+                                 min(int(hello.get('queue', 2)), self.MAX_SUBSCRIBER_QUEUE))
+        with self._queues_changed:
+            self._on_attach(subscriber)
+            self._subscribers[connection] = subscriber
+        logger.debug(f"Subscriber attached with policy {subscriber.policy} and queue of {subscriber.max_queue}")
+        self._flush(subscriber)
+    
+    def _expire_handshakes(self):
+        now = monotonic()
+        for handshake in [h for h in self._handshakes.values() if h.deadline < now]:
+            self._reject(handshake, "No hello from consumer in time")
+    
+    def _detach(self, subscriber:_Subscriber):
+        with self._queues_changed:
+            subscriber.closed = True
+            self._subscribers.pop(subscriber.sock, None)
+            self._queues_changed.notify_all()
+        if subscriber.registered:
+            self._selector.unregister(subscriber.sock)
+            subscriber.registered = False
+        logger.debug(f"Subscriber detached: {subscriber.stats()}")
         try:
-            width, height = str(config.VID_RESOLUTION).split('x',1)
-            self._camera.set(cv2.CAP_PROP_FRAME_WIDTH, int(width))
-            self._camera.set(cv2.CAP_PROP_FRAME_HEIGHT, int(height))
+            subscriber.sock.close()
         except:
             pass
-        logger.debug("Started video capture")
+    
+    def _flush(self, subscriber:_Subscriber):
+        #send as much of the subscriber's queue as its socket takes without blocking
+        try:
+            while True:
+                if subscriber.current is None:
+                    with self._queues_changed:
+                        if len(subscriber.queue) == 0:
+                            break
+                        subscriber.current_seq, subscriber.current = subscriber.queue.popleft()
+                        subscriber.offset = 0
+                        self._queues_changed.notify_all()
+                subscriber.offset += subscriber.sock.send(subscriber.current[subscriber.offset:])
+                if subscriber.offset >= len(subscriber.current):
+                    if not subscriber.current_seq is None:
+                        subscriber.sent += 1
+                        subscriber.last_sent_seq = subscriber.current_seq
+                        subscriber.lag = self._seq - subscriber.last_sent_seq
+                    subscriber.current = None
+        except BlockingIOError:
+            pass #socket buffer is full, wait until it is writable
+        except OSError:
+            #connection failed. Maybe it's closed?
+            self._detach(subscriber)
+            return
         
-        # make sure socket does not exist
-        if os.path.exists(self.SOCKET_PATH):
-            os.remove(self.SOCKET_PATH)
-            #TODO add error handling
-        logger.debug("Starting Unix socket")
-        sock = socket(AF_UNIX, SOCK_STREAM)
+        pending = not subscriber.current is None
+        if pending and not subscriber.registered:
+            self._selector.register(subscriber.sock, selectors.EVENT_WRITE, subscriber)
+            subscriber.registered = True
+        elif not pending and subscriber.registered:
+            self._selector.unregister(subscriber.sock)
+            subscriber.registered = False
+    
+    def _wake(self):
         try:
+            self._wake_w.send(b'\0')
+        except BlockingIOError:
+            pass #already woken up
+    
+    def _enqueue(self, subscriber:_Subscriber, seq:int, message:memoryview):
+        #must be called with the queue lock held
+        if subscriber.full:
+            if subscriber.policy == 'drop-newest':
+                subscriber.dropped += 1
+                return
+            elif subscriber.policy == 'drop-oldest':
+                subscriber.queue.popleft()
+                subscriber.dropped += 1
+            else:
+                #block: wait for the selector loop to make room
+                self._wake()
+                while subscriber.full and not subscriber.closed and not self._stop:
+                    self._queues_changed.wait(0.1)
+                if subscriber.closed or self._stop:
+                    return
+        subscriber.queue.append((seq, message))
+        subscriber.lag = seq - subscriber.last_sent_seq
+    
+    def _next_message(self) -> tuple[int,memoryview]|None:
+        #get frame here and serialize it once for all subscribers
+        check, frame = self._format.read(self._camera)
+        if not check:
+            return None
+        buffer = BytesIO()
+        buffer.write(bytes(4)) #room for the length header
+        np.save(buffer, frame, allow_pickle=False)
+        message = buffer.getbuffer()
+        # Prefix each message with a 4-byte length (network byte order)
+        message[:4] = pack('>I', len(message) - 4)
+        self._seq += 1
+        return self._seq, message
+
+    def _broadcast_messages(self):
+        logger.debug("Broadcasting to connected elements")
+        last_stats_log = perf_counter()
+        while not self._stop:
+            while self._pause:
+                # do not read frames for now
+                # Wait until frame request
+                sleep(0.3)
+                if self._stop:
+                    return
+            next_message = self._next_message()
+            if next_message is None:
+                continue
+            with self._queues_changed:
+                for subscriber in list(self._subscribers.values()):
+                    self._enqueue(subscriber, *next_message)
+            self._wake()
+            if perf_counter() - last_stats_log > self.STATS_LOG_INTERVAL:
+                last_stats_log = perf_counter()
+                logger.debug(f"Frame publisher subscribers: {self.subscriber_stats()}")
+    
+    def _open_camera(self):
+        self._camera = open_video_capture(settings.VID_CAMERA_DEVICE)
+        logger.debug("Started video capture")
+
+    def start(self):
+        sock = None
+        try:
+            self._open_camera()
+            
+            # make sure socket does not exist
+            if os.path.exists(self.SOCKET_PATH):
+                os.remove(self.SOCKET_PATH)
+            logger.debug("Starting Unix socket")
+            sock = socket(AF_UNIX, self.SOCKET_TYPE)
             sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
             sock.bind(self.SOCKET_PATH)
-            sock.listen(1)
+            sock.listen(8)
+            self._selector.register(sock, selectors.EVENT_READ)
+            self._selector.register(self._wake_r, selectors.EVENT_READ)
             
             self._broadcast_thread.start()
             
             while not self._stop:
-                readlist, _, _ = select.select([sock], [], [], 0.1)
-                if len(readlist) > 0:
-                    conn,addr = sock.accept()
-                    logger.debug("Got connection to unix socket")
-                    t = Thread(target=self.handle_connection, args=(conn, Semaphore(0)))
-                    self._threads.append(t)
-                    t.start()
+                for key, _ in self._selector.select(0.1):
+                    if key.fileobj is sock:
+                        conn,addr = sock.accept()
+                        logger.debug("Got connection to unix socket")
+                        self.handle_connection(conn)
+                    elif isinstance(key.data, _Handshake):
+                        self._read_hello(key.data)
+                    elif key.fileobj is self._wake_r:
+                        try:
+                            while self._wake_r.recv(4096):
+                                pass
+                        except BlockingIOError:
+                            pass
+                        for subscriber in list(self._subscribers.values()):
+                            self._flush(subscriber)
+                    elif not key.data.closed:
+                        self._flush(key.data)
+                self._expire_handshakes()
         finally:
             logger.debug("Stopping unix socket server")
-            sock.close()
+            if not sock is None:
+                sock.close()
             self.release()
-            
-    def release(self):
-        if self._stop:
-            return
-        self._stop = True
-        logger.debug("Releasing Frame publisher")
-        #make a copy to avoid error when another thread removes values
-        for sem in list(self._connections.values()):
-            logger.debug("Sem.release() called")
-            sem.release()
+            self._shutdown()
+    
+    def _shutdown(self):
+        logger.debug("Joining broadcast thread")
+        if self._broadcast_thread.is_alive():
+            self._broadcast_thread.join()
+        logger.debug("Threads joined")
         
         if not self._camera is None:
             self._camera.release()
             logger.debug("Releasing camera")
             self._camera = None
         
-        logger.debug("Joining threads")
-        for thread in self._threads:
-            thread.join()
-        self._threads.clear()
+        logger.debug("Releasing all connections")
+        for handshake in list(self._handshakes.values()):
+            self._reject(handshake, "Publisher stopping")
+        for subscriber in list(self._subscribers.values()):
+            self._detach(subscriber)
+        self._selector.close()
+        self._wake_r.close()
+        self._wake_w.close()
+        if os.path.exists(self.SOCKET_PATH):
+            os.remove(self.SOCKET_PATH)
             
-        logger.debug("Joining broadcast thread")
-        self._broadcast_thread.join()
-        logger.debug("Threads joined")
-        os.remove(self.SOCKET_PATH)
+    def release(self):
+        #only requests the stop, start() cleans up once its loop exits
+        if self._stop:
+            return
+        self._stop = True
+        logger.debug("Releasing Frame publisher")
+        with self._queues_changed:
+            self._queues_changed.notify_all()
         
 class FrameConsumer(object):
     SOCKET_PATH = os.path.join(str(settings.BASE_DIR), "video_duplication_sock.s")
     
-    def __init__(self):
-        self._frame_queue = BlockingSingleQueue()
+    def __init__(self, policy:str='drop-oldest', max_queue:int=2):
+        if policy == 'block':
+            #keep every frame in order and let the publisher wait for us when we are behind
+            self._frame_queue = ThreadQueue(max_queue)
+        else:
+            self._frame_queue = BlockingSingleQueue()
+        self._policy = policy
+        self._max_queue = max_queue
+        self._header = bytearray(4)
         self._stop = False
         self._recvThread = Thread(target=self._start)
         self._recvThread.start()
@@ -268,25 +1042,26 @@ class FrameConsumer(object):
         Returns None if the socket is half closed and no longer receives
         """
         # Read message length (first 4 bytes)
-        message_header = self._recv_all(sock, 4)
-        if not message_header:
+        if not self._recv_into(sock, memoryview(self._header)):
             return None
         
-        message_length = unpack('>I', message_header)[0]
+        message_length = unpack('>I', self._header)[0]
         
-        # Read the message data based on the length
-        message = self._recv_all(sock, message_length)
+        # Read the message data based on the length in a buffer allocated once
+        message = bytearray(message_length)
+        if not self._recv_into(sock, memoryview(message)):
+            return None
         return message
 
-    def _recv_all(self, sock, length):
-        # Helper function to receive a fixed number of bytes
-        data = b''
-        while len(data) < length:
-            packet = sock.recv(length - len(data))
-            if not packet:
-                return None
-            data += packet
-        return data
+    def _recv_into(self, sock, view:memoryview) -> bool:
+        # Helper function to fill the whole buffer. Returns False if the socket is closed
+        pos = 0
+        while pos < len(view):
+            received = sock.recv_into(view[pos:], len(view) - pos)
+            if received == 0:
+                return False
+            pos += received
+        return True
         
     def __enter__(self):
         return self
@@ -299,6 +1074,7 @@ class FrameConsumer(object):
         try:
             logger.debug("Connecting to unix socket")
             sock.connect(self.SOCKET_PATH)
+            sock.sendall(_hello_message(self._policy, self._max_queue))
             sock.shutdown(1)
             logger.debug("Connection Success")
             errnum = 0
@@ -317,12 +1093,23 @@ class FrameConsumer(object):
                     self._stop = True
                     break
                     
-                self._frame_queue.put(frame)
+                self._put_frame(frame)
         finally:
             logger.debug("Releasing connection")
             sock.shutdown(2)
             sock.close()
                 
+    def _put_frame(self, frame):
+        if isinstance(self._frame_queue, BlockingSingleQueue):
+            self._frame_queue.put(frame)
+            return
+        while not self._stop:
+            try:
+                self._frame_queue.put(frame, timeout=0.1)
+                return
+            except Full:
+                continue
+                
     def read(self):
         #returns (True, $Frame) if there is a frame otherwise if timeout returns (False, None)
         try:
@@ -338,4 +1125,423 @@ class FrameConsumer(object):
         self._stop = True
         logger.debug("Stopping Frame consumer recv thread")
         self._recvThread.join()
-        logger.debug("FrameConsumer recv thread joined")
\ No newline at end of file
+        logger.debug("FrameConsumer recv thread joined")
+
+def _attach_shared_memory(name:str) -> shared_memory.SharedMemory:
+    """Attaches to an existing shared memory block without handing it to the resource tracker.
+    Otherwise the tracker unlinks the block when the consumer exits, while the publisher still uses it"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False) # python >= 3.13
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+class SharedFrameRing:
+    _DATA_ALIGN = 64
+    
+    def __init__(self, name:str, shape:tuple, dtype:str='uint8', num_slots:int=6, create:bool=False):
+        """Fixed pool of frame slots living in a shared memory block.
+        
+        The block starts with a header of int64: the sequence number of the latest complete frame
+        followed by the sequence number of the frame held by each slot (-1 while it is being written).
+        Frame with sequence number `seq` is always written to slot `seq % num_slots`.
+        The frames data follows the header, aligned to 64 bytes.
+        """
+        self.name = name
+        self.shape = tuple(int(i) for i in shape)
+        self.dtype = np.dtype(dtype)
+        self.num_slots = int(num_slots)
+        header_size = (1 + self.num_slots) * np.dtype(np.int64).itemsize
+        data_offset = -(-header_size // self._DATA_ALIGN) * self._DATA_ALIGN
+        frame_size = int(np.prod(self.shape)) * self.dtype.itemsize
+        
+        if create:
+            try:
+                self._shm = shared_memory.SharedMemory(name=name, create=True, size=data_offset + frame_size*self.num_slots)
+            except FileExistsError:
+                #left behind by a publisher that crashed
+                logger.debug(f"Removing stale shared memory block {name}")
+                shared_memory.SharedMemory(name=name).unlink()
+                self._shm = shared_memory.SharedMemory(name=name, create=True, size=data_offset + frame_size*self.num_slots)
+        else:
+            self._shm = _attach_shared_memory(name)
+        self._owner = create
+        self._header = np.ndarray((1 + self.num_slots,), dtype=np.int64, buffer=self._shm.buf)
+        self._frames = np.ndarray((self.num_slots, *self.shape), dtype=self.dtype,
+                                  buffer=self._shm.buf, offset=data_offset)
+        if create:
+            self._header[:] = -1
+        else:
+            #consumers only ever get read-only views
+            self._frames.flags.writeable = False
+    
+    def describe(self) -> dict:
+        return {'name':self.name, 'shape':list(self.shape), 'dtype':self.dtype.str, 'slots':self.num_slots}
+    
+    @property
+    def latest_seq(self) -> int:
+        return int(self._header[0])
+    
+    def begin_write(self, seq:int) -> np.ndarray:
+        #invalidate the slot before overwriting it so readers cannot mistake it for an older frame
+        slot = seq % self.num_slots
+        self._header[1+slot] = -1
+        return self._frames[slot]
+    
+    def commit(self, seq:int):
+        self._header[1 + seq % self.num_slots] = seq
+        self._header[0] = seq
+        
+    def get(self, seq:int) -> np.ndarray|None:
+        """Returns a view on the frame `seq` or None if it has already been overwritten"""
+        if seq < 0 or self._header[1 + seq % self.num_slots] != seq:
+            return None
+        return self._frames[seq % self.num_slots]
+    
+    def is_valid(self, seq:int) -> bool:
+        return seq >= 0 and self._header[1 + seq % self.num_slots] == seq
+    
+    def close(self):
+        del self._header, self._frames
+        try:
+            self._shm.close()
+        except BufferError:
+            #a view on a frame is still held somewhere, the mapping is freed with it
+            pass
+        if self._owner:
+            try:
+                self._shm.unlink()
+            except FileNotFoundError:
+                pass
+
+class SharedFramePublisher(FramePublisher):
+    SOCKET_PATH = os.path.join(str(settings.BASE_DIR), "frame_bus_sock.s")
+    SOCKET_TYPE = SOCK_SEQPACKET
+    SHM_NAME = f"{settings.PROJECT_NAME}_frames"
+    
+    def __init__(self) -> None:
+        """Publishes camera frames through a SharedFrameRing instead of copying them to every consumer.
+        
+        The unix socket is only used as a control channel: on attach the consumer receives the
+        description of the ring, then the sequence number (8 bytes) of each new frame.
+        Closing the socket detaches the consumer.
+        """
+        super().__init__()
+        self._ring:SharedFrameRing|None = None
+        
+    def _open_camera(self):
+        super()._open_camera()
+        #the first frame gives the geometry of the slots
+        check, frame = self._format.read(self._camera)
+        if not check:
+            raise RuntimeError(f"Unable to read a frame from {settings.VID_CAMERA_DEVICE}")
+        self._ring = SharedFrameRing(self.SHM_NAME, frame.shape, frame.dtype.str,
+                                     num_slots=settings.FRAME_BUS_SLOTS, create=True)
+        logger.debug(f"Created shared frame ring {self._ring.describe()}")
+    
+    def _on_attach(self, subscriber:_Subscriber):
+        #keep the kernel from buffering many notifications so the subscriber's queue and policy
+        #apply (the size is rounded up to the kernel minimum, a handful of notifications)
+        subscriber.sock.setsockopt(SOL_SOCKET, SO_SNDBUF, 1)
+        #the ring description is always the first message, whatever the subscriber's policy
+        subscriber.current_seq = None
+        subscriber.current = memoryview(dumps(self._ring.describe()).encode())
+        subscriber.offset = 0
+    
+    def _next_message(self) -> tuple[int,memoryview]|None:
+        seq = self._seq + 1
+        slot = self._ring.begin_write(seq)
+        #decode straight into the shared memory slot when the camera allows it
+        check, _ = self._format.read(self._camera, slot)
+        if not check:
+            return None
+        self._ring.commit(seq)
+        self._seq = seq
+        return seq, memoryview(pack('>q', seq))
+    
+    def _shutdown(self):
+        super()._shutdown()
+        if not self._ring is None:
+            self._ring.close()
+            self._ring = None
+
+class SharedFrameConsumer:
+    SOCKET_PATH = SharedFramePublisher.SOCKET_PATH
+    
+    def __init__(self, timeout:float=5, policy:str='drop-oldest', max_queue:int=1):
+        """Attaches to a SharedFramePublisher. `read()` has the same semantics as cv2.VideoCapture.read()
+        except the frame returned is a read-only view into shared memory (no copy is made).
+        The view is only valid until the publisher wraps around the ring
+        (settings.FRAME_BUS_SLOTS frames later), copy it to keep it longer.
+        
+        With the 'block' policy frames are returned in order, otherwise only the latest one.
+        A frame overwritten before it could be read is skipped.
+        """
+        self._timeout = timeout
+        self._latest_only = policy != 'block'
+        self._sock = socket(AF_UNIX, SOCK_SEQPACKET)
+        self._ring:SharedFrameRing|None = None
+        self._notification = bytearray(8)
+        try:
+            logger.debug("Connecting to frame bus")
+            self._sock.connect(self.SOCKET_PATH)
+            self._sock.send(_hello_message(policy, max_queue))
+            description = loads(self._sock.recv(4096))
+            self._ring = SharedFrameRing(description['name'], description['shape'],
+                                         description['dtype'], description['slots'])
+            logger.debug("Attached to frame bus")
+        except:
+            self.release()
+            raise
+    
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, *args):
+        self.release()
+    
+    def _next_notified_seq(self) -> int|None:
+        #drain all pending notifications and keep only the most recent unless every frame is wanted
+        seq = None
+        while True:
+            try:
+                n = self._sock.recv_into(self._notification, 8, MSG_DONTWAIT)
+            except BlockingIOError:
+                return seq
+            if n == 0:
+                raise EOFError("Frame bus closed")
+            seq = unpack('>q', self._notification)[0]
+            if not self._latest_only:
+                return seq
+    
+    def read(self):
+        #returns (True, $Frame) if there is a frame otherwise if timeout or closed returns (False, None)
+        if self._ring is None:
+            return False, None
+        try:
+            while True:
+                readable,_,_ = select.select([self._sock], [], [], self._timeout)
+                if len(readable) == 0:
+                    logger.debug("No frame gotten from frame bus")
+                    return False, None
+                seq = self._next_notified_seq()
+                if seq is None:
+                    continue
+                frame = self._ring.get(seq)
+                if not frame is None:
+                    return True, frame
+        except:
+            return False, None
+    
+    def release(self):
+        logger.debug("Detaching from frame bus")
+        try:
+            self._sock.close()
+        except:
+            pass
+        if not self._ring is None:
+            self._ring.close()
+            self._ring = None
+
+#maximum height (0 for the camera's) and JPEG quality of the versions of the livestream clients can choose from
+LIVESTREAM_TIERS = {'full':(0, 70), '720p':(720, 70), '360p':(360, 60)}
+#each frame of the livestream is a part of a multipart response
+LIVESTREAM_PART_HEADER = b'--frame\r\nContent-Type: image/jpeg\r\n\r\n'
+
+def encode_livestream_tiers(frame:np.ndarray, tiers) -> dict[str,bytes]:
+    """The BGR frame as a part of the multipart livestream response for each of the tiers. Tiers that come
+    out at the same size and quality (a 720p tier of a 480p camera is the full tier) are only encoded once"""
+    height, width = frame.shape[:2]
+    encoded:dict[tuple[int,int],bytes] = {}
+    frames = {}
+    for tier in tiers:
+        max_height, quality = LIVESTREAM_TIERS[tier]
+        tier_height = height if max_height <= 0 else min(height, max_height)
+        key = (tier_height, quality)
+        if not key in encoded:
+            scaled = frame if tier_height == height else cv2.resize(
+                frame, (round(width*tier_height/height), tier_height), interpolation=cv2.INTER_AREA)
+            jpeg = cv2.imencode(".jpg", scaled, [cv2.IMWRITE_JPEG_QUALITY, quality])[1]
+            encoded[key] = LIVESTREAM_PART_HEADER + jpeg.tobytes() + b'\r\n'
+        frames[tier] = encoded[key]
+    return frames
+
+class LiveStreamProducer:
+    SOCKET_PATH = os.path.join(str(settings.BASE_DIR), "livestream_sock.s")
+    #the camera stays open this long after the last connection closed
+    IDLE_SECONDS = 2
+    SEND_TIMEOUT = 2
+    #the camera is opened again once no frame was read for this long
+    NO_FRAME_SECONDS = 2
+    #seconds before opening the camera again after a failure, doubled at each failure up to the maximum
+    RETRY_MIN_SECONDS = 0.5
+    RETRY_MAX_SECONDS = 8
+    
+    def __init__(self) -> None:
+        """Reads the camera for the livestream of all the webapp workers and encodes each frame once per tier.
+        
+        A worker opens a connection per tier it has viewers for (the hello is the name of the tier and a
+        newline) then sends a byte each time it wants a frame, and gets the frame length prefixed.
+        A frame is only encoded for the tiers with a pending request. The camera is only read while
+        there are connections. While it can't be opened (the recorder isn't running yet or restarts) the
+        connections are kept and it is opened again with a backoff.
+        """
+        self._connections:dict[socket,dict] = {}
+        self._selector = selectors.DefaultSelector()
+        self._camera = None
+        self._stop = False
+    
+    @staticmethod
+    def _open_camera():
+        match settings.DEVICE_DUPLICATION.lower():
+            case 'socket':
+                return FrameConsumer()
+            case 'shm':
+                #frames are encoded straight from the shared memory view
+                return SharedFrameConsumer()
+            case 'v4l2loopback':
+                return open_video_capture(settings.STREAM_VID_DEVICE)
+            case _:
+                raise RuntimeError("No video duplication available for streaming")
+    
+    def _release_camera(self):
+        try:
+            self._camera.release()
+        except Exception:
+            pass
+        self._camera = None
+    
+    def _accept(self, server:socket):
+        connection, _ = server.accept()
+        connection.settimeout(LiveStreamProducer.SEND_TIMEOUT)
+        self._connections[connection] = {'tier':None, 'hello':b'', 'requests':0}
+        self._selector.register(connection, selectors.EVENT_READ)
+    
+    def _close(self, connection:socket):
+        self._connections.pop(connection, None)
+        try:
+            self._selector.unregister(connection)
+        except (KeyError, ValueError):
+            pass
+        connection.close()
+    
+    def _read_requests(self, connection:socket):
+        try:
+            data = connection.recv(4096)
+        except OSError:
+            data = b''
+        state = self._connections[connection]
+        if len(data) == 0:
+            self._close(connection)
+            return
+        if state['tier'] is None:
+            hello, newline, data = (state['hello'] + data).partition(b'\n')
+            state['hello'] = hello
+            if not newline:
+                return
+            tier = hello.decode(errors='replace')
+            if not tier in LIVESTREAM_TIERS:
+                logger.warning(f"Livestream connection for an unknown tier '{tier}'")
+                self._close(connection)
+                return
+            state['tier'] = tier
+        #one byte per frame requested
+        state['requests'] += len(data)
+    
+    def _send_frame(self, frames:dict[str,bytes]):
+        for connection, state in list(self._connections.items()):
+            if state['requests'] <= 0 or not state['tier'] in frames:
+                continue
+            frame = frames[state['tier']]
+            try:
+                connection.sendall(pack('>I', len(frame)) + frame)
+                state['requests'] -= 1
+            except OSError:
+                logger.debug("Livestream connection closed while sending a frame")
+                self._close(connection)
+    
+    def _poll(self, server:socket, timeout:float):
+        for key, _ in self._selector.select(timeout):
+            if key.fileobj is server:
+                self._accept(server)
+            elif key.fileobj in self._connections:
+                self._read_requests(key.fileobj)
+    
+    def start(self):
+        if os.path.exists(self.SOCKET_PATH):
+            os.remove(self.SOCKET_PATH)
+        server = socket(AF_UNIX, SOCK_STREAM)
+        capture_format = CaptureFormat()
+        idle_since = perf_counter()
+        retry_at, retry_seconds = 0.0, self.RETRY_MIN_SECONDS
+        last_frame = perf_counter()
+        try:
+            server.bind(self.SOCKET_PATH)
+            server.listen(8)
+            server.setblocking(False)
+            self._selector.register(server, selectors.EVENT_READ)
+            logger.info("Livestream producer started")
+            while not self._stop:
+                if len(self._connections) == 0:
+                    self._poll(server, 0.5)
+                    if not self._camera is None and perf_counter() - idle_since > self.IDLE_SECONDS:
+                        logger.debug("No livestream viewer, releasing the camera")
+                        self._release_camera()
+                    continue
+                idle_since = perf_counter()
+                if self._camera is None:
+                    if perf_counter() < retry_at:
+                        self._poll(server, min(0.5, retry_at - perf_counter()))
+                        continue
+                    try:
+                        self._camera = self._open_camera()
+                        last_frame = perf_counter()
+                    except Exception as e:
+                        logger.warning(f"Livestream camera unavailable ({e!r}), retrying in {retry_seconds:.1f}s")
+                        retry_at = perf_counter() + retry_seconds
+                        retry_seconds = min(2*retry_seconds, self.RETRY_MAX_SECONDS)
+                        continue
+                try:
+                    flag, frame = capture_format.read(self._camera)
+                except Exception:
+                    logger.exception("Error reading the livestream camera")
+                    flag, frame = False, None
+                #the camera read paces the loop, handle the requests received while waiting for the frame
+                self._poll(server, 0)
+                if not flag:
+                    if perf_counter() - last_frame > self.NO_FRAME_SECONDS:
+                        logger.warning("No frame from the livestream camera, opening it again")
+                        self._release_camera()
+                        retry_at = perf_counter() + retry_seconds
+                        retry_seconds = min(2*retry_seconds, self.RETRY_MAX_SECONDS)
+                    else:
+                        sleep(0.01)
+                    continue
+                last_frame = perf_counter()
+                retry_seconds = self.RETRY_MIN_SECONDS
+                tiers = {state['tier'] for state in self._connections.values() if state['requests'] > 0}
+                if len(tiers) == 0:
+                    continue #read to keep the frames fresh, but nobody needs this one
+                self._send_frame(encode_livestream_tiers(capture_format.to_bgr(frame), tiers))
+        finally:
+            logger.info("Livestream producer stopping")
+            for connection in list(self._connections):
+                self._close(connection)
+            self._selector.close()
+            server.close()
+            if not self._camera is None:
+                self._release_camera()
+            if os.path.exists(self.SOCKET_PATH):
+                os.remove(self.SOCKET_PATH)
+    
+    def release(self):
+        #only requests the stop, start() cleans up once its loop exits
+        self._stop = True
+
+def run_livestream_producer():
+    """Target of the livestream producer process started with the webapp"""
+    producer = LiveStreamProducer()
+    signal.signal(signal.SIGTERM, lambda *args, **kwargs : producer.release())
+    signal.signal(signal.SIGINT, lambda *args, **kwargs : producer.release())
+    producer.start()
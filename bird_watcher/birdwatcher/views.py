@@ -1,9 +1,12 @@
 from django.shortcuts import render
-from birdwatcher.models import Video, Tag
+from birdwatcher.models import Video, Tag, VideoTag, Segment
 from birdwatcher.forms import TagVideoForm, ConstanceSettingsForm
-from birdwatcher.utils import start_or_restart_birdwatcher, kill_birdwatcher, watcher_is_running, FrameConsumer
+from birdwatcher.utils import start_or_restart_birdwatcher, kill_birdwatcher, watcher_is_running, concat_segments, fetch_metrics, VideoFileCache, LiveStreamProducer, LIVESTREAM_TIERS, LIVESTREAM_PART_HEADER, FileRemover
 from django.views.generic import View, ListView, DetailView
 from django.http import HttpRequest
+from django.db.models import Q, QuerySet, Count
+from django.db import transaction
+from django.core.exceptions import BadRequest
 from django.shortcuts import get_object_or_404
 from django.urls import reverse
 from django.conf import settings
@@ -11,15 +14,19 @@ from constance import config
 from django.http import HttpResponse, HttpResponseNotModified
 from django.views.generic.edit import FormMixin
 from json import loads, dumps
-from fastapi import APIRouter, HTTPException, Request, status
+from fastapi import APIRouter, HTTPException, Request, Query, status
 from fastapi.responses import StreamingResponse, FileResponse, Response, RedirectResponse
-from threading import Thread
-import os, cv2, logging
-from typing import BinaryIO
-from starlette._compat import md5_hexdigest
-from datetime import datetime
-from time import sleep
-from asyncio import sleep as asleep
+from fastapi.staticfiles import StaticFiles
+from threading import Lock
+import os, logging
+from hashlib import md5
+from functools import lru_cache
+from email.utils import formatdate
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime, date, time, timedelta, timezone
+from time import monotonic
+from asyncio import sleep as asleep, to_thread, wait_for, create_task, open_unix_connection, Event, Task, IncompleteReadError, Queue as AsyncQueue, Lock as AsyncLock
+from struct import unpack
 
 logger = logging.getLogger(settings.PROJECT_NAME)
 
@@ -32,7 +39,7 @@ class GlobalContextMixin:
             context = super().get_context_data(**kwargs)
         except:
             context = kwargs
-        context['all_tags'] = list(t.name for t in Tag.objects.all())
+        context['all_tags'] = Tag.all_names()
         if 'video' in context:
             context['url_edit_video_tags'] = reverse(VideoTagView.url_name, args=(context['video'].pk,))
             context['url_this_video'] = reverse(SingleVideoView.url_name, args=(context['video'].pk,))
@@ -40,19 +47,111 @@ class GlobalContextMixin:
         context['url_home_videos_page'] = reverse(VideoListView.url_name)
         return context
 
+def _video_cursor(video:Video) -> str:
+    return urlsafe_b64encode(f"{video.date_created.isoformat()}|{video.pk}".encode()).decode()
+
+def videos_page(queryset:QuerySet, cursor:str|None, size:int) -> tuple[list[Video], str|None]:
+    """The `size` videos of the queryset after the `cursor`, from the newest, and the cursor of the next page
+    (None if it's the last). Seeks to the cursor with the index on (date_created, id) instead of counting
+    the videos before it. Raises ValueError if the cursor is invalid"""
+    queryset = queryset.order_by('-date_created', '-pk')
+    if cursor:
+        try:
+            date_created, pk = urlsafe_b64decode(cursor.encode()).decode().rsplit('|', 1)
+            date_created, pk = datetime.fromisoformat(date_created), int(pk)
+        except Exception as e:
+            raise ValueError(f"Invalid cursor {cursor!r}") from e
+        queryset = queryset.filter(Q(date_created__lt=date_created) | Q(date_created=date_created, pk__lt=pk))
+    videos = list(queryset[:size+1])
+    if len(videos) <= size:
+        return videos, None
+    return videos[:size], _video_cursor(videos[size-1])
+
+def _date_bound(value:str, end:bool) -> datetime:
+    #dates are stored in local time, as if it were UTC
+    try:
+        moment = datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"Invalid date {value!r}")
+    if len(value) <= 10:
+        moment = datetime.combine(date.fromisoformat(value), time()) + timedelta(days=int(end))
+    return moment if not moment.tzinfo is None else moment.replace(tzinfo=timezone.utc)
+
+def _date_range(prefix:str, after:str|None, before:str|None) -> Q:
+    #a day as `before` includes the whole day
+    q = Q()
+    if after:
+        q &= Q(**{prefix+'date_created__gte':_date_bound(after, False)})
+    if before:
+        bound = _date_bound(before, True)
+        q &= Q(**{prefix+('date_created__lt' if len(before) <= 10 else 'date_created__lte'):bound})
+    return q
+
+def filter_videos(queryset:QuerySet, tags:list[str]=(), match:str='all',
+                  after:str|None=None, before:str|None=None) -> QuerySet:
+    """The videos with all (`match`='all') or any (`match`='any') of the `tags`, created from `after` to
+    `before` (ISO dates or date-times, a date includes the whole day). The tags are matched on the index of
+    the tags of videos by tag. Raises ValueError if `match` or a date is invalid"""
+    if not match in ('all', 'any'):
+        raise ValueError(f"Invalid match {match!r}, expected 'all' or 'any'")
+    queryset = queryset.filter(_date_range('', after, before))
+    names = set(Tag.normalize_name(t) for t in tags if t.strip())
+    if len(names) > 0:
+        tagged = VideoTag.objects.filter(tag__name__in=names)
+        if match == 'all' and len(names) > 1:
+            tagged = tagged.values('video').annotate(tags_count=Count('tag')).filter(tags_count=len(names))
+        queryset = queryset.filter(pk__in=tagged.values('video'))
+    return queryset
+
+def tag_counts(after:str|None=None, before:str|None=None) -> list[tuple[str,int]]:
+    """The name of each tag and its number of videos created from `after` to `before`, in one query.
+    Raises ValueError if a date is invalid"""
+    #counted from the tags of videos, the videos in the date range are found with the index on their date
+    counts = dict(VideoTag.objects.filter(_date_range('video__', after, before)).values_list('tag__name')
+                                  .annotate(videos_count=Count('video')).order_by())
+    return [(name, counts.get(name, 0)) for name in Tag.all_names()]
+
 #####################
 ###### Pages
 
 class VideoListView(GlobalContextMixin, ListView):
     model = Video
-    paginate = 50
-    queryset = Video.objects.order_by('-date_created')
+    #videos per page, the next ones are loaded when scrolling to the end of the page
+    page_size = 50
+    queryset = Video.objects.all()
+    context_object_name = 'video_list'
     template_name = 'videos.html'
     url_name = 'video-list'
+    
+    def get_queryset(self):
+        self.filters = {'tags':self.request.GET.getlist('tag'), 'match':self.request.GET.get('match', 'all'),
+                        'after':self.request.GET.get('after'), 'before':self.request.GET.get('before')}
+        try:
+            queryset = filter_videos(super().get_queryset(), **self.filters)
+            videos, self.next_cursor = videos_page(queryset, self.request.GET.get('cursor'), self.page_size)
+        except ValueError as e:
+            raise BadRequest(str(e))
+        return videos
 
     def get_context_data(self, **kwargs):
         # Call the base implementation first to get the context
-        return super().get_context_data(**kwargs)
+        context = super().get_context_data(**kwargs)
+        context['next_cursor'] = self.next_cursor
+        #width of the cards, for the browser to pick the size of the thumbnails
+        context['thumbnail_sizes'] = "(min-width: 992px) 25vw, (min-width: 768px) 33vw, (min-width: 576px) 50vw, 100vw"
+        selected = set(Tag.normalize_name(t) for t in self.filters['tags'])
+        context['tag_counts'] = [(name, count, name in selected)
+                                 for name, count in tag_counts(self.filters['after'], self.filters['before'])]
+        context['filters'] = self.filters
+        #the filters as a query string to keep when loading the next videos
+        query = self.request.GET.copy()
+        query.pop('cursor', None)
+        context['filter_query'] = query.urlencode()
+        #the filter of the bulk endpoint to change all the videos matching the filters
+        context['bulk_filter'] = {'tag':self.filters['tags'], 'match':self.filters['match'],
+                                  'after':self.filters['after'], 'before':self.filters['before']}
+        context['bulk_url'] = reverse(BulkVideosView.url_name)
+        return context
 
 class LiveStreamView(GlobalContextMixin, View):
     template_name = 'livestream.html'
@@ -61,7 +160,7 @@ class LiveStreamView(GlobalContextMixin, View):
     # Cf. https://github.com/umlaeute/v4l2loopback to create a loopback livestream device
     
     def get(self, request, *args, **kwargs):
-        context = {}
+        context = {'tiers':list(LiveStreamVideo.TIERS)}
         return render(request, self.template_name, context)
 
 class ConfigView(GlobalContextMixin, FormMixin, View):
@@ -118,26 +217,35 @@ class SingleVideoView(GlobalContextMixin, FormMixin, DetailView):
         context['video'] = context.pop('object')
         context['tag_list'] = list(context['video'].tags.values_list('name',flat=True))
         context['tag_url'] = reverse('video-tags', args=(context['video'].pk,))
+        #the time picked in the hover preview of the video list
+        try:
+            context['start_time'] = max(0.0, float(self.request.GET.get('t', 0)))
+        except ValueError:
+            context['start_time'] = 0.0
         return context
     
     def delete(self, request, *args, pk=None, **kwargs):
         vid:Video = get_object_or_404(self.queryset, pk=pk)
-        try:
-            os.remove(vid.video_file)
-        except:
-            logger.exception(f"Unable to delete file vide file '{vid.video_file}'")
-        vid.thumbnail_file.delete(True)
-        vid.delete()
+        #the file names come from the pk, which the delete clears
+        files = vid.files
+        with transaction.atomic():
+            vid.delete()
+            transaction.on_commit(lambda: FileRemover.getSingleton().remove(files))
         return HttpResponse('', status=status.HTTP_204_NO_CONTENT)
     
     def patch(self, request, *args, pk=None, **kwargs):
         data = loads(request.body)
         instance:Video = get_object_or_404(self.queryset, pk=pk)
-        if len(data.get('title', '').strip()) > 0:
-            instance.title = data['title']
+        has_title = len(data.get('title', '').strip()) > 0
+        if has_title or isinstance(data.get('starred'), bool):
+            if has_title:
+                instance.title = data['title']
+            if isinstance(data.get('starred'), bool):
+                instance.starred = data['starred']
             instance.save()
             return HttpResponse(status=status.HTTP_200_OK)
-        return HttpResponse(dumps({'error':f'"title" field is empty, blank or not found in request data', 
+        return HttpResponse(dumps({'error':f'"title" field is empty, blank or not found in request data '
+                                            'and no boolean "starred" field', 
                                    'content':data}),
                             status=status.HTTP_400_BAD_REQUEST,
                             content_type='application/json')
@@ -151,7 +259,11 @@ class VideoTagView(View):
      
     def post(self, request:HttpRequest, *args, pk=None, **kwargs):
         post = loads(request.body)
-        tag,_ = Tag.objects.get_or_create(name=post.get('tag'))
+        name = Tag.normalize_name(str(post.get('tag') or ''))
+        if len(name) == 0:
+            return HttpResponse('"tag" field is empty, blank or not found in request data', status=status.HTTP_400_BAD_REQUEST)
+        #the name is unique, if another request creates the tag first it is fetched instead
+        tag,_ = Tag.objects.get_or_create(name=name)
         # tag = get_object_or_404(Tag.objects.all(), pk=post.get('tag'))
         vid = get_object_or_404(self.queryset, pk=pk)
         vid.tags.add(tag)
@@ -161,96 +273,192 @@ class VideoTagView(View):
     def delete(self, request:HttpRequest, *args, pk=None, **kwargs):
         vid:Video = get_object_or_404(self.queryset, pk=pk)
         post = loads(request.body)
-        tag = vid.tags.filter(name=post.get('tag'))
+        tag = vid.tags.filter(name=Tag.normalize_name(str(post.get('tag') or '')))
         if tag.count() == 0:
             return HttpResponseNotModified()
         tag = tag.first()
         vid.tags.remove(tag)
         return HttpResponse('', status=204)
     
+class BulkVideosView(View):
+    url_name = 'videos-bulk'
+    #most videos given by id in a request
+    MAX_IDS = 5000
+    ACTIONS = ('delete', 'tag', 'untag', 'retitle')
+    
+    @staticmethod
+    def _error(message:str):
+        return HttpResponse(dumps({'error':message}), status=status.HTTP_400_BAD_REQUEST, content_type='application/json')
+    
+    def _videos(self, data:dict) -> QuerySet:
+        """The videos given by `ids`, or by a `filter` like the video list's (tag, match, after, before).
+        Raises ValueError if neither is valid"""
+        if 'ids' in data:
+            ids = data['ids']
+            #true and false are ints to python, not to the client
+            if not isinstance(ids, list) or not all(isinstance(pk, int) and not isinstance(pk, bool) for pk in ids):
+                raise ValueError('"ids" must be a list of video ids')
+            if len(ids) > self.MAX_IDS:
+                raise ValueError(f'At most {self.MAX_IDS} "ids", use a "filter" for more videos')
+            return Video.objects.filter(pk__in=ids)
+        filters = data.get('filter')
+        if not isinstance(filters, dict) or not any(filters.get(k) for k in ('tag', 'after', 'before')):
+            raise ValueError('"ids" or a "filter" with a "tag", "after" or "before" is required')
+        tags = filters.get('tag') or []
+        if not isinstance(tags, (str, list)):
+            raise ValueError('"tag" must be a tag name or a list of them')
+        return filter_videos(Video.objects.all(), [tags] if isinstance(tags, str) else [str(t) for t in tags],
+                             filters.get('match', 'all'), filters.get('after'), filters.get('before'))
+    
+    def post(self, request:HttpRequest, *args, **kwargs):
+        """Applies an `action` to many videos in one transaction: 'delete' them, 'tag' or 'untag' them with `tag`,
+        or 'retitle' them to `title`. The files of deleted videos are removed in the background.
+        Returns the number of videos changed"""
+        try:
+            data = loads(request.body)
+            if not isinstance(data, dict):
+                raise ValueError('The body must be a JSON object')
+            action = data.get('action')
+            if not action in self.ACTIONS:
+                raise ValueError(f'"action" must be one of {", ".join(self.ACTIONS)}')
+            videos = self._videos(data)
+            if action in ('tag', 'untag'):
+                name = Tag.normalize_name(str(data.get('tag') or ''))
+                if len(name) == 0 or len(name) > Tag._meta.get_field('name').max_length:
+                    raise ValueError('"tag" is empty or too long')
+            elif action == 'retitle':
+                title = str(data.get('title') or '').strip()
+                if len(title) == 0:
+                    raise ValueError('"title" is empty')
+        except ValueError as e:
+            return self._error(str(e))
+        
+        with transaction.atomic():
+            if action == 'delete':
+                #only what the paths of the files need
+                deleted = list(videos.only('pk', 'video_file', 'thumbnail_file', 'thumbnail_widths', 'thumbnail_avif',
+                                           'preview_tiles'))
+                count = len(deleted)
+                videos.delete()
+                paths = [f for v in deleted for f in v.files]
+                transaction.on_commit(lambda: FileRemover.getSingleton().remove(paths))
+            elif action == 'tag':
+                tag,_ = Tag.objects.get_or_create(name=name)
+                pks = list(videos.values_list('pk', flat=True))
+                #the videos already tagged are skipped by the unique index
+                VideoTag.objects.bulk_create([VideoTag(video_id=pk, tag=tag) for pk in pks],
+                                             ignore_conflicts=True, batch_size=500)
+                count = len(pks)
+            elif action == 'untag':
+                count, _ = VideoTag.objects.filter(tag__name=name, video__in=videos).delete()
+            else:
+                count = videos.update(title=title)
+        logger.info(f"Bulk {action} of {count} videos")
+        return HttpResponse(dumps({'action':action, 'videos':count}), status=status.HTTP_200_OK,
+                            content_type='application/json')
+
 ##################
 #### Streaming views
 
+class _LiveStreamClient:
+    def __init__(self, max_fps:float|None=None, tier:str='full') -> None:
+        """A client of the livestream. Its mailbox only holds the latest frame so a slow client
+        skips frames instead of falling behind, and it is only offered frames at `max_fps`"""
+        self.tier = tier
+        self.frames:AsyncQueue[bytes|None] = AsyncQueue(maxsize=1)
+        self.interval = 1/max_fps if max_fps else 0.0
+        self.next_due = monotonic()
+    
+    def offer(self, frame:bytes|None):
+        if self.frames.full():
+            self.frames.get_nowait()
+        self.frames.put_nowait(frame)
+
 class LiveStreamVideo:
     _singelton = None
-    _max_unread_frames = 30
+    #the connection of a tier stays open this long after its last viewer left, so a page reload can reuse it
+    IDLE_SECONDS = 2
+    TIERS = LIVESTREAM_TIERS
     
     def __init__(self):
-        """The class is used by the livestream endpoint.
-        It creates a singleton that reads from a camera device (must be an unused device)
-        and posts the frames read to a shared variable. 
-        
-        Whenever a client requests a frame it waits to be notified by the camera reader thread.
-        Once notified it can send the frame to the client.
+        """The class is used by the livestream endpoint, there is a singleton per webapp worker.
         
-        To be able to reuse the camera device for motion detection and livestream a device
-        loopback like v4l2loopback should be used
+        The camera is read and the frames encoded once by the LiveStreamProducer process, shared by
+        all the workers. The worker only relays the frames: it opens a connection to the producer per
+        tier with viewers and requests a frame whenever a viewer of the tier is waiting and due for one.
+        The frame is put in the mailbox of the clients, which only wake up when they get a frame.
         """
-        self._frame_num = 0
-        self._frames_since_last_query = 0
-        self._current_frame = b''
-        self._interrupt = [False]
-        self._thread = None
+        self._clients:set[_LiveStreamClient] = set()
+        self._relays:dict[str,Task] = {}
+        self._wakeups:dict[str,Event] = {}
         LiveStreamVideo._singelton = self
-        
-    def _start_thread(self):
-        if not self._thread is None:
-            return
-        self._interrupt[0] = False
-        self._thread = Thread(target=LiveStreamVideo._run, args=(self,))
-        self._thread.start()
+    
+    def _wake(self, tier:str):
+        self._wakeups.setdefault(tier, Event()).set()
+    
+    def _next_request(self, tier:str) -> float|None:
+        """When the first viewer of `tier` waiting for a frame is due for one, None if none is waiting"""
+        return min((c.next_due for c in self._clients if c.tier == tier and c.frames.empty()), default=None)
     
     @staticmethod
-    def _run(singleton:'LiveStreamVideo'):
-        #open camera and read frames
+    async def _wait(event:Event, timeout:float|None):
+        try:
+            await wait_for(event.wait(), timeout)
+        except TimeoutError:
+            pass
+    
+    async def _relay(self, tier:str):
+        wakeup = self._wakeups.setdefault(tier, Event())
+        writer = None
         try:
-            sleep(0.1) #wait for frame request
-            vid = None
-            match settings.DEVICE_DUPLICATION.lower():
-                case 'socket':
-                    vid = FrameConsumer()
-                case 'v4l2loopback':
-                    vid = cv2.VideoCapture(settings.STREAM_VID_DEVICE, cv2.CAP_V4L2)
-                    try:
-                        width, height = str(config.VID_RESOLUTION).split('x',1)
-                        vid.set(cv2.CAP_PROP_FRAME_WIDTH, int(width))
-                        vid.set(cv2.CAP_PROP_FRAME_HEIGHT, int(height))
-                    except: pass
-                case _:
-                    raise RuntimeError("No video duplication available for streaming")
-            while not singleton._interrupt[0]:
-                flag, frame = vid.read()
-                if not flag:
+            reader, writer = await open_unix_connection(LiveStreamProducer.SOCKET_PATH)
+            writer.write(tier.encode() + b'\n')
+            idle_since = monotonic()
+            while True:
+                wakeup.clear()
+                if not any(c.tier == tier for c in self._clients):
+                    if monotonic() - idle_since >= LiveStreamVideo.IDLE_SECONDS:
+                        return
+                    await self._wait(wakeup, LiveStreamVideo.IDLE_SECONDS - (monotonic() - idle_since))
                     continue
-                singleton._current_frame = LiveStreamVideo.format_frame(cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, 70])[1])
-                singleton._frame_num += 1
-                singleton._frames_since_last_query += 1
-                if singleton.unread_frames >= singleton._max_unread_frames:
-                    singleton._kill_thread()
+                idle_since = monotonic()
+                due = self._next_request(tier)
+                if due is None or due > idle_since:
+                    #woken up when a viewer takes its frame or joins
+                    await self._wait(wakeup, None if due is None else due - idle_since)
+                    continue
+                writer.write(b'\x01')
+                await writer.drain()
+                length = unpack('>I', await reader.readexactly(4))[0]
+                frame = await reader.readexactly(length)
+                now = monotonic()
+                for client in self._clients:
+                    if client.tier == tier and now >= client.next_due:
+                        client.offer(frame)
+        except (OSError, IncompleteReadError):
+            logger.warning(f"Livestream producer unavailable for tier {tier}")
         finally:
-            if not vid is None:
-                vid.release()
+            self._relays.pop(tier, None)
+            if not writer is None:
+                writer.close()
+            #ends the streams if the producer is gone
+            for client in self._clients:
+                if client.tier == tier:
+                    client.offer(None)
     
-    @property
-    def unread_frames(self):
-        return self._frames_since_last_query
+    def subscribe(self, client:_LiveStreamClient):
+        self._clients.add(client)
+        self._wake(client.tier)
+        if not client.tier in self._relays:
+            self._relays[client.tier] = create_task(self._relay(client.tier))
     
-    def _kill_thread(self):
-        if self._thread is None:
-            return
-        self._interrupt[0] = True
-        self._thread = None
-
-    async def get_frame(self, curr_frame_num:int):
-        while self._frame_num <= curr_frame_num:
-            await asleep(0.01) #wait 1 frame time (~30fps)
-        curr_frame_num = self._frame_num
-        self._frames_since_last_query = 0
-        return self._current_frame, curr_frame_num
+    def unsubscribe(self, client:_LiveStreamClient):
+        self._clients.discard(client)
+        self._wake(client.tier)
     
-    @staticmethod
-    def format_frame(frame):
-        return b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + bytearray(frame) + b'\r\n'
+    @property
+    def subscribers(self) -> int:
+        return len(self._clients)
     
     @staticmethod
     def getSingleton():
@@ -259,120 +467,241 @@ class LiveStreamVideo:
         return LiveStreamVideo._singelton
     
     @staticmethod
-    async def livestream_frame_generator():
+    async def livestream_frame_generator(max_fps:float|None=None, tier:str='full'):
         stream = LiveStreamVideo.getSingleton()
-        stream._start_thread()
-        curr_num = 0
-        while stream.unread_frames < LiveStreamVideo._max_unread_frames:
-            frame, curr_num = await stream.get_frame(curr_num)
-            yield frame
-        return
+        client = _LiveStreamClient(max_fps, tier)
+        stream.subscribe(client)
+        try:
+            while True:
+                frame = await client.frames.get()
+                if frame is None:
+                    return
+                #on schedule rather than from the frame received, which comes up to a frame late
+                client.next_due = max(client.next_due + client.interval, monotonic())
+                #the relay can request the next frame
+                stream._wake(tier)
+                yield frame
+        finally:
+            #also when the client disconnects and the response is cancelled
+            stream.unsubscribe(client)
     
+class CameraSnapshot:
+    _singelton = None
+    #time to wait for a frame from the livestream producer
+    TIMEOUT = 2
+    
+    def __init__(self):
+        """The latest image of the camera for /stream/single, kept in memory by each worker.
+        It is a frame of the full livestream tier, taken when a request finds the image older than
+        SNAPSHOT_INTERVAL: nothing is encoded while nobody asks, and nothing more while someone
+        watches the livestream. Concurrent requests wait for the same frame"""
+        self._image:bytes|None = None
+        self._etag = ''
+        self._taken = 0.0
+        self._lock:AsyncLock|None = None
+    
+    @property
+    def age(self) -> float:
+        return monotonic() - self._taken
+    
+    async def _take(self) -> bytes|None:
+        stream = LiveStreamVideo.getSingleton()
+        client = _LiveStreamClient(None, 'full')
+        stream.subscribe(client)
+        try:
+            part = await wait_for(client.frames.get(), CameraSnapshot.TIMEOUT)
+        except TimeoutError:
+            part = None
+        finally:
+            stream.unsubscribe(client)
+        if part is None:
+            return None
+        return part[len(LIVESTREAM_PART_HEADER):-2]
+    
+    async def get(self) -> bytes|None:
+        """The JPEG image, None if the camera can't be read"""
+        if not self._image is None and self.age < settings.SNAPSHOT_INTERVAL:
+            return self._image
+        if self._lock is None:
+            self._lock = AsyncLock()
+        async with self._lock:
+            #taken while waiting for the lock
+            if not self._image is None and self.age < settings.SNAPSHOT_INTERVAL:
+                return self._image
+            image = await self._take()
+            if image is None:
+                return None
+            self._image, self._taken = image, monotonic()
+            self._etag = f'"{md5(image, usedforsecurity=False).hexdigest()}"'
+            return image
+    
+    @property
+    def etag(self) -> str:
+        return self._etag
+    
+    @staticmethod
+    def getSingleton():
+        if CameraSnapshot._singelton is None:
+            CameraSnapshot._singelton = CameraSnapshot()
+        return CameraSnapshot._singelton
+
 @api_router.get('/stream/single')
-def get_current_camera_view(request:Request):
+async def get_current_camera_view(request:Request):
+    if settings.DEVICE_DUPLICATION.lower() in ('socket', 'shm', 'v4l2loopback'):
+        snapshot = CameraSnapshot.getSingleton()
+        image = await snapshot.get()
+        if not image is None:
+            #cached by the browser until the next one can be taken
+            headers = {"Cache-Control":f"max-age={max(0, int(settings.SNAPSHOT_INTERVAL - snapshot.age))}",
+                       "ETag":snapshot.etag}
+            if request.headers.get("if-none-match") == snapshot.etag:
+                return Response(None, status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+            return Response(image, media_type="image/jpeg", headers=headers)
+    #the frame saved by the motion detector when it started
     if os.path.exists(os.path.join(settings.STATICFILES_DIRS[0], 'single_frame.webp')):
         return FileResponse('static/single_frame.webp', headers={"Cache-Control":"no-cache"})
     return FileResponse('static/no-stream.jpg', headers={"Cache-Control":"max-age=600"})
 
 @api_router.get('/stream/live')
-async def livestream_video():
+async def livestream_video(fps:float|None=None, tier:str='full'):
+    #`fps` caps the frame rate sent to this client, `tier` is one of LiveStreamVideo.TIERS
+    if not tier in LiveStreamVideo.TIERS:
+        raise HTTPException(status_code=400, detail=f"Unknown tier '{tier}', expected one of {list(LiveStreamVideo.TIERS)}")
     if len(settings.STREAM_VID_DEVICE) == 0:
         return RedirectResponse('/static/no-stream.jpg')
-    return StreamingResponse(LiveStreamVideo.livestream_frame_generator(),
+    return StreamingResponse(LiveStreamVideo.livestream_frame_generator(fps if fps and fps > 0 else None, tier),
                       media_type="multipart/x-mixed-replace;boundary=frame")
 
-def send_bytes_range_requests(file_obj: BinaryIO,
-                              start: int, end: int, chunk_size: int = 128*1024):
-    """Send a file in chunks using Range Requests specification RFC7233
-    `start` and `end` parameters are inclusive due to specification
-    """
-    with file_obj as f:
-        f.seek(start)
-        while (pos := f.tell()) <= end:
-            read_size = min(chunk_size, end + 1 - pos)
-            yield f.read(read_size)
-
-
-def _get_range_header(range_header: str, file_size: int) -> tuple[int, int]:
-    def _invalid_range():
-        return HTTPException(
-            status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
-            detail=f"Invalid request range (Range:{range_header!r})")
-
-    try:
-        h = range_header.replace("bytes=", "").split("-")
-        start = int(h[0]) if h[0] != "" else 0
-        end = int(h[1]) if h[1] != "" else file_size - 1
-    except ValueError:
-        raise _invalid_range()
-
-    if start > end or start < 0 or end > file_size - 1:
-        raise _invalid_range()
-    return start, end
-
+class VideoFileResponse(FileResponse):
+    """Starlette's file response answers Range (several ranges too) and If-Range itself and the server
+    can send the file with sendfile if it supports the pathsend extension. Otherwise the file is read
+    in a thread in large chunks, a lot less of them than starlette's 64KB when scrubbing through a clip"""
+    chunk_size = 1024*1024
+
+class ThumbnailFiles(StaticFiles):
+    """The thumbnails are never changed once written (the pk in their name isn't reused), browsers can keep them"""
+    def file_response(self, *args, **kwargs) -> Response:
+        response = super().file_response(*args, **kwargs)
+        response.headers["cache-control"] = "public, max-age=31536000, immutable"
+        return response
+
+@lru_cache(maxsize=1024)
+def _file_etag(file_path:str, size:int, mtime:float) -> str:
+    #same as starlette's so If-Range matches it
+    return f'"{md5(f"{mtime}-{size}".encode(), usedforsecurity=False).hexdigest()}"'
+
+def _etag_matches(if_none_match:str|None, etag:str) -> bool:
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    return etag in (e.strip().removeprefix('W/') for e in if_none_match.split(','))
 
 def range_requests_response(
-    request: Request, file_path: str, content_type: str
+    request: Request, file_path: str, content_type: str, stat_result: os.stat_result|None = None
 ):
-    """Returns StreamingResponse using Range Requests of a given file"""
-
-    file_size = os.stat(file_path).st_size
-    range_header = request.headers.get("range")
-
-    """Compose etag from last_modified and file_size"""
-    last_modified = datetime.fromtimestamp(os.stat(file_path).st_mtime).strftime("%a, %d %b %Y %H:%M:%S")
-    etag_base = str(last_modified) + "-" + str(file_size)
-    etag = f'"{md5_hexdigest(etag_base.encode(), usedforsecurity=False)}"'
-
-    """Check if the browser sent etag matches the videos etag"""
-    request_if_non_match_etag = request.headers.get("if-none-match")
-
-    """if there is a match return 304 unmodified instead of 206 response without video file"""
-    if request_if_non_match_etag == etag:
+    """Returns the file answering Range Requests (RFC7233), or 304 if the browser has it already.
+    The file is only stat'ed if `stat_result` isn't given"""
+    if stat_result is None:
+        stat_result = os.stat(file_path)
+    etag = _file_etag(file_path, stat_result.st_size, stat_result.st_mtime)
+
+    """if the browser sent etag matches the videos etag return 304 unmodified without video file"""
+    if _etag_matches(request.headers.get("if-none-match"), etag):
         headers = {
             "cache-control": "public, max-age=86400, stale-while-revalidate=2592000",
             "etag" : etag,
-            "last-modified":str(last_modified),
+            "last-modified": formatdate(stat_result.st_mtime, usegmt=True),
         }
-        status_code = status.HTTP_304_NOT_MODIFIED
-        return Response(None, status_code=status_code, headers=headers)
+        return Response(None, status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
 
     headers = {
         "etag" : etag,
-        "content-type": content_type,
-        "accept-ranges": "bytes",
-        "content-encoding": "identity",
-        "content-length": str(file_size),
         "access-control-expose-headers": (
             "content-type, accept-ranges, content-length, "
             "content-range, content-encoding"
         ),
     }
-
-    if range_header is not None:
-        start, end = _get_range_header(range_header, file_size)
-        size = end - start + 1
-        headers["content-length"] = str(size)
-        headers["content-range"] = f"bytes {start}-{end}/{file_size}"
-        status_code = status.HTTP_206_PARTIAL_CONTENT
-    else:
-        start, end = 0, file_size - 1
-        status_code = status.HTTP_200_OK        
-
-    return StreamingResponse(
-        send_bytes_range_requests(open(file_path, mode="rb"), start, end),
-        headers=headers,
-        status_code=status_code,
-    )
+    return VideoFileResponse(file_path, headers=headers, media_type=content_type, stat_result=stat_result)
+
+_event_video_lock = Lock()
+
+def write_event_video(vid:Video) -> bool:
+    """Writes the video file of a movement recorded in segments by joining them.
+    Returns False if the movement is still being recorded"""
+    with _event_video_lock:
+        if os.path.exists(vid.video_file):
+            return True
+        if vid.event_end is None:
+            return False
+        segments = list(Segment.objects.filter(start__lt=vid.event_end, end__gt=vid.event_start).order_by('start'))
+        if (len(segments) == 0 or segments[-1].end < vid.event_end) and watcher_is_running():
+            return False #the last segment is still being written
+        vid.num_frames = concat_segments(segments, vid.video_file, vid.event_start, vid.event_end)
+        #the video is now a file like the others, the segments can be deleted by the recorder
+        vid.event_start, vid.event_end = None, None
+        vid.file_size = os.path.getsize(vid.video_file)
+        vid.save()
+        return True
 
 @api_router.get('/stream/{pk}')
 async def stream_video_file(request:Request, pk:int):
+    cache = VideoFileCache.getSingleton()
+    cached = cache.get(pk)
+    if not cached is None:
+        file_path, stat_result = cached
+        #another process may have deleted it since, then it's looked up again
+        if os.path.exists(file_path):
+            return range_requests_response(request, file_path, content_type='media/mp4', stat_result=stat_result)
+        cache.invalidate(pk)
     try:
         vid = await Video.objects.aget(pk=pk)
     except:
         return Response(status_code=404)
     
-    return range_requests_response(request, vid.video_file, content_type='media/mp4')
+    if not vid.event_start is None and not os.path.exists(vid.video_file):
+        try:
+            if not await to_thread(write_event_video, vid):
+                return Response(status_code=503, headers={"Retry-After":"5"})
+        except FileNotFoundError:
+            logger.exception(f"Segments of video {pk} not found")
+            return Response(status_code=404)
+    try:
+        stat_result = os.stat(vid.video_file)
+    except FileNotFoundError:
+        return Response(status_code=404)
+    cache.put(pk, vid.video_file, stat_result)
+    return range_requests_response(request, vid.video_file, content_type='media/mp4', stat_result=stat_result)
+
+@api_router.get("/birdwatcher/videos")
+async def list_videos(cursor:str|None=None, limit:int=50, tag:list[str]=Query(default=[]), match:str='all',
+                      after:str|None=None, before:str|None=None):
+    """A page of videos from the newest, and the cursor to get the next page with (null on the last one).
+    Filtered by `tag` (several with `match` 'all' or 'any') and creation dates `after` and `before`"""
+    try:
+        queryset = filter_videos(Video.objects.all(), tag, match, after, before)
+        videos, next_cursor = await to_thread(videos_page, queryset, cursor, min(max(limit, 1), 200))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {'videos':[{'pk':v.pk, 'title':v.title, 'date_created':v.date_created.isoformat(),
+                       'duration':v.num_frames/v.framerate if v.framerate else None,
+                       'thumbnail_url':v.thumbnail_url if v.thumbnail_file else None,
+                       'thumbnail_srcset':v.thumbnail_srcset, 'thumbnail_avif_srcset':v.thumbnail_avif_srcset,
+                       'preview_url':v.preview_url, 'preview_index_url':v.preview_index_url,
+                       'preview_tiles':v.preview_tiles, 'starred':v.starred,
+                       'url':reverse(SingleVideoView.url_name, args=(v.pk,)),
+                       'stream_url':f'/stream/{v.pk}'}
+                      for v in videos],
+            'next':next_cursor}
+
+@api_router.get("/birdwatcher/tags")
+async def list_tags(after:str|None=None, before:str|None=None):
+    """The tags and their number of videos created from `after` to `before`"""
+    try:
+        counts = await to_thread(tag_counts, after, before)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return [{'name':name, 'count':count} for name, count in counts]
 
 @api_router.get("/favicon.ico")
 async def get_favicon():
@@ -410,3 +739,12 @@ async def stop_watcher():
 @api_router.get("/birdwatcher/motion")
 async def get_watcher_state():
     return Response("true" if watcher_is_running() else "false", status_code=200)
+
+@api_router.get("/birdwatcher/metrics")
+async def get_watcher_metrics():
+    #snapshot of the motion detector's metrics, the page computes the rates between two of them
+    snapshot = await to_thread(fetch_metrics)
+    if snapshot is None:
+        return Response(dumps({"error": "Motion detector metrics unavailable"}), status_code=503, media_type="application/json")
+    return Response(dumps(snapshot), status_code=200, media_type="application/json",
+                    headers={'Cache-Control':'no-store'})
@@ -24,10 +24,10 @@ python3 manage.py migrate
 cd ..
 
 echo '***********************\nAdding Unix Socket\n***********************'
-read -n1 -p "Would you like to use a unix socket to distribute frames? (y/n): " answer
+read -n1 -p "Would you like to use shared memory to distribute frames? (y/n): " answer
 echo ''
 if [[ "$answer" =~ ^[Yy]$ ]]; then
-    sed "s/^DEVICE_DUPLICATION=.*$/DEVICE_DUPLICATION=socket/g" .env -i
+    sed "s/^DEVICE_DUPLICATION=.*$/DEVICE_DUPLICATION=shm/g" .env -i
     sed "s/^STREAM_VID_DEVICE=.*$/STREAM_VID_DEVICE=127.0.0.1/g" .env -i
     sed "s:^VID_CAMERA_DEVICE=.*$:VID_CAMERA_DEVICE=/dev/video0:g" .env -i
 else